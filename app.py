@@ -1,12 +1,39 @@
-from flask import Flask, render_template, request, jsonify, Response
+from flask import Flask, render_template, request, jsonify, Response, send_file, url_for, g
 import re
 import os
 import subprocess
-from threading import Thread
-from queue import Queue
+import threading
+from threading import Thread, Timer, Lock, Condition
+from collections import deque, Counter, defaultdict
 from werkzeug.utils import secure_filename
 import json
 import shutil
+import sqlite3
+import time
+import gzip
+import uuid
+import random
+import io
+import zipfile
+import tarfile
+from urllib.parse import quote, urlparse, urlunparse, urlencode, parse_qsl
+from functools import lru_cache
+from contextlib import contextmanager
+import cProfile
+import pstats
+import tracemalloc
+import math
+import urllib.request
+import urllib.error
+import http.client
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
+import platform
+import ctypes
+import fcntl
+from queue import Queue
+import resource
+import signal
 
 app = Flask(__name__)
 UPLOAD_FOLDER = 'uploads/cookies'
@@ -16,50 +43,506 @@ os.makedirs(DOWNLOAD_FOLDER, exist_ok=True)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['DOWNLOAD_FOLDER'] = DOWNLOAD_FOLDER
 
+# SQLite database holding the media library index (see "Media Library Index" below). data/ is a
+# volume in docker-compose.yml so the index, scan cursor and job logs outlive the container.
+LIBRARY_DB = 'data/library.db'
+app.config['LIBRARY_DB'] = LIBRARY_DB
+
+# Per-job log files (gzip segments) and in-memory log limits
+LOG_FOLDER = 'data/logs'
+app.config['LOG_FOLDER'] = LOG_FOLDER
+LOG_BUFFER_LINES = 500          # events kept in memory per job
+GLOBAL_LOG_BUFFER_LINES = 2000  # events kept for subscribers of the global stream
+LOG_ROTATE_BYTES = 8 * 1024 * 1024
+LOG_MAX_SEGMENTS = 5
+MAX_FINISHED_JOBS = 200         # finished jobs kept in memory; their logs stay on disk
+LOG_RETENTION_JOBS = 2000       # jobs whose logs are kept on disk
+LOG_RETENTION_SECONDS = 30 * 24 * 3600
+SSE_KEEPALIVE_SECONDS = 15
+
+# Post-download deduplication: identical media files are replaced with links to one copy
+DEDUP_ENABLED = True
+DEDUP_LINK_MODE = 'hardlink'    # or 'reflink' (copy-on-write clone, falls back to a hard link)
+DEDUP_HASH_WORKERS = 2
+DEDUP_SAMPLE_BYTES = 64 * 1024  # read from each end of a file for the cheap prefilter hash
+DEDUP_CHUNK_SIZE = 1024 * 1024
+
+# Request instrumentation. Profiling and tracemalloc endpoints stay off unless enabled here;
+# when PROFILING_TOKEN is set, requests must present it (X-Profile header or ?profile=).
+PROFILE_FOLDER = 'data/profiles'
+app.config['PROFILE_FOLDER'] = PROFILE_FOLDER
+app.config['PROFILING_ENABLED'] = False
+app.config['PROFILING_TOKEN'] = None
+
+# Scratch staging: set SCRATCH_FOLDER to fast local storage (SSD/tmpfs) to keep temporary and
+# intermediate files off the destination; results are moved to output_dir when the job is done
+app.config['SCRATCH_FOLDER'] = None
+SCRATCH_MAX_BYTES = 50 * 1024 ** 3
+SCRATCH_JOB_RESERVE_BYTES = 4 * 1024 ** 3  # space set aside per staged job
+SCRATCH_MOVE_WORKERS = 2
+
+# Segmented downloads: one long video fetched as parallel byte ranges
+SEGMENTED_DEFAULT_SEGMENTS = 4
+SEGMENTED_MAX_SEGMENTS = 16
+SEGMENTED_MIN_BYTES = 32 * 1024 * 1024  # smaller streams are fetched as a single range
+SEGMENT_RETRIES = 4
+SEGMENT_TIMEOUT = 30
+SEGMENT_CHUNK_SIZE = 256 * 1024
+# yt-dlp options whose post-processors must still run on the merged file of a segmented job
+POSTPROCESSING_FLAGS = ('--embed-', '--sponsorblock-remove', '--sponsorblock-mark', '--remux-video',
+                        '--recode-video', '--convert-', '--remove-chapters', '--split-chapters',
+                        '--add-metadata', '--parse-metadata', '--replace-in-metadata', '--exec',
+                        '--use-postprocessor', '--postprocessor-args', '--ppa', '--xattrs', '-x',
+                        '--extract-audio', '--fixup')
+PROBE_TIMEOUT = 120
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, math.inf)
+
+# Artifact cache: finished single-video downloads kept for answering repeat requests offline
+# Hidden folder inside the downloads volume, so cache entries can be hard links of downloaded files
+ARTIFACT_CACHE_FOLDER = os.path.join(DOWNLOAD_FOLDER, '.cache')
+app.config['ARTIFACT_CACHE_FOLDER'] = ARTIFACT_CACHE_FOLDER
+ARTIFACT_CACHE_ENABLED = True
+ARTIFACT_CACHE_MAX_BYTES = 20 * 1024 ** 3
+
+# Deferred metadata: with download_options.defer_metadata, sidecar files (description, comments,
+# info JSON, subtitles, thumbnail) are fetched by a low-priority queue after the media is done
+METADATA_WORKERS = 1
+
+# Process supervision: priority and resource limits per job class (None leaves a limit unset),
+# and how long a download may go without printing anything before it is considered stalled
+PROCESS_LIMITS = {
+    'download': {'nice': 5, 'ionice_level': 4, 'max_memory_bytes': 4 * 1024 ** 3, 'max_open_files': 1024,
+                 'max_cpu_seconds': None},
+    'playlist': {'nice': 5, 'ionice_level': 4, 'max_memory_bytes': 4 * 1024 ** 3, 'max_open_files': 1024,
+                 'max_cpu_seconds': None},
+    'merge': {'nice': 10, 'ionice_level': 6, 'max_memory_bytes': 8 * 1024 ** 3, 'max_open_files': 256,
+              'max_cpu_seconds': 3600},
+    'probe': {'nice': 0, 'ionice_level': 4, 'max_memory_bytes': 2 * 1024 ** 3, 'max_open_files': 256,
+              'max_cpu_seconds': 300},
+    'metadata': {'nice': 15, 'ionice_level': 7, 'max_memory_bytes': 2 * 1024 ** 3, 'max_open_files': 256,
+                 'max_cpu_seconds': None},
+}
+STALL_TIMEOUT_SECONDS = 10 * 60
+# ffmpeg steps run by yt-dlp (merging, converting, SponsorBlock cuts, embedding) print nothing
+# until they finish, so silence there isn't a stall; None disarms the watchdog during them
+POSTPROCESSING_STALL_TIMEOUT_SECONDS = None
+POSTPROCESSING_PHASES = ('merging', 'converting', 'sponsorblock', 'embedding')
+STALL_CHECK_SECONDS = 5
+KILL_GRACE_SECONDS = 10
+
+# yt-dlp executable; the load harness points this at its stub (loadtest/fake_yt_dlp.py)
+YT_DLP_BINARY = os.environ.get('YT_DLP_BINARY', 'yt-dlp')
+
 # Used for a couple helper functions, mainly for parsing metadata files
 MEDIA_EXTENSIONS = {'.mp4', '.webm', '.mkv', '.flv', '.avi', '.mp3', '.m4a', '.ogg', '.aac', '.flac'}
 
-log_queue = Queue()
+jobs = {}
+jobs_lock = Lock()
 
 # Helper Functions
 def is_likely_playlist(url):
-    """Helper to determine if a URL likely points to a playlist based on common patterns."""
+    """
+    Helper to determine if a URL points to a playlist: asks the URL classifier first and falls
+    back to common patterns for URLs no extractor recognizes.
+    """
+    classification = classify_url(url)
+    if classification['extractor']:
+        return classification['is_playlist']
     lower_url = url.lower()
     return ('playlist' in lower_url or 
             'list=' in lower_url or
             '/sets/' in lower_url or
             '/albums/' in lower_url)
 
+def url_domain(url):
+    """Host name of a URL without a leading "www.", used to group jobs by site."""
+    host = (urlparse(url).hostname or '').lower()
+    return host[4:] if host.startswith('www.') else host
+
+def normalize_url(url):
+    """
+    Canonical form of a URL for recognizing repeated requests: "extractor:id" when the classifier
+    knows the URL, otherwise the URL without fragment, "www." and host case, with sorted query.
+    """
+    classification = classify_url(url)
+    if classification['extractor'] and classification['id']:
+        return f"{classification['extractor']}:{classification['id']}"
+    parts = urlparse(url)
+    netloc = parts.netloc.lower()
+    netloc = netloc[4:] if netloc.startswith('www.') else netloc
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunparse((parts.scheme.lower(), netloc, parts.path.rstrip('/') or '/', parts.params, query, ''))
+
+# URL Classification
+#
+# URLs are matched against yt-dlp's extractor URL patterns (_VALID_URL) to find the extractor,
+# whether it yields a playlist and the canonical ID. The patterns are compiled once and indexed
+# by the literal host names found in them, so a URL is only tested against the extractors for
+# its host (plus those whose host part is variable). Results are memoized. Without the
+# yt_dlp package a small built-in set of patterns for the main sites is used instead.
+URL_CLASSIFY_CACHE_SIZE = 4096
+URL_BATCH_LIMIT = 5000
+# Extractors whose pattern matches any URL; a match there does not make a URL supported
+CATCH_ALL_EXTRACTORS = {'generic'}
+PLAYLIST_NAME_HINTS = ('playlist', 'channel', 'tab', 'user', 'album', 'series', 'season', 'show', 'list',
+                       'collection', 'search')
+
+FALLBACK_EXTRACTORS = [
+    ('youtube:tab', [r'https?://(?:www\.|m\.|music\.)?youtube\.com/(?:playlist|watch)\?(?:[^#]*&)?list=(?P<id>[\w-]+)',
+                     r'https?://(?:www\.|m\.)?youtube\.com/(?:@|c/|channel/|user/)(?P<id>[^/?#]+)'], True),
+    ('youtube', [r'https?://(?:www\.|m\.|music\.)?youtube\.com/(?:watch\?(?:[^#]*&)?v=|shorts/|live/|embed/)(?P<id>[\w-]{11})',
+                 r'https?://youtu\.be/(?P<id>[\w-]{11})'], False),
+    ('vimeo:album', [r'https?://(?:www\.)?vimeo\.com/(?:album|showcase)/(?P<id>\d+)'], True),
+    ('vimeo', [r'https?://(?:www\.|player\.)?vimeo\.com/(?:video/)?(?P<id>\d+)'], False),
+    ('dailymotion:playlist', [r'https?://(?:www\.)?dailymotion\.com/playlist/(?P<id>x[0-9a-z]+)'], True),
+    ('dailymotion', [r'https?://(?:www\.)?dailymotion\.com/video/(?P<id>[0-9a-z]+)',
+                     r'https?://dai\.ly/(?P<id>[0-9a-z]+)'], False),
+    ('twitch:vod', [r'https?://(?:www\.|m\.)?twitch\.tv/(?:[^/]+/)?v(?:ideos?)?/(?P<id>\d+)'], False),
+    ('twitch:clips', [r'https?://clips\.twitch\.tv/(?P<id>[^/?#]+)'], False),
+    ('twitch:videos', [r'https?://(?:www\.)?twitch\.tv/(?P<id>[^/?#]+)/videos'], True),
+    ('twitch:stream', [r'https?://(?:www\.|m\.)?twitch\.tv/(?P<id>[^/?#]+)/?(?:[?#]|$)'], False),
+    ('facebook', [r'https?://(?:[\w-]+\.)?facebook\.com/(?:[^?#]*/videos/|watch/?\?v=|reel/)(?P<id>\d+)',
+                  r'https?://fb\.watch/(?P<id>[\w-]+)'], False),
+    ('instagram', [r'https?://(?:www\.)?instagram\.com/(?:[^/]+/)?(?:p|reels?|tv)/(?P<id>[^/?#&]+)'], False),
+    ('tiktok:user', [r'https?://(?:www\.)?tiktok\.com/@(?P<id>[\w.-]+)/?(?:[?#]|$)'], True),
+    ('tiktok', [r'https?://(?:www\.|m\.)?tiktok\.com/(?:@[\w.-]+/video|v|embed(?:/v2)?)/(?P<id>\d+)',
+                r'https?://vm\.tiktok\.com/(?P<id>\w+)'], False),
+    ('soundcloud:set', [r'https?://(?:www\.|m\.)?soundcloud\.com/(?P<uploader>[\w-]+)/sets/(?P<id>[\w-]+)'], True),
+    ('soundcloud', [r'https?://(?:www\.|m\.)?soundcloud\.com/(?P<uploader>[\w-]+)/(?P<id>[\w-]+)/?(?:[?#]|$)'], False),
+]
+
+_url_index = None
+_url_index_lock = Lock()
+
+def tokenize_host_pattern(pattern):
+    """
+    Tokens of the host part of a URL regex (after "://", up to the first "/" outside groups):
+    ('lit', char), ('dot',) for an escaped dot, ('var',) for anything variable, ('open', lookaround),
+    ('close', optional), ('alt',). Returns None if the host part cannot be analysed.
+    """
+    start = pattern.find('://')
+    if start == -1 or pattern.count('://') > 1:
+        return None  # several alternative schemes/hosts
+    verbose = pattern.lstrip('^').startswith('(?x')
+    tokens, opened, i = [], [], start + 3
+    while i < len(pattern):
+        char = pattern[i]
+        i += 1
+        if verbose and char.isspace():
+            continue
+        if verbose and char == '#':
+            newline = pattern.find('\n', i)
+            i = len(pattern) if newline == -1 else newline
+            continue
+        if char == '\\':
+            tokens.append(('dot',) if pattern[i:i + 1] == '.' else ('var',))
+            i += 1
+        elif char == '[':
+            while i < len(pattern) and pattern[i] != ']':
+                i += 2 if pattern[i] == '\\' else 1
+            i += 1
+            tokens.append(('var',))
+        elif char == '(':
+            lookaround = pattern[i:i + 2] in ('?=', '?!') or pattern[i:i + 3] in ('?<=', '?<!')
+            if pattern[i:i + 1] == '?':  # skip "?:", "?P<name>", "?=" and similar
+                i = min(p for p in (pattern.find(':', i), pattern.find('>', i), i + 2) if p != -1) + 1 \
+                    if not lookaround else i + (2 if pattern[i + 1] in '=!' else 3)
+            opened.append(len(tokens))
+            tokens.append(('open', lookaround))
+        elif char == ')':
+            if not opened:
+                if tokens:
+                    break  # closes a group opened before the host part
+                if i < len(pattern) and pattern[i] in '?*+':
+                    i += 1
+                continue
+            opened.pop()
+            optional = i < len(pattern) and pattern[i] in '?*{'
+            tokens.append(('close', optional))
+        elif char in '?*+{':
+            if char == '{':
+                i = pattern.find('}', i) + 1
+            if tokens and tokens[-1][0] == 'lit':
+                tokens[-1] = ('var',)  # an optional or repeated character is not literal
+            elif tokens and tokens[-1][0] == 'close' and char != '+':
+                tokens[-1] = ('close', True)
+        elif char == '|':
+            tokens.append(('alt',))
+        elif char == '/':
+            if opened and tokens[-1][0] in ('open', 'alt'):
+                return tokens[:opened[0]]  # a group like (?:/|$) after the host
+            if opened:
+                return None
+            break
+        elif char in '^$.':
+            tokens.append(('var',))
+        else:
+            tokens.append(('lit', char.lower()))
+    return tokens
+
+def parse_host_tokens(tokens):
+    """Turn host tokens into a sequence of items; groups are {'branches': [...], 'optional': bool}."""
+    stack = [{'branches': [[]], 'optional': False}]
+    for token in tokens:
+        if token[0] == 'open':
+            stack.append({'branches': [[]], 'optional': token[1]})
+        elif token[0] == 'close':
+            group = stack.pop()
+            group['optional'] = group['optional'] or token[1]
+            stack[-1]['branches'][-1].append(group)
+        elif token[0] == 'alt':
+            stack[-1]['branches'].append([])
+        else:
+            stack[-1]['branches'][-1].append(token)
+    while len(stack) > 1:  # unclosed groups: treat as optional
+        group = stack.pop()
+        group['optional'] = True
+        stack[-1]['branches'][-1].append(group)
+    top = stack[0]
+    return top['branches'][0] if len(top['branches']) == 1 else [top]
+
+def sequence_hosts(sequence, left_boundary=True, right_boundary=True):
+    """
+    Host literals one of which every host matched by `sequence` contains as whole labels, or
+    None if there is no such set. The boundary flags say whether a label ends just outside the
+    sequence on that side.
+    """
+    def edge_is_dot(group, index):
+        return all(branch and branch[index] == ('dot',) for branch in group['branches'])
+
+    pieces = []
+    for item in sequence:
+        if isinstance(item, dict):
+            # A group is opaque here, but a dot on its edge still separates labels
+            pieces.append(('\\.' if edge_is_dot(item, 0) else '') + '#' + ('\\.' if edge_is_dot(item, -1) else ''))
+        else:
+            pieces.append({'lit': lambda: item[1], 'dot': lambda: '\\.', 'var': lambda: '#'}[item[0]]())
+    prefix, suffix = ('' if left_boundary else '#'), ('' if right_boundary else '#')
+    literals = re.findall(r'(?<![a-z0-9#-])[a-z0-9-]+(?:\\\.[a-z0-9-]+)+(?![a-z0-9#-])', prefix + ''.join(pieces) + suffix)
+    if literals:
+        return {literals[-1].replace('\\.', '.')}
+    for position, item in enumerate(sequence):
+        if isinstance(item, dict) and not item['optional']:
+            before = prefix + ''.join(pieces[:position])
+            after = ''.join(pieces[position + 1:]) + suffix
+            branch_hosts = [sequence_hosts(branch, before == '' or before.endswith('\\.'),
+                                           after == '' or after.startswith('\\.'))
+                            for branch in item['branches']]
+            if all(branch_hosts):
+                return set().union(*branch_hosts)
+    return None
+
+def pattern_hosts(pattern):
+    """
+    Host names (e.g. {"youtube.com"}) that every URL matching a pattern has as whole labels of
+    its host. Empty when that cannot be told from the pattern, e.g. a fully variable host.
+    """
+    tokens = tokenize_host_pattern(pattern)
+    if not tokens:
+        return set()
+    return sequence_hosts(parse_host_tokens(tokens)) or set()
+
+def host_keys(hostname):
+    """Every run of two or more consecutive labels of a host name, the keys it may be indexed under."""
+    labels = hostname.lower().rstrip('.').split('.')
+    return {'.'.join(labels[i:j]) for i in range(len(labels)) for j in range(i + 2, len(labels) + 1)}
+
+def build_url_index(extractors):
+    """
+    Compile (name, patterns, is_playlist[, suitable]) extractor specs into a host index.
+    `suitable` is an optional callable replacing the regex test (yt-dlp extractors with
+    extra rules). Extractor order is kept: the first suitable extractor wins.
+    """
+    index = {'by_host': {}, 'unindexed': []}
+    for position, spec in enumerate(extractors):
+        name, patterns, is_playlist = spec[:3]
+        entry = {
+            'position': position,
+            'name': name,
+            'patterns': [re.compile(p) for p in patterns],
+            'is_playlist': is_playlist,
+            'suitable': spec[3] if len(spec) > 3 else None,
+        }
+        hosts = [pattern_hosts(p) for p in patterns]
+        if not hosts or not all(hosts):
+            index['unindexed'].append(entry)  # some pattern could match any host
+            continue
+        for host in set().union(*hosts):
+            index['by_host'].setdefault(host, []).append(entry)
+    return index
+
+def yt_dlp_extractor_specs():
+    """Extractor specs from the installed yt_dlp package, or None if it is not installed."""
+    try:
+        from yt_dlp.extractor import gen_extractor_classes
+    except ImportError:
+        return None
+    specs = []
+    for ie in gen_extractor_classes():
+        valid_url = getattr(ie, '_VALID_URL', None)
+        if not valid_url or ie.IE_NAME in CATCH_ALL_EXTRACTORS:
+            continue
+        patterns = [valid_url] if isinstance(valid_url, str) else list(valid_url)
+        return_type = getattr(ie, '_RETURN_TYPE', None)
+        if return_type in ('video', 'playlist'):
+            is_playlist = return_type == 'playlist'
+        else:  # 'any' or not declared
+            is_playlist = any(hint in ie.IE_NAME.lower() for hint in PLAYLIST_NAME_HINTS)
+        specs.append((ie.IE_NAME, patterns, is_playlist, ie.suitable))
+    return specs
+
+def get_url_index():
+    global _url_index
+    with _url_index_lock:
+        if _url_index is None:
+            specs = yt_dlp_extractor_specs()
+            if specs is None:
+                print("yt_dlp package not installed; classifying URLs with the built-in patterns")
+                specs = FALLBACK_EXTRACTORS
+            _url_index = build_url_index(specs)
+        return _url_index
+
+def match_url(index, url):
+    """First extractor in `index` that accepts url: (name, is_playlist, id) or None."""
+    hostname = (urlparse(url).hostname or '').lower()
+    candidates = {id(entry): entry for key in host_keys(hostname) for entry in index['by_host'].get(key, ())}
+    candidates.update((id(entry), entry) for entry in index['unindexed'])
+    for entry in sorted(candidates.values(), key=lambda e: e['position']):
+        matches = [m for m in (p.match(url) for p in entry['patterns']) if m]
+        if not matches:
+            continue
+        if entry['suitable'] is not None and not entry['suitable'](url):
+            continue
+        groups = matches[0].groupdict()
+        return entry['name'], entry['is_playlist'], groups.get('id')
+    return None
+
+@lru_cache(maxsize=URL_CLASSIFY_CACHE_SIZE)
+def _classify_url(url):
+    return match_url(get_url_index(), url)
+
+def classify_url(url):
+    """Extractor name, playlist flag and canonical ID for a URL (extractor None if unsupported)."""
+    # Scheme and host are case-insensitive, but the extractor patterns expect them in lower case
+    url = re.sub(r'^[a-zA-Z][\w+.-]*://[^/?#]*', lambda m: m.group(0).lower(), url.strip())
+    match = _classify_url(url)
+    if match is None:
+        return {'extractor': None, 'is_playlist': False, 'id': None}
+    name, is_playlist, video_id = match
+    return {'extractor': name, 'is_playlist': is_playlist, 'id': video_id}
+
+# How each requested output can be produced without re-encoding. For video, "sort" is the
+# yt-dlp format-sort (-S) preference that steers selection toward streams the target container
+# can hold as-is (merging and remuxing then only copy streams); None means any codec fits.
+# Resolution comes first so the codec preference only breaks ties; FLV is the exception, as it
+# can only hold H.264 and --remux-video would fail on the VP9/AV1 streams higher resolutions use.
+VIDEO_FORMAT_PLANS = {
+    'mp4': {'sort': 'res,vcodec:h264,acodec:aac', 'vcodecs': ('avc1', 'avc', 'h264', 'hev1', 'hvc1', 'av01'),
+            'acodecs': ('mp4a', 'aac', 'mp3'), 'output': ['--merge-output-format', 'mp4']},
+    'mkv': {'sort': None, 'vcodecs': None, 'acodecs': None, 'output': ['--merge-output-format', 'mkv']},
+    'webm': {'sort': 'res,vcodec:vp9,acodec:opus', 'vcodecs': ('vp9', 'vp09', 'vp8', 'av01'),
+             'acodecs': ('opus', 'vorbis'), 'output': []},
+    'flv': {'sort': 'vcodec:h264,acodec:aac', 'vcodecs': ('avc1', 'h264'),
+            'acodecs': ('mp4a', 'aac', 'mp3'), 'output': ['--remux-video', 'flv']},
+    'avi': {'sort': 'res,vcodec:h264,acodec:mp3', 'vcodecs': ('avc1', 'h264', 'mpeg4'),
+            'acodecs': ('mp3', 'mp4a', 'aac'), 'output': ['--merge-output-format', 'avi']},
+}
+# For audio, an input stream already in the target codec is only re-muxed by --audio-format.
+# source_exts are the downloaded extensions that indicate such a stream.
+AUDIO_FORMAT_PLANS = {
+    'mp3': {'audio_format': 'mp3', 'acodecs': ('mp3',), 'source_exts': ('mp3',)},
+    'm4a': {'audio_format': 'm4a', 'acodecs': ('mp4a', 'aac'), 'source_exts': ('m4a', 'mp4', 'aac')},
+    'aac': {'audio_format': 'aac', 'acodecs': ('mp4a', 'aac'), 'source_exts': ('m4a', 'mp4', 'aac')},
+    'ogg': {'audio_format': 'vorbis', 'acodecs': ('vorbis',), 'source_exts': ('ogg',)},
+    'flac': {'audio_format': 'flac', 'acodecs': ('flac',), 'source_exts': ('flac',)},
+}
+
+def _codec_matches(codec, prefixes):
+    return bool(codec) and codec != 'none' and codec.lower().startswith(prefixes)
+
+def plan_format(format_type, formats=None):
+    """
+    Plan the yt-dlp format flags for a requested output format, preferring streams that can be
+    stream-copied into it and falling back to transcoding only when required.
+
+    formats is the optional list of available formats (the "formats" entry of an info.json).
+    Without it, selection is left to yt-dlp's format sorting and the expected path is recorded.
+    Returns {'args': [...], 'strategy': 'copy' | 'transcode' | 'auto', 'reason': str}.
+    """
+    if format_type in VIDEO_FORMAT_PLANS:
+        plan = VIDEO_FORMAT_PLANS[format_type]
+        if format_type == 'flv':
+            args = ['-f', 'b[ext=flv]/bv*+ba/b']
+        else:
+            args = ['-f', 'bv*+ba/b']
+        if plan['sort']:
+            args += ['-S', plan['sort']]
+        args += plan['output']
+        if plan['vcodecs'] is None:
+            return {'args': args, 'strategy': 'copy', 'reason': f'{format_type} accepts any codec'}
+        if formats is None:
+            return {'args': args, 'strategy': 'auto',
+                    'reason': f'format sorting prefers {plan["sort"]} for stream copy'}
+        has_video = any(_codec_matches(f.get('vcodec'), plan['vcodecs']) for f in formats)
+        has_audio = any(_codec_matches(f.get('acodec'), plan['acodecs']) for f in formats)
+        if has_video and has_audio:
+            return {'args': args, 'strategy': 'copy', 'reason': f'compatible streams available for {format_type}'}
+        if format_type == 'mp4':
+            # MP4 also holds VP9/AV1 and Opus, so ffmpeg can mux those without re-encoding. WebM
+            # only takes VP8/VP9/AV1 with Opus/Vorbis; anything else must be transcoded below.
+            return {'args': args, 'strategy': 'copy', 'reason': 'no preferred codecs; remuxing into mp4'}
+        return {'args': args + ['--recode-video', format_type], 'strategy': 'transcode',
+                'reason': f'no streams compatible with {format_type}'}
+
+    command = ['-x']
+    plan = AUDIO_FORMAT_PLANS.get(format_type)
+    if plan is None:
+        return {'args': command, 'strategy': 'auto', 'reason': 'audio extraction in source format'}
+    selector = '/'.join(f'ba[acodec^={codec}]' for codec in plan['acodecs']) + '/ba/b'
+    args = ['-f', selector] + command + ['--audio-format', plan['audio_format']]
+    if formats is None:
+        return {'args': args, 'strategy': 'auto',
+                'reason': f'copy if a {"/".join(plan["acodecs"])} stream exists, otherwise transcode'}
+    if any(_codec_matches(f.get('acodec'), plan['acodecs']) for f in formats):
+        return {'args': args, 'strategy': 'copy', 'reason': f'{plan["acodecs"][0]} stream available'}
+    return {'args': args, 'strategy': 'transcode', 'reason': f'no {plan["acodecs"][0]} stream available'}
+
 def build_format_command(format_type):
     """
     Helper to build yt-dlp format-specific command flags.
     Returns a list of flags based on whether video or audio is requested.
     """
-    command = []
-    if format_type in ['mp4', 'mkv', 'webm', 'flv', 'avi']:
-        if format_type == 'mp4':
-            command += ['-f', 'bestvideo+bestaudio', '--merge-output-format', 'mp4']
-        elif format_type == 'mkv':
-            command += ['-f', 'bestvideo+bestaudio', '--merge-output-format', 'mkv']
-        elif format_type == 'webm':
-            command += ['-f', 'bestvideo+bestaudio/best[ext=webm]']
-        elif format_type == 'flv':
-            command += ['-f', 'best[ext=flv]']
-        elif format_type == 'avi':
-            command += ['-f', 'bestvideo+bestaudio', '--merge-output-format', 'avi']
-    else:
-        command += ['-x']
-        if format_type == 'mp3':
-            command += ['--audio-format', 'mp3']
-        elif format_type == 'ogg':
-            command += ['--audio-format', 'vorbis']
-        elif format_type == 'aac':
-            command += ['--audio-format', 'aac']
-        elif format_type == 'flac':
-            command += ['--audio-format', 'flac']
-        elif format_type == 'm4a':
-            command += ['--audio-format', 'm4a']
-    return command
+    return plan_format(format_type)['args']
+
+def observe_format_path(job, line, source_ext):
+    """
+    Update job['format_path'] from yt-dlp post-processor output: converters mean the media was
+    re-encoded, mergers/remuxers and "Not converting" mean streams were copied.
+    source_ext is the extension of the last downloaded file.
+    """
+    if line.startswith('[VideoConvertor]'):
+        job['format_path'] = 'transcode'
+    elif line.startswith('[ExtractAudio]'):
+        plan = AUDIO_FORMAT_PLANS.get(job.get('format'))
+        if 'Not converting audio' in line or (plan and source_ext in plan['source_exts']):
+            job['format_path'] = job.get('format_path') or 'copy'
+        else:
+            job['format_path'] = 'transcode'
+    elif line.startswith(('[Merger]', '[VideoRemuxer]')) and job.get('format_path') != 'transcode':
+        job['format_path'] = 'copy'
+
+def known_formats(url):
+    """Available formats for a URL from an info.json already in the library, or None."""
+    with _library_lock:
+        row = get_library_db().execute("SELECT path FROM media WHERE url = ? LIMIT 1", (url,)).fetchone()
+    info_path = find_info_json(row['path']) if row else None
+    if not info_path:
+        return None
+    try:
+        with open(info_path, 'r', encoding='utf-8') as f:
+            return json.load(f).get('formats')
+    except (OSError, ValueError):
+        return None
 
 def add_download_option_commands(command, download_options, metadata_dir, is_playlist):
     """
@@ -93,6 +576,18 @@ def add_download_option_commands(command, download_options, metadata_dir, is_pla
     if download_options.get('sponsorblock') or download_options.get('sponsorblock_remove'):
         command += ['--sponsorblock-remove', 'all']
 
+def parse_destination(line):
+    """
+    Extract the output file path from a yt-dlp line announcing where a file is written
+    ("[download] Destination: ...", "[Merger] Merging formats into ...", "[ExtractAudio] Destination: ...",
+    "[VideoRemuxer] Remuxing video from webm to mp4; Destination: ...").
+    Returns None for any other line.
+    """
+    match = re.search(r'^\[(?:download|ExtractAudio|VideoConvertor|VideoRemuxer)\] (?:.*; )?Destination: (.+)$', line.strip())
+    if not match:
+        match = re.search(r'^\[Merger\] Merging formats into "(.+)"$', line.strip())
+    return match.group(1) if match else None
+
 def deduplicate_command(command):
     """Helper to remove duplicate flags from the command list while preserving order and arguments."""
     unique_command = []
@@ -177,6 +672,2318 @@ def move_media_files_up_and_metadata_down(base_dir):
         if not moved:
             print(f"Did not move metadata file (no matching media found): {file}")
 
+# Media Library Index
+#
+# Every finished media file is recorded in a SQLite table with an FTS5 index over
+# the searchable fields, so the library can be searched and listed without walking
+# the download tree. Rows are keyed by path and carry the file's mtime, which lets
+# both the per-job indexer and the background scanner skip unchanged files.
+LIBRARY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS media (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    dir TEXT NOT NULL,
+    title TEXT,
+    uploader TEXT,
+    duration REAL,
+    format TEXT,
+    ext TEXT,
+    url TEXT,
+    extractor TEXT,
+    video_id TEXT,
+    filesize INTEGER,
+    mtime REAL,
+    indexed_at REAL
+);
+CREATE INDEX IF NOT EXISTS media_dir ON media(dir);
+CREATE INDEX IF NOT EXISTS media_url ON media(url);
+CREATE VIRTUAL TABLE IF NOT EXISTS media_fts USING fts5(
+    title, uploader, format, path, url,
+    content='media', content_rowid='id'
+);
+CREATE TRIGGER IF NOT EXISTS media_ai AFTER INSERT ON media BEGIN
+    INSERT INTO media_fts(rowid, title, uploader, format, path, url)
+    VALUES (new.id, new.title, new.uploader, new.format, new.path, new.url);
+END;
+CREATE TRIGGER IF NOT EXISTS media_ad AFTER DELETE ON media BEGIN
+    INSERT INTO media_fts(media_fts, rowid, title, uploader, format, path, url)
+    VALUES ('delete', old.id, old.title, old.uploader, old.format, old.path, old.url);
+END;
+CREATE TRIGGER IF NOT EXISTS media_au AFTER UPDATE ON media BEGIN
+    INSERT INTO media_fts(media_fts, rowid, title, uploader, format, path, url)
+    VALUES ('delete', old.id, old.title, old.uploader, old.format, old.path, old.url);
+    INSERT INTO media_fts(rowid, title, uploader, format, path, url)
+    VALUES (new.id, new.title, new.uploader, new.format, new.path, new.url);
+END;
+CREATE TABLE IF NOT EXISTS content_hashes (
+    path TEXT PRIMARY KEY,
+    dev INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    quick_hash TEXT NOT NULL,
+    full_hash TEXT
+);
+CREATE INDEX IF NOT EXISTS content_hashes_quick ON content_hashes(size, quick_hash);
+CREATE TABLE IF NOT EXISTS artifact_cache (
+    key TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    format TEXT,
+    files TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    last_used REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS artifact_cache_lru ON artifact_cache(last_used);
+CREATE TABLE IF NOT EXISTS scan_state (
+    root TEXT PRIMARY KEY,
+    cursor TEXT,
+    files_indexed INTEGER NOT NULL DEFAULT 0,
+    started_at REAL,
+    finished_at REAL
+);
+"""
+
+MEDIA_COLUMNS = ('id', 'path', 'title', 'uploader', 'duration', 'format', 'ext', 'url',
+                 'extractor', 'video_id', 'filesize', 'mtime', 'indexed_at')
+
+_library_lock = Lock()
+_library_conn = None
+_library_conn_path = None
+library_scan_status = {'running': False, 'root': None, 'files_indexed': 0, 'error': None}
+
+def get_library_db():
+    """
+    Return the shared library connection, opening it (and creating the schema) on first use.
+    Callers must hold _library_lock while using the connection.
+    """
+    global _library_conn, _library_conn_path
+    db_path = app.config['LIBRARY_DB']
+    if _library_conn is None or _library_conn_path != db_path:
+        if _library_conn is not None:
+            _library_conn.close()
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        conn = sqlite3.connect(db_path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(LIBRARY_SCHEMA)
+        _library_conn, _library_conn_path = conn, db_path
+    return _library_conn
+
+def find_info_json(media_path):
+    """
+    Locate the info.json sidecar for a media file.
+    Checks the organized layout (<dir>/<title>/<title>.info.json) first, then a sidecar next to the file.
+    """
+    base_dir, filename = os.path.split(media_path)
+    stem = os.path.splitext(filename)[0]
+    for candidate in (os.path.join(base_dir, stem, f"{stem}.info.json"),
+                      os.path.join(base_dir, f"{stem}.info.json")):
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+def read_media_record(media_path, stat_result):
+    """Build a library row for a media file from its info.json sidecar (if any) and file stats."""
+    stem, ext = os.path.splitext(os.path.basename(media_path))
+    info = {}
+    info_path = find_info_json(media_path)
+    if info_path:
+        try:
+            with open(info_path, 'r', encoding='utf-8') as f:
+                info = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Could not read metadata {info_path}: {e}")
+    return {
+        'path': media_path,
+        'dir': os.path.dirname(media_path),
+        'title': info.get('title') or stem,
+        'uploader': info.get('uploader') or info.get('channel'),
+        'duration': info.get('duration'),
+        'format': info.get('format') or ext.lstrip('.').lower(),
+        'ext': ext.lstrip('.').lower(),
+        'url': info.get('webpage_url') or info.get('original_url'),
+        'extractor': info.get('extractor_key') or info.get('extractor'),
+        'video_id': info.get('id'),
+        'filesize': stat_result.st_size,
+        'mtime': stat_result.st_mtime,
+        'indexed_at': time.time(),
+    }
+
+def _upsert_media(conn, record):
+    conn.execute("""
+        INSERT INTO media (path, dir, title, uploader, duration, format, ext, url,
+                           extractor, video_id, filesize, mtime, indexed_at)
+        VALUES (:path, :dir, :title, :uploader, :duration, :format, :ext, :url,
+                :extractor, :video_id, :filesize, :mtime, :indexed_at)
+        ON CONFLICT(path) DO UPDATE SET
+            dir=excluded.dir, title=excluded.title, uploader=excluded.uploader,
+            duration=excluded.duration, format=excluded.format, ext=excluded.ext,
+            url=excluded.url, extractor=excluded.extractor, video_id=excluded.video_id,
+            filesize=excluded.filesize, mtime=excluded.mtime, indexed_at=excluded.indexed_at
+    """, record)
+
+def index_media_files(paths, force=False):
+    """
+    Add or refresh library entries for the given media files.
+    Files whose mtime matches the indexed row are skipped unless force is set (e.g. when sidecar
+    metadata arrived later); missing files are dropped from the index.
+    Returns the number of rows written.
+    """
+    paths = [os.path.abspath(p) for p in paths if is_media_file(p)]
+    if not paths:
+        return 0
+    with _library_lock:
+        conn = get_library_db()
+        placeholders = ','.join('?' * len(paths))
+        known = {row['path']: row['mtime'] for row in conn.execute(
+            f"SELECT path, mtime FROM media WHERE path IN ({placeholders})", paths)}
+
+    records, missing = [], []
+    for path in paths:
+        try:
+            stat_result = os.stat(path)
+        except OSError:
+            missing.append((path,))
+            continue
+        if known.get(path) == stat_result.st_mtime and not force:
+            continue
+        records.append(read_media_record(path, stat_result))
+
+    with _library_lock:
+        conn = get_library_db()
+        with conn:
+            for record in records:
+                _upsert_media(conn, record)
+            conn.executemany("DELETE FROM media WHERE path = ?", missing)
+    return len(records)
+
+def _index_directory(conn, dirpath, filenames):
+    """Sync one directory's media files into the index. Caller holds the lock and the transaction."""
+    known = {row['path']: row['mtime'] for row in conn.execute(
+        "SELECT path, mtime FROM media WHERE dir = ?", (dirpath,))}
+    written = 0
+    seen = set()
+    for filename in filenames:
+        if not is_media_file(filename):
+            continue
+        path = os.path.join(dirpath, filename)
+        try:
+            stat_result = os.stat(path)
+        except OSError:
+            continue
+        seen.add(path)
+        if known.get(path) == stat_result.st_mtime:
+            continue
+        _upsert_media(conn, read_media_record(path, stat_result))
+        written += 1
+    conn.executemany("DELETE FROM media WHERE path = ?", [(p,) for p in known if p not in seen])
+    return written
+
+def scan_library(root):
+    """
+    Walk root and sync every directory into the library index.
+
+    The walk order is deterministic (sorted), and the last completed directory is stored in
+    scan_state after each directory, so an interrupted scan resumes where it stopped instead of
+    starting over. Unchanged files are skipped by mtime, which keeps rescans cheap.
+    """
+    root = os.path.abspath(root)
+    with _library_lock:
+        conn = get_library_db()
+        state = conn.execute("SELECT * FROM scan_state WHERE root = ?", (root,)).fetchone()
+        if state is not None and state['finished_at'] is None:
+            resume_after = state['cursor']
+            files_indexed = state['files_indexed']
+        else:
+            resume_after = None
+            files_indexed = 0
+            with conn:
+                conn.execute("""
+                    INSERT INTO scan_state (root, cursor, files_indexed, started_at, finished_at)
+                    VALUES (?, NULL, 0, ?, NULL)
+                    ON CONFLICT(root) DO UPDATE SET cursor=NULL, files_indexed=0,
+                        started_at=excluded.started_at, finished_at=NULL
+                """, (root, time.time()))
+
+    library_scan_status.update(running=True, root=root, files_indexed=files_indexed, error=None)
+    skipping = resume_after is not None
+    cache_folder = os.path.realpath(app.config['ARTIFACT_CACHE_FOLDER'])
+    try:
+        for dirpath, dirnames, filenames in os.walk(root):
+            # Cache entries are links of files already in the library
+            dirnames[:] = sorted(d for d in dirnames if os.path.realpath(os.path.join(dirpath, d)) != cache_folder)
+            if skipping:
+                if dirpath == resume_after:
+                    skipping = False
+                continue
+            with _library_lock:
+                conn = get_library_db()
+                with conn:
+                    files_indexed += _index_directory(conn, dirpath, filenames)
+                    conn.execute("UPDATE scan_state SET cursor = ?, files_indexed = ? WHERE root = ?",
+                                 (dirpath, files_indexed, root))
+            library_scan_status['files_indexed'] = files_indexed
+
+        if skipping:
+            # The resume cursor no longer exists in the tree; start a fresh pass.
+            with _library_lock:
+                conn = get_library_db()
+                with conn:
+                    conn.execute("UPDATE scan_state SET finished_at = ? WHERE root = ?", (time.time(), root))
+            return scan_library(root)
+
+        with _library_lock:
+            conn = get_library_db()
+            with conn:
+                conn.execute("UPDATE scan_state SET finished_at = ? WHERE root = ?", (time.time(), root))
+    except Exception as e:
+        library_scan_status['error'] = str(e)
+        print(f"Library scan of {root} failed: {e}")
+    finally:
+        library_scan_status['running'] = False
+    return files_indexed
+
+def start_library_scan(root):
+    """Start scan_library in a background thread. Returns False if a scan is already running."""
+    if library_scan_status['running']:
+        return False
+    library_scan_status['running'] = True
+    Thread(target=scan_library, args=(root,), daemon=True).start()
+    return True
+
+def build_fts_query(text):
+    """Turn free text into an FTS5 query: every word must match, as a prefix, in any column."""
+    words = re.findall(r'\w+', text)
+    return ' '.join(f'"{word}"*' for word in words)
+
+def _media_row_to_dict(row):
+    return {column: row[column] for column in MEDIA_COLUMNS}
+
+def resolve_media_path(path):
+    """
+    Find where a downloaded media file ended up after move_media_files_up_and_metadata_down.
+    Files downloaded into <dir>/<title>/ are moved up one level by the organizer.
+    """
+    if os.path.isfile(path):
+        return path
+    parent = os.path.dirname(os.path.dirname(path))
+    moved = os.path.join(parent, os.path.basename(path))
+    if os.path.isfile(moved):
+        return moved
+    return None
+
+# Jobs and Logging
+#
+# Each download is tracked as a job dict in `jobs`. Progress and info events go to a small
+# in-memory ring buffer per job (what /stream_logs replays), while the complete yt-dlp output is
+# appended to gzip-compressed, size-rotated log files under LOG_FOLDER that outlive the job.
+class LogBuffer:
+    """Fixed-size ring buffer of log lines that readers follow by sequence number."""
+
+    def __init__(self, maxlen):
+        self.lines = deque(maxlen=maxlen)
+        self.next_seq = 0
+        self.cond = Condition()
+
+    def append(self, line):
+        with self.cond:
+            self.lines.append((self.next_seq, line))
+            self.next_seq += 1
+            self.cond.notify_all()
+
+    def read_since(self, seq, timeout=None):
+        """
+        Return (lines, next_seq) for every buffered line with sequence number >= seq,
+        waiting up to timeout seconds if there is nothing new yet. Lines that already
+        fell out of the buffer are skipped.
+        """
+        with self.cond:
+            if seq >= self.next_seq:
+                self.cond.wait(timeout)
+            return [line for line_seq, line in self.lines if line_seq >= seq], self.next_seq
+
+
+class JobLogWriter:
+    """Appends a job's full output to gzip-compressed log segments, rotating them by size."""
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.log_dir = app.config['LOG_FOLDER']
+        self.segment = 0
+        self.segment_bytes = 0
+        self.file = None
+        self.lock = Lock()
+
+    def _segment_path(self, segment):
+        return os.path.join(self.log_dir, f"{self.job_id}.{segment:04d}.log.gz")
+
+    def write(self, line):
+        with self.lock:
+            if self.file is None:
+                self._open_segment()
+            self.file.write(line + '\n')
+            self.segment_bytes += len(line) + 1
+            if self.segment_bytes >= LOG_ROTATE_BYTES:
+                self._rotate()
+
+    def _open_segment(self):
+        os.makedirs(self.log_dir, exist_ok=True)
+        self.file = gzip.open(self._segment_path(self.segment), 'at', encoding='utf-8')
+        expired = self.segment - LOG_MAX_SEGMENTS
+        if expired >= 0:
+            try:
+                os.remove(self._segment_path(expired))
+            except OSError:
+                pass
+
+    def _rotate(self):
+        self.file.close()
+        self.file = None
+        self.segment += 1
+        self.segment_bytes = 0
+
+    def flush(self):
+        """Flush buffered output so readers see everything written so far."""
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+log_buffer = LogBuffer(GLOBAL_LOG_BUFFER_LINES)
+
+def job_log_segments(job_id):
+    """Return the job's log segment files, oldest first."""
+    log_dir = app.config['LOG_FOLDER']
+    if not os.path.isdir(log_dir):
+        return []
+    prefix = f"{job_id}."
+    return sorted(os.path.join(log_dir, name) for name in os.listdir(log_dir)
+                  if name.startswith(prefix) and name.endswith('.log.gz'))
+
+def iter_job_log(job_id):
+    """Yield every retained line of a job's log, including output of a still-running job up to its last flush."""
+    for path in job_log_segments(job_id):
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8', errors='replace') as f:
+                for line in f:
+                    yield line.rstrip('\n')
+        except EOFError:
+            # Segment is still being written; everything flushed so far has been read.
+            pass
+
+def prune_job_logs(now=None):
+    """Delete the logs of jobs beyond LOG_RETENTION_JOBS or older than LOG_RETENTION_SECONDS; logs of unfinished jobs are kept."""
+    log_dir = app.config['LOG_FOLDER']
+    if not os.path.isdir(log_dir):
+        return
+    now = time.time() if now is None else now
+    with jobs_lock:
+        active = {job_id for job_id, job in jobs.items() if job['finished_at'] is None}
+    segments = defaultdict(list)
+    for name in os.listdir(log_dir):
+        if name.endswith('.log.gz'):
+            segments[name.split('.', 1)[0]].append(os.path.join(log_dir, name))
+    last_written = {}
+    for job_id, paths in segments.items():
+        try:
+            last_written[job_id] = max(os.path.getmtime(path) for path in paths)
+        except OSError:
+            continue
+    newest_first = sorted(last_written, key=last_written.get, reverse=True)
+    for rank, job_id in enumerate(newest_first):
+        if job_id in active:
+            continue
+        if rank >= LOG_RETENTION_JOBS or now - last_written[job_id] > LOG_RETENTION_SECONDS:
+            for path in segments[job_id]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+def create_job(url, output_dir, command, is_playlist):
+    """Register a new job and return it."""
+    job_id = uuid.uuid4().hex[:12]
+    job = {
+        'id': job_id,
+        'url': url,
+        'domain': url_domain(url),
+        'output_dir': output_dir,
+        'command': command,
+        'base_command': command,
+        'is_playlist': is_playlist,
+        'status': 'queued',
+        'created_at': time.time(),
+        'started_at': None,
+        'finished_at': None,
+        'attempt': 0,
+        'retries': {},
+        'errors': [],
+        'returncode': None,
+        'retry_at': None,
+        'files': [],
+        'timeline': [],
+        'format': None,
+        'format_plan': None,
+        'format_path': None,
+        'segments': None,
+        'stage_dir': None,
+        'processes': [],
+        'deferred_metadata': None,
+        'single_flight_key': None,
+        'requesters': [],
+        'cache_key': None,
+        'cache': None,
+        'log': LogBuffer(LOG_BUFFER_LINES),
+        'log_writer': JobLogWriter(job_id),
+    }
+    with jobs_lock:
+        jobs[job_id] = job
+        finished = [j for j in jobs.values() if j['finished_at'] is not None]
+        expired = sorted(finished, key=lambda j: j['finished_at'])[:max(0, len(finished) - MAX_FINISHED_JOBS)]
+        for old in expired:
+            del jobs[old['id']]
+    if expired:
+        prune_job_logs()
+    return job
+
+def job_summary(job):
+    """JSON-serializable view of a job."""
+    return {key: value for key, value in job.items() if key not in ('log', 'log_writer', 'thread', 'retry_timer')}
+
+def emit_job_event(job, line):
+    """Publish a progress/info event to the job's ring buffer and the global stream."""
+    job['log'].append(line)
+    log_buffer.append(line)
+
+def organize_job_output(job):
+    """Run the metadata organizer over a finished job's output folder(s) (its scratch folder when staged)."""
+    output_dir = job['stage_dir'] or job['output_dir']
+    if job['is_playlist']:
+        # Look for playlist folder (usually one folder in output_dir)
+        playlist_subfolders = [f for f in os.listdir(output_dir) if os.path.isdir(os.path.join(output_dir, f))]
+        for folder in playlist_subfolders:
+            folder_path = os.path.join(output_dir, folder)
+            move_media_files_up_and_metadata_down(folder_path)
+    else:
+        move_media_files_up_and_metadata_down(output_dir)
+
+# Phase Timing
+#
+# Each job attempt is split into phases (extracting, downloading, merging, ...) detected from the
+# "[Component]" prefixes yt-dlp prints when it moves between stages, plus the organize/index/dedup
+# steps run in this process. Every finished phase records wall time, CPU seconds and bytes, both
+# on the job (job['timeline']) and in process-wide totals (phase_totals).
+PHASE_MARKERS = [
+    ('merging', re.compile(r'^\[Merger\]')),
+    ('sponsorblock', re.compile(r'^\[(?:SponsorBlock|ModifyChapters)\]')),
+    ('embedding', re.compile(r'^\[(?:EmbedThumbnail|EmbedSubtitle|Metadata|ThumbnailsConvertor|EmbedInfoJson)\]')),
+    ('converting', re.compile(r'^\[(?:ExtractAudio|VideoConvertor|VideoRemuxer|Fixup\w*)\]')),
+    ('downloading', re.compile(r'^\[download\]\s+(?:Destination:|\d)')),
+    ('writing_metadata', re.compile(r'^\[info\] Writing')),
+    ('extracting', re.compile(r'^\[[\w:]+\]')),
+]
+SIZE_UNITS = {'B': 1, 'KiB': 1024, 'MiB': 1024 ** 2, 'GiB': 1024 ** 3, 'TiB': 1024 ** 4,
+              'KB': 1000, 'MB': 1000 ** 2, 'GB': 1000 ** 3, 'TB': 1000 ** 4}
+
+phase_totals = {}
+phase_totals_lock = Lock()
+
+def detect_phase(line):
+    """Return the phase a yt-dlp output line belongs to, or None if it carries no stage marker."""
+    for phase_name, pattern in PHASE_MARKERS:
+        if pattern.match(line):
+            return phase_name
+    return None
+
+def parse_size(text):
+    """Convert a yt-dlp size such as "12.34MiB" (or a rate like "1.5MiB/s") to bytes; None if unparseable."""
+    match = re.match(r'~?\s*(\d+(?:\.\d+)?)\s*([KMGT]i?B|B)', text.strip())
+    if not match:
+        return None
+    return float(match.group(1)) * SIZE_UNITS[match.group(2)]
+
+def process_cpu_seconds(pid):
+    """
+    CPU seconds used by a child process and the children it has waited for (e.g. ffmpeg), read
+    from /proc. Works for a zombie that has not been reaped yet; returns None where unavailable.
+    """
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return sum(int(value) for value in fields[11:15]) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError, TypeError):
+        return None
+
+def record_phase(job, phase_name, started_at, wall, cpu, nbytes):
+    """Append a finished phase to the job's timeline and the process-wide totals."""
+    job['timeline'].append({
+        'phase': phase_name,
+        'attempt': job['attempt'],
+        'started_at': started_at,
+        'wall_seconds': round(wall, 3),
+        'cpu_seconds': None if cpu is None else round(cpu, 3),
+        'bytes': int(nbytes),
+    })
+    with phase_totals_lock:
+        totals = phase_totals.setdefault(phase_name, {'count': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'bytes': 0})
+        totals['count'] += 1
+        totals['wall_seconds'] += wall
+        totals['cpu_seconds'] += cpu or 0.0
+        totals['bytes'] += int(nbytes)
+
+class PhaseTimer:
+    """Follows the current phase of an external process, closing each phase when the next begins."""
+
+    def __init__(self, job, cpu_clock):
+        self.job = job
+        self.cpu_clock = cpu_clock
+        self.phase = None
+
+    def enter(self, phase_name):
+        if phase_name == self.phase:
+            return
+        self.close()
+        self.phase = phase_name
+        self.started_at = time.time()
+        self.start_clock = time.monotonic()
+        self.start_cpu = self.cpu_clock()
+        self.bytes = 0
+
+    def add_bytes(self, nbytes):
+        self.bytes += max(0, nbytes)
+
+    def close(self):
+        if self.phase is None:
+            return
+        end_cpu = self.cpu_clock()
+        cpu = None if end_cpu is None or self.start_cpu is None else end_cpu - self.start_cpu
+        record_phase(self.job, self.phase, self.started_at, time.monotonic() - self.start_clock, cpu, self.bytes)
+        self.phase = None
+
+@contextmanager
+def timed_phase(job, phase_name):
+    """Time an in-process phase (CPU time is this thread's). Add transferred bytes to the yielded counters."""
+    started_at = time.time()
+    start_clock = time.monotonic()
+    start_cpu = time.thread_time()
+    counters = {'bytes': 0}
+    try:
+        yield counters
+    finally:
+        record_phase(job, phase_name, started_at, time.monotonic() - start_clock,
+                     time.thread_time() - start_cpu, counters['bytes'])
+
+# Failure Classification and Retries
+#
+# yt-dlp reports failures as "ERROR: ..." lines. Each one is mapped to an error class, and the
+# class decides the retry policy. Retries are re-queued through the scheduler after a backoff
+# delay, so a waiting job never occupies a download slot.
+ERROR_CLASSES = [
+    ('throttled', re.compile(r'HTTP Error 429|Too Many Requests|rate[- ]?limit', re.I)),
+    ('forbidden', re.compile(r'HTTP Error 403|Forbidden', re.I)),
+    ('geo_blocked', re.compile(r'available in your country|geo[- ]?restrict|blocked it in your country', re.I)),
+    ('unavailable', re.compile(r'unavailable|Private video|has been removed|does not exist|'
+                               r'account .*terminated|members[- ]only|confirm your age', re.I)),
+    ('disk_full', re.compile(r'No space left on device|Errno 28', re.I)),
+    ('ffmpeg', re.compile(r'ffmpeg|ffprobe|Postprocessing|Conversion failed', re.I)),
+    ('network', re.compile(r'timed out|Connection (?:reset|refused|aborted)|name resolution|'
+                           r'Unable to download|IncompleteRead|HTTP Error 5\d\d', re.I)),
+]
+
+# max_retries is per error class; delays are in seconds.
+RETRY_POLICIES = {
+    'throttled': {'max_retries': 5, 'base_delay': 30, 'max_delay': 900},
+    'forbidden': {'max_retries': 3, 'base_delay': 2, 'max_delay': 60, 'reextract': True},
+    'network': {'max_retries': 4, 'base_delay': 5, 'max_delay': 300},
+    'ffmpeg': {'max_retries': 1, 'base_delay': 5, 'max_delay': 5},
+    'disk_full': {'max_retries': 1, 'base_delay': 5, 'max_delay': 5},
+    'stalled': {'max_retries': 2, 'base_delay': 30, 'max_delay': 300},
+    'geo_blocked': {'max_retries': 0},
+    'unavailable': {'max_retries': 0},
+    'unknown': {'max_retries': 0},
+}
+
+def classify_error(message):
+    """Map a yt-dlp error message to an error class name (a key of RETRY_POLICIES)."""
+    for error_class, pattern in ERROR_CLASSES:
+        if pattern.search(message):
+            return error_class
+    return 'unknown'
+
+def backoff_delay(policy, retry_number):
+    """Exponential backoff with jitter: half the capped delay is fixed, the other half random."""
+    delay = min(policy['max_delay'], policy['base_delay'] * (2 ** retry_number))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+def set_playlist_items(command, indices):
+    """Return a copy of command limited to the given playlist entries (the URL stays last)."""
+    stripped = []
+    skip_next = False
+    for item in command[:-1]:
+        if skip_next:
+            skip_next = False
+            continue
+        if item in ('--playlist-items', '-I'):
+            skip_next = True
+            continue
+        stripped.append(item)
+    return stripped + ['--playlist-items', ','.join(str(i) for i in sorted(indices)), command[-1]]
+
+def playlist_items(command):
+    """
+    The playlist indices a command's --playlist-items selects, in order, or None when it selects
+    everything or uses a form other than numbers and ranges.
+    """
+    for flag, value in zip(command, command[1:]):
+        if flag not in ('--playlist-items', '-I'):
+            continue
+        indices = []
+        for item in value.split(','):
+            bounds = re.fullmatch(r'(\d+)(?:[-:](\d+))?', item.strip())
+            if not bounds:
+                return None
+            start = int(bounds.group(1))
+            indices += range(start, int(bounds.group(2) or start) + 1)
+        return indices
+    return None
+
+def plan_retry(job):
+    """
+    Decide whether a failed attempt should be retried.
+    Returns (delay_seconds, error_class, command) or None when the failure is final.
+
+    For playlists, only entries that failed with a retryable error are retried. For single
+    videos, any non-retryable error (e.g. "unavailable") makes the failure final.
+    """
+    errors = job['errors'] or [{'class': 'unknown', 'message': f"exit code {job['returncode']}", 'playlist_index': None}]
+    retryable = [e for e in errors if RETRY_POLICIES[e['class']]['max_retries'] > 0]
+    if not retryable:
+        return None
+    entry_indices = {e['playlist_index'] for e in retryable if e['playlist_index'] is not None}
+    whole_job = any(e['playlist_index'] is None for e in retryable)
+    if not job['is_playlist'] and len(retryable) != len(errors):
+        return None
+
+    # The slowest policy among the failures decides the delay
+    error_class = max((e['class'] for e in retryable), key=lambda c: RETRY_POLICIES[c]['base_delay'])
+    policy = RETRY_POLICIES[error_class]
+    retry_number = job['retries'].get(error_class, 0)
+    if retry_number >= policy['max_retries']:
+        return None
+
+    command = list(job['base_command'])
+    if job['is_playlist'] and entry_indices and not whole_job:
+        command = set_playlist_items(command, entry_indices)
+    if any(RETRY_POLICIES[e['class']].get('reextract') for e in retryable):
+        # Stale cached player data is a common cause of 403s on stream URLs
+        command = command[:-1] + ['--no-cache-dir', command[-1]]
+    return backoff_delay(policy, retry_number), error_class, command
+
+def finish_job(job, status):
+    leave_single_flight(job)
+    release_scratch(job)
+    job['status'] = status
+    job['finished_at'] = time.time()
+    job['retry_at'] = None
+    if status == 'finished' and job['cache']:
+        record_job_latency(job)
+    emit_job_event(job, '[DONE]')
+
+def start_job_process(job):
+    """
+    Begin a new attempt of a job: reset per-attempt state and launch yt-dlp.
+    Returns the process, or None if it could not be started (the reason is in job['launch_error']).
+    """
+    job['status'] = 'running'
+    job['started_at'] = job['started_at'] or time.time()
+    job['attempt'] += 1
+    job['errors'] = []
+    job['returncode'] = None
+    job['launch_error'] = None
+    try:
+        return spawn_supervised(job['command'], 'playlist' if job['is_playlist'] else 'download',
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    except OSError as e:
+        job['launch_error'] = str(e)
+        return None
+
+def run_download_job(job, process):
+    """
+    Follow one attempt of a job started by start_job_process: stream yt-dlp output, organize and
+    index the results, then either finish the job or hand it back to the scheduler for a retry.
+    The download slot is released as soon as yt-dlp exits, before post-processing.
+    """
+    last_percent = -1
+    playlist_index = None
+    destinations = []
+    # "Downloading item N of M" counts within the selection, so map N back to the playlist index
+    selected_items = playlist_items(job['command'][:-1])
+    log_writer = job['log_writer']
+    if process is None:
+        log_writer.write(f"Failed to start yt-dlp: {job['launch_error']}")
+        log_writer.close()
+        emit_job_event(job, f"INFO::Failed to start yt-dlp: {job['launch_error']}")
+        finish_job(job, 'failed')
+        return
+
+    phases = PhaseTimer(job, lambda: process_cpu_seconds(process.pid))
+    phases.enter('extracting')
+    file_bytes_done = 0
+    source_ext = None
+    peak_speed = 0
+    supervision = supervised_processes.get(process.pid)
+    for line in process.stdout:
+        supervision['last_output'] = time.monotonic()
+        line = line.rstrip('\n')
+        print(line.strip())
+        log_writer.write(line)
+        phase_name = detect_phase(line)
+        if phase_name:
+            phases.enter(phase_name)
+            supervision['postprocessing'] = phase_name in POSTPROCESSING_PHASES
+        observe_format_path(job, line, source_ext)
+        destination = parse_destination(line)
+        if destination:
+            destinations.append(destination)
+            file_bytes_done = 0
+            peak_speed = 0
+            if line.startswith('[download]'):
+                source_ext = os.path.splitext(destination)[1].lstrip('.').lower()
+        entry = re.search(r'\[download\] Downloading (?:item|video) (\d+) of (\d+)', line)
+        if entry:
+            playlist_index = int(entry.group(1))
+            if selected_items and playlist_index <= len(selected_items):
+                playlist_index = selected_items[playlist_index - 1]
+        if line.startswith('ERROR:'):
+            job['errors'].append({
+                'class': classify_error(line),
+                'message': line[len('ERROR:'):].strip(),
+                'playlist_index': playlist_index,
+            })
+            if job['errors'][-1]['class'] == 'throttled':
+                record_throttling(job, job['errors'][-1]['message'])
+        size_match = re.search(r'\[download\]\s+(\d+(?:\.\d+)?)% of\s+(~?\s*[\d.]+\s*\w+)', line)
+        total_bytes = parse_size(size_match.group(2)) if size_match else None
+        if total_bytes:
+            done = total_bytes * float(size_match.group(1)) / 100
+            phases.add_bytes(done - file_bytes_done)
+            record_download_bytes(job, done - file_bytes_done)
+            file_bytes_done = max(file_bytes_done, done)
+        match = re.search(r"\[download\]\s+(\d+(?:\.\d+)?)%.*?at\s+([^\s]+).*?ETA\s+([^\s]+)", line)
+        if match:
+            percent = float(match.group(1))
+            speed = match.group(2)
+            eta = match.group(3)
+            rate = parse_size(speed)
+            if rate and rate < peak_speed * SPEED_COLLAPSE_RATIO:
+                record_throttling(job, f"speed fell from {format_size(peak_speed)}/s to {speed}")
+                peak_speed = rate
+            peak_speed = max(peak_speed, rate or 0)
+            if int(percent) != last_percent:
+                emit_job_event(job, f"PROGRESS::{percent}::{speed}::{eta}")
+                last_percent = int(percent)
+        else:
+            if "[ffmpeg]" in line or "Destination" in line or "[info]" in line or line.startswith('ERROR:'):
+                emit_job_event(job, f"INFO::{line.strip()}")
+    phases.close()  # read CPU time before the process is reaped
+    job['returncode'] = reap_process(process, job)
+    log_writer.close()
+    release_download_slot(job)
+    finalize_attempt(job, destinations)
+
+def finalize_attempt(job, destinations):
+    """
+    Post-process a finished attempt (organize, place staged files, index, queue deduplication),
+    then finish the job or schedule a retry based on job['returncode'] and job['errors'].
+    """
+    with timed_phase(job, 'organizing'):
+        try:
+            organize_job_output(job)
+        except Exception as e:
+            print(f"Error organizing metadata files: {e}")
+    # Paths recorded before organizing (e.g. a segmented job's merge target) may have moved too
+    job['files'] = sorted({p for p in map(resolve_media_path, set(job['files']) | set(destinations)) if p})
+
+    succeeded = job['returncode'] == 0 and not job['errors']
+    if job['stage_dir'] and any(e['class'] == 'disk_full' for e in job['errors']):
+        # Scratch space ran out: keep what finished and retry writing straight to output_dir
+        with timed_phase(job, 'placing') as counters:
+            counters['bytes'] = place_staged_output(job)
+        unstage_job(job)
+    retry = None if succeeded else plan_retry(job)
+    if job['stage_dir'] and retry is None:
+        with timed_phase(job, 'placing') as counters:
+            counters['bytes'] = place_staged_output(job)
+    if retry is None:
+        leave_single_flight(job)
+        if job['requesters']:
+            with timed_phase(job, 'sharing') as counters:
+                try:
+                    counters['bytes'] = share_job_output(job)
+                except OSError as e:
+                    print(f"Error placing files for attached requests: {e}")
+
+    # Files of a staged job waiting for a retry are still in scratch; they're indexed once placed
+    if not (job['stage_dir'] and retry is not None):
+        with timed_phase(job, 'indexing'):
+            try:
+                index_media_files(job['files'] + requester_files(job))
+            except Exception as e:
+                print(f"Error indexing downloaded files: {e}")
+        if DEDUP_ENABLED and job['files']:
+            queue_dedup(job)
+
+    if succeeded:
+        queue_deferred_metadata(job)
+        if not job['deferred_metadata']:
+            cache_job_output(job)  # with deferred sidecars the entry is stored once they are in
+        finish_job(job, 'finished')
+        return
+    if retry is None:
+        if job['is_playlist'] and job['files']:
+            queue_deferred_metadata(job)
+            finish_job(job, 'partial')
+        else:
+            finish_job(job, 'failed')
+        return
+    delay, error_class, command = retry
+    job['retries'][error_class] = job['retries'].get(error_class, 0) + 1
+    job['command'] = command
+    job['status'] = 'retry_scheduled'
+    job['retry_at'] = time.time() + delay
+    emit_job_event(job, f"INFO::Attempt {job['attempt']} failed ({error_class}), retrying in {delay:.0f}s")
+    job['retry_timer'] = Timer(delay, schedule_job, args=(job,))
+    job['retry_timer'].daemon = True
+    job['retry_timer'].start()
+
+# Scratch Staging
+#
+# When SCRATCH_FOLDER points at fast local storage, each job gets its own folder there for all
+# of yt-dlp's output: fragments, .part files, ffmpeg intermediates and the organizer's moves
+# stay off slow network storage. Finished results are moved to output_dir by a small I/O pool.
+# A job only gets a scratch folder if SCRATCH_JOB_RESERVE_BYTES fits within SCRATCH_MAX_BYTES
+# and the free space on the device; otherwise it writes to output_dir directly.
+TEMPORARY_SUFFIXES = ('.part', '.ytdl', '.temp')
+
+scratch_reservations = {}
+scratch_lock = Lock()
+staging_pool = ThreadPoolExecutor(max_workers=SCRATCH_MOVE_WORKERS, thread_name_prefix='staging')
+
+def reserve_scratch_space():
+    """Create a scratch folder for a new job, or return None to write directly to the destination."""
+    scratch = app.config['SCRATCH_FOLDER']
+    if not scratch:
+        return None
+    with scratch_lock:
+        try:
+            os.makedirs(scratch, exist_ok=True)
+            free = shutil.disk_usage(scratch).free
+        except OSError as e:
+            print(f"Scratch folder {scratch} unusable: {e}")
+            return None
+        reserved = sum(scratch_reservations.values())
+        if reserved + SCRATCH_JOB_RESERVE_BYTES > SCRATCH_MAX_BYTES or free < SCRATCH_JOB_RESERVE_BYTES:
+            return None
+        stage_dir = os.path.join(scratch, uuid.uuid4().hex[:12])
+        os.makedirs(stage_dir)
+        scratch_reservations[stage_dir] = SCRATCH_JOB_RESERVE_BYTES
+    return stage_dir
+
+def move_tree(source_dir, target_dir):
+    """
+    Move every finished file from source_dir into the same relative place under target_dir
+    (copying across devices). Existing targets are kept, as yt-dlp would not overwrite them.
+    Returns (bytes_moved, {old_path: new_path}).
+    """
+    moved_bytes = 0
+    moved = {}
+    for dirpath, dirnames, filenames in os.walk(source_dir):
+        for filename in filenames:
+            source = os.path.join(dirpath, filename)
+            if filename.endswith(TEMPORARY_SUFFIXES) or '.part-Frag' in filename:
+                continue
+            target = os.path.join(target_dir, os.path.relpath(source, source_dir))
+            if os.path.exists(target):
+                print(f"Target file already exists, keeping it: {target}")
+                moved[source] = target
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            size = os.path.getsize(source)
+            shutil.move(source, target)
+            moved_bytes += size
+            moved[source] = target
+    return moved_bytes, moved
+
+def place_staged_output(job):
+    """Move a staged job's results to output_dir, remap job['files'] and empty its scratch folder."""
+    stage_dir = job['stage_dir']
+    try:
+        moved_bytes, moved = staging_pool.submit(move_tree, stage_dir, job['output_dir']).result()
+    except OSError as e:
+        print(f"Error moving staged files for job {job['id']}: {e}")
+        return 0
+    job['files'] = sorted(moved.get(path, path) for path in job['files'])
+    shutil.rmtree(stage_dir, ignore_errors=True)
+    os.makedirs(stage_dir, exist_ok=True)  # a retry may still resume into it
+    return moved_bytes
+
+def release_scratch(job):
+    """Delete a job's scratch folder and return its reservation."""
+    stage_dir = job['stage_dir']
+    if stage_dir is None:
+        return
+    shutil.rmtree(stage_dir, ignore_errors=True)
+    with scratch_lock:
+        scratch_reservations.pop(stage_dir, None)
+
+def unstage_job(job):
+    """Point a staged job's commands at output_dir and give up its scratch folder."""
+    stage_dir = job['stage_dir']
+    job['base_command'] = [arg.replace(stage_dir, job['output_dir']) for arg in job['base_command']]
+    job['command'] = [arg.replace(stage_dir, job['output_dir']) for arg in job['command']]
+    release_scratch(job)
+    job['stage_dir'] = None
+
+# Segmented Downloads
+#
+# yt-dlp fetches a progressive (single-file HTTP) stream over one connection. For long videos a
+# job can instead be split into byte ranges fetched in parallel: the formats are resolved with
+# "yt-dlp -J", each range is written in place into a preallocated file (so joining the pieces
+# needs no copying and is lossless by construction), failed ranges are retried on their own from
+# where they stopped, and separate video/audio streams are merged with a stream-copy ffmpeg pass.
+# Fragmented formats (HLS/DASH) fall back to yt-dlp's own --concurrent-fragments.
+COOKIE_ATTRIBUTES = {'domain', 'path', 'expires', 'max-age', 'secure', 'httponly', 'samesite'}
+
+def split_ranges(size, count):
+    """Split size bytes into count contiguous inclusive (start, end) ranges."""
+    count = max(1, min(count, size))
+    step = size // count
+    bounds = [i * step for i in range(count)] + [size]
+    return [(bounds[i], bounds[i + 1] - 1) for i in range(count)]
+
+def format_size(nbytes):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if nbytes < 1024 or unit == 'GiB':
+            return f"{nbytes:.2f}{unit}"
+        nbytes /= 1024
+
+def probe_media(job):
+    """Resolve the job's selected formats with yt-dlp -J (nothing is downloaded)."""
+    command = job['base_command'][:-1] + ['-J', '--no-playlist', job['base_command'][-1]]
+    result = run_supervised(command, 'probe', job=job, timeout=PROBE_TIMEOUT)
+    if result.returncode != 0:
+        errors = [line for line in result.stderr.splitlines() if line.startswith('ERROR:')]
+        raise RuntimeError(errors[-1] if errors else f"ERROR: format probe exited with {result.returncode}")
+    return json.loads(result.stdout)
+
+def plan_segments(info, segments):
+    """
+    Describe the byte ranges to fetch for each selected format, or return None when a format
+    cannot be fetched by range (fragmented protocol or unknown exact size).
+    """
+    parts = []
+    for fmt in info.get('requested_formats') or [info]:
+        if fmt.get('protocol') not in ('http', 'https') or not fmt.get('url') or not fmt.get('filesize'):
+            return None
+        headers = dict(info.get('http_headers') or {}, **(fmt.get('http_headers') or {}))
+        if fmt.get('cookies'):
+            pairs = [item.strip() for item in fmt['cookies'].split(';')]
+            headers['Cookie'] = '; '.join(p for p in pairs if '=' in p and p.split('=', 1)[0].lower() not in COOKIE_ATTRIBUTES)
+        size = fmt['filesize']
+        parts.append({
+            'format_id': fmt.get('format_id', 'media'),
+            'ext': fmt.get('ext', 'bin'),
+            'url': fmt['url'],
+            'headers': headers,
+            'size': size,
+            'ranges': split_ranges(size, segments if size >= SEGMENTED_MIN_BYTES else 1),
+        })
+    return parts
+
+def fetch_range(url, headers, path, state, end, on_bytes):
+    """Fetch bytes state['position']..end into path at the same offsets, advancing state['position']."""
+    request_headers = dict(headers, Range=f"bytes={state['position']}-{end}")
+    with urllib.request.urlopen(urllib.request.Request(url, headers=request_headers), timeout=SEGMENT_TIMEOUT) as response:
+        if response.status != 206:
+            raise OSError(f"server ignored the Range request (HTTP {response.status})")
+        fd = os.open(path, os.O_WRONLY)
+        try:
+            while state['position'] <= end:
+                chunk = response.read(min(SEGMENT_CHUNK_SIZE, end + 1 - state['position']))
+                if not chunk:
+                    raise OSError(f"connection closed at byte {state['position']} of range ending {end}")
+                os.pwrite(fd, chunk, state['position'])
+                state['position'] += len(chunk)
+                on_bytes(len(chunk))
+        finally:
+            os.close(fd)
+
+def fetch_range_with_retries(job, part, path, start, end, on_bytes):
+    """Fetch one range, resuming it from the last written byte after transient failures."""
+    state = {'position': start}
+    for attempt in range(SEGMENT_RETRIES + 1):
+        try:
+            fetch_range(part['url'], part['headers'], path, state, end, on_bytes)
+            return
+        except urllib.error.HTTPError as e:
+            if e.code in (403, 404, 410) or attempt == SEGMENT_RETRIES:
+                # Expired or missing stream URLs need a fresh extraction, which is a job-level retry
+                raise RuntimeError(f"ERROR: segment {start}-{end} of format {part['format_id']}: HTTP Error {e.code}: {e.reason}")
+        except (OSError, http.client.HTTPException) as e:
+            if attempt == SEGMENT_RETRIES:
+                raise RuntimeError(f"ERROR: segment {start}-{end} of format {part['format_id']}: {e}")
+        job['log_writer'].write(f"[segmented] retrying range {state['position']}-{end} of format {part['format_id']}")
+        time.sleep(backoff_delay({'base_delay': 1, 'max_delay': 30}, attempt))
+
+def download_segments(job, parts, target_stem):
+    """Fetch every range of every part in parallel. Returns the completed part files in order."""
+    total = sum(part['size'] for part in parts)
+    progress = {'done': 0, 'last_percent': -1, 'started': time.monotonic()}
+    progress_lock = Lock()
+
+    def on_bytes(nbytes):
+        record_download_bytes(job, nbytes)
+        with progress_lock:
+            progress['done'] += nbytes
+            percent = int(progress['done'] * 100 / total)
+            if percent == progress['last_percent']:
+                return
+            progress['last_percent'] = percent
+            elapsed = max(time.monotonic() - progress['started'], 1e-6)
+            rate = progress['done'] / elapsed
+            eta = int((total - progress['done']) / rate) if rate else 0
+        emit_job_event(job, f"PROGRESS::{float(percent)}::{format_size(rate)}/s::{eta // 60:02d}:{eta % 60:02d}")
+
+    paths = []
+    for part in parts:
+        path = f"{target_stem}.f{part['format_id']}.{part['ext']}.part"
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'wb') as f:
+            f.truncate(part['size'])
+        paths.append(path)
+        job['log_writer'].write(f"[segmented] Destination: {path} ({len(part['ranges'])} segments)")
+
+    workers = max(len(part['ranges']) for part in parts)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(fetch_range_with_retries, job, part, path, start, end, on_bytes)
+                   for part, path in zip(parts, paths) for start, end in part['ranges']]
+        try:
+            for future in as_completed(futures):
+                future.result()
+        except Exception:
+            for future in futures:
+                future.cancel()
+            raise
+
+    finished = []
+    for path in paths:
+        os.replace(path, path[:-len('.part')])
+        finished.append(path[:-len('.part')])
+    return finished
+
+def merge_parts(part_paths, target_path, job=None):
+    """Combine downloaded parts into target_path without re-encoding."""
+    if len(part_paths) == 1:
+        os.replace(part_paths[0], target_path)
+        return
+    command = ['ffmpeg', '-y', '-loglevel', 'error']
+    for path in part_paths:
+        command += ['-i', path]
+    command += ['-map', '0:v:0', '-map', '1:a:0', '-c', 'copy', target_path]
+    result = run_supervised(command, 'merge', job=job)
+    if result.returncode != 0:
+        raise RuntimeError(f"ERROR: Postprocessing: ffmpeg merge failed: {result.stderr.strip()[-300:]}")
+    for path in part_paths:
+        os.remove(path)
+
+def run_segmented_job(job):
+    """
+    Run one attempt of a segmented job. Falls back to a normal yt-dlp run with
+    --concurrent-fragments when the selected formats cannot be fetched by byte range.
+    """
+    url = job['base_command'][-1]
+    job['status'] = 'running'
+    job['started_at'] = job['started_at'] or time.time()
+    job['errors'] = []
+    job['returncode'] = None
+    try:
+        with timed_phase(job, 'extracting'):
+            info = probe_media(job)
+        parts = plan_segments(info, job['segments'])
+    except (RuntimeError, OSError, ValueError, subprocess.TimeoutExpired) as e:
+        parts, info = None, None
+        probe_error = str(e)
+    else:
+        probe_error = None
+
+    if parts is None:
+        reason = probe_error or 'formats are fragmented or have no known size'
+        job['log_writer'].write(f"[segmented] falling back to yt-dlp concurrent fragments: {reason}")
+        emit_job_event(job, f"INFO::Segmented download unavailable ({reason}); using concurrent fragments")
+        job['command'] = job['command'][:-1] + ['--concurrent-fragments', str(job['segments']), url]
+        run_download_job(job, start_job_process(job))
+        return
+
+    job['attempt'] += 1
+    target_path = info.get('filename') or info.get('_filename')
+    emit_job_event(job, f"INFO::[segmented] Destination: {target_path}")
+    try:
+        with timed_phase(job, 'downloading') as counters:
+            part_paths = download_segments(job, parts, os.path.splitext(target_path)[0])
+            counters['bytes'] = sum(part['size'] for part in parts)
+        with timed_phase(job, 'merging'):
+            merge_parts(part_paths, target_path, job)
+        job['returncode'] = 0
+    except (RuntimeError, OSError) as e:
+        message = str(e)
+        job['log_writer'].write(message)
+        emit_job_event(job, f"INFO::{message}")
+        job['errors'].append({'class': classify_error(message), 'message': message, 'playlist_index': None})
+        job['returncode'] = 1
+    job['log_writer'].close()
+    release_download_slot(job)
+
+    flags = job['base_command'][:-1]
+    postprocessing = any(flag.startswith(POSTPROCESSING_FLAGS) for flag in flags)
+    if job['returncode'] == 0 and (postprocessing or any(flag.startswith('--write-') for flag in flags)):
+        # Media is in place. yt-dlp finds it already downloaded and only writes the sidecar files
+        # and runs its post-processors (SponsorBlock, embedding, remux/recode) on it;
+        # --skip-download would skip the post-processors, so it's only used for sidecars.
+        job['files'] = sorted(set(job['files']) | {target_path})
+        job['command'] = flags + ([] if postprocessing else ['--skip-download']) + [url]
+        run_download_job(job, start_job_process(job))
+        return
+    finalize_attempt(job, [target_path] if job['returncode'] == 0 else [])
+
+# Process Supervision
+#
+# Every child process (yt-dlp, ffmpeg merges, format probes) is started through spawn_supervised:
+# it runs in its own process group with the nice level, best-effort I/O priority and rlimits of
+# its class (PROCESS_LIMITS), applied to the running process so later children such as ffmpeg
+# inherit them. reap_process collects the exit status and rusage with wait4 as soon as the
+# process exits and records them on the job. A watchdog stops process groups that print nothing
+# for STALL_TIMEOUT_SECONDS (SIGTERM, then SIGKILL after KILL_GRACE_SECONDS); while yt-dlp is in a
+# post-processing phase, POSTPROCESSING_STALL_TIMEOUT_SECONDS applies instead.
+IOPRIO_CLASS_BE = 2
+PROCESS_RLIMITS = {
+    # RLIMIT_DATA rather than RLIMIT_AS: it counts heap and private writable mappings, not reserved
+    # address space, so runtimes that reserve large ranges up front (V8-based JS runtimes yt-dlp may
+    # spawn) aren't killed by a cap their real memory use never reaches. Children inherit it.
+    'max_memory_bytes': getattr(resource, 'RLIMIT_DATA', None),
+    'max_open_files': getattr(resource, 'RLIMIT_NOFILE', None),
+    'max_cpu_seconds': getattr(resource, 'RLIMIT_CPU', None),
+}
+
+supervised_processes = {}  # pid -> supervision entry, until the process is reaped
+_watchdog = None
+_watchdog_lock = Lock()
+
+def apply_process_limits(pid, limits):
+    """Set nice level, I/O priority and rlimits on a running process (Linux; best effort)."""
+    try:
+        os.setpriority(os.PRIO_PROCESS, pid, limits['nice'])
+    except (AttributeError, OSError):
+        pass
+    syscall_number = IOPRIO_SET_SYSCALLS.get(platform.machine())
+    if syscall_number is not None:
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            libc.syscall(syscall_number, IOPRIO_WHO_PROCESS, pid,
+                         (IOPRIO_CLASS_BE << IOPRIO_CLASS_SHIFT) | limits['ionice_level'])
+        except (OSError, AttributeError):
+            pass
+    for key, rlimit in PROCESS_RLIMITS.items():
+        if limits.get(key) is None or rlimit is None:
+            continue
+        try:
+            resource.prlimit(pid, rlimit, (limits[key], limits[key]))
+        except (AttributeError, OSError, ValueError) as e:
+            print(f"Could not set {key} on process {pid}: {e}")
+
+def spawn_supervised(command, job_class, **popen_kwargs):
+    """Start a child process in its own process group with the limits of job_class and watch it."""
+    process = subprocess.Popen(command, start_new_session=True, **popen_kwargs)
+    pid = process.pid if isinstance(process.pid, int) else None
+    if pid is not None:
+        apply_process_limits(pid, PROCESS_LIMITS[job_class])
+    supervised_processes[process.pid] = {
+        'pid': pid,
+        'job_class': job_class,
+        'started': time.monotonic(),
+        'last_output': time.monotonic(),
+        'postprocessing': False,
+        'stalled': False,
+        'reaped': False,
+        'lock': Lock(),
+    }
+    start_watchdog()
+    return process
+
+def reap_process(process, job=None):
+    """
+    Wait for a supervised process to exit and reap it. Records exit code, CPU seconds, peak RSS
+    and wall time in job['processes'], and adds a 'stalled' error if the watchdog stopped it.
+    Returns the exit code.
+    """
+    entry = supervised_processes.get(process.pid)
+    usage = None
+    if entry is None or entry['pid'] is None:
+        returncode = process.wait()
+    else:
+        try:
+            # Wait without reaping first, so the watchdog never signals a recycled pid
+            os.waitid(os.P_PID, entry['pid'], os.WEXITED | os.WNOWAIT)
+            with entry['lock']:
+                _, status, usage = os.wait4(entry['pid'], 0)
+                entry['reaped'] = True
+            process.returncode = returncode = os.waitstatus_to_exitcode(status)
+        except (AttributeError, ChildProcessError):
+            returncode = process.wait()
+    supervised_processes.pop(process.pid, None)
+    if job is None or entry is None:
+        return returncode
+
+    record = {
+        'attempt': job['attempt'],
+        'job_class': entry['job_class'],
+        'pid': entry['pid'],
+        'returncode': returncode,
+        'wall_seconds': round(time.monotonic() - entry['started'], 3),
+        'cpu_seconds': round(usage.ru_utime + usage.ru_stime, 3) if usage else None,
+        'max_rss_bytes': usage.ru_maxrss * 1024 if usage else None,  # ru_maxrss is in KiB on Linux
+        'stalled': entry['stalled'],
+    }
+    job['processes'].append(record)
+    if entry['stalled']:
+        job['errors'].append({
+            'class': 'stalled',
+            'message': f"No output for {STALL_TIMEOUT_SECONDS}s, process stopped",
+            'playlist_index': None,
+        })
+    return returncode
+
+def run_supervised(command, job_class, job=None, timeout=None):
+    """subprocess.run() for a supervised process: capture output, stop the group on timeout."""
+    process = spawn_supervised(command, job_class, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    try:
+        stdout, stderr = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        signal_process_group(supervised_processes.get(process.pid), signal.SIGKILL)
+        process.communicate()
+        reap_process(process, job)
+        raise
+    return subprocess.CompletedProcess(command, reap_process(process, job), stdout, stderr)
+
+def signal_process_group(entry, signum):
+    """Signal a supervised process and its children, unless it has already been reaped."""
+    if entry is None or entry['pid'] is None:
+        return
+    with entry['lock']:
+        if entry['reaped']:
+            return
+        try:
+            os.killpg(entry['pid'], signum)
+        except ProcessLookupError:
+            pass
+
+def start_watchdog():
+    global _watchdog
+    with _watchdog_lock:
+        if _watchdog is None:
+            _watchdog = Thread(target=_run_watchdog, daemon=True)
+            _watchdog.start()
+
+def stop_stalled_processes():
+    """Terminate downloads that have printed nothing for too long; kill those that ignore it."""
+    now = time.monotonic()
+    for entry in list(supervised_processes.values()):
+        if entry['job_class'] not in ('download', 'playlist', 'metadata'):
+            continue  # probes and merges are bounded by timeouts and CPU limits instead
+        timeout = POSTPROCESSING_STALL_TIMEOUT_SECONDS if entry['postprocessing'] else STALL_TIMEOUT_SECONDS
+        if not entry['stalled'] and timeout is not None and now - entry['last_output'] > timeout:
+            print(f"Process {entry['pid']} printed nothing for {timeout}s, stopping it")
+            entry['stalled'] = True
+            entry['stopped_at'] = now
+            signal_process_group(entry, signal.SIGTERM)
+        elif entry['stalled'] and now - entry['stopped_at'] > KILL_GRACE_SECONDS:
+            signal_process_group(entry, signal.SIGKILL)
+
+def _run_watchdog():
+    while True:
+        time.sleep(STALL_CHECK_SECONDS)
+        stop_stalled_processes()
+
+# Scheduler
+#
+# Jobs wait in pending_jobs until a download slot is free. How many slots there are is decided by
+# the concurrency controllers below, overall and per domain (MAX_CONCURRENT_DOWNLOADS when adaptive
+# concurrency is off); a job whose domain is at its limit lets jobs for other domains go first.
+# Dispatching a job launches its yt-dlp process; a thread per job then follows the output and
+# releases the slot when yt-dlp exits, dispatching the next job.
+MAX_CONCURRENT_DOWNLOADS = 3
+pending_jobs = deque()
+running_job_ids = set()
+running_by_domain = Counter()
+scheduler_lock = Lock()
+
+def schedule_job(job):
+    """Queue a job (new or retried) and start it as soon as a slot is free."""
+    with scheduler_lock:
+        job['status'] = 'queued'
+        job['retry_at'] = None
+        pending_jobs.append(job)
+    start_concurrency_controller()
+    dispatch_jobs()
+
+def _next_dispatchable_job():
+    """The first queued job the concurrency limits allow to start, or None (call with scheduler_lock held)."""
+    for job in pending_jobs:
+        total_slots, domain_slots = download_slots(job['domain'])
+        if len(running_job_ids) >= total_slots:
+            return None
+        if domain_slots is None or running_by_domain[job['domain']] < domain_slots:
+            return job
+    return None
+
+def dispatch_jobs():
+    """Launch queued jobs while download slots are available."""
+    while True:
+        with scheduler_lock:
+            job = _next_dispatchable_job()
+            if job is None:
+                return
+            pending_jobs.remove(job)
+            running_job_ids.add(job['id'])
+            running_by_domain[job['domain']] += 1
+            note_running(job['domain'], len(running_job_ids), running_by_domain[job['domain']])
+        # Segmented jobs probe formats before deciding what to launch, so they start in their thread
+        process = None if job['segments'] else start_job_process(job)
+        job['thread'] = Thread(target=_run_scheduled_job, args=(job, process), daemon=True)
+        job['thread'].start()
+
+def release_download_slot(job):
+    """Free the job's download slot (idempotent) and launch the next queued job."""
+    with scheduler_lock:
+        if job['id'] not in running_job_ids:
+            return
+        running_job_ids.discard(job['id'])
+        running_by_domain[job['domain']] -= 1
+        if not running_by_domain[job['domain']]:
+            del running_by_domain[job['domain']]
+    dispatch_jobs()
+
+def _run_scheduled_job(job, process):
+    try:
+        if job['segments']:
+            run_segmented_job(job)
+        else:
+            run_download_job(job, process)
+    except Exception as e:
+        print(f"Job {job['id']} crashed: {e}")
+        finish_job(job, 'failed')
+    finally:
+        release_download_slot(job)
+
+# Concurrency Control
+#
+# No fixed number of parallel downloads suits every link and site, so the limit is adjusted by
+# AIMD (additive increase, multiplicative decrease) controllers: one for all downloads and one per
+# domain. Each collects the bytes its downloads receive, and every CONCURRENCY_INTERVAL_SECONDS it
+# compares that window's throughput with the previous one. While the limit is fully used and each
+# added download brings at least CONCURRENCY_MARGINAL_GAIN of what an average download was getting,
+# the limit grows by one slot. When the last slot added brought less than that, or throughput fell
+# by more than CONCURRENCY_FALL_THRESHOLD, the limit is multiplied by
+# CONCURRENCY_DECREASE_FACTOR and the climb starts again, so it keeps oscillating just below the
+# point where more downloads stop helping, wherever that is on the current link. A domain whose
+# downloads are throttled (an HTTP 429, or a download's reported speed collapsing below
+# SPEED_COLLAPSE_RATIO of its own peak) is cut harder, by THROTTLE_DECREASE_FACTOR.
+ADAPTIVE_CONCURRENCY = True
+CONCURRENCY_MIN = 1
+CONCURRENCY_MAX = 16
+DOMAIN_CONCURRENCY_MAX = 8
+CONCURRENCY_INTERVAL_SECONDS = 10
+CONCURRENCY_MARGINAL_GAIN = 0.5
+CONCURRENCY_FALL_THRESHOLD = 0.05
+CONCURRENCY_DECREASE_FACTOR = 0.75
+THROTTLE_DECREASE_FACTOR = 0.5
+SPEED_COLLAPSE_RATIO = 0.2
+CONCURRENCY_HISTORY = 20  # decisions kept per controller for /concurrency
+
+class ConcurrencyController:
+    """AIMD download limit for one scope (all downloads, or the downloads of one domain)."""
+
+    def __init__(self, initial, maximum):
+        self.limit = float(initial)
+        self.maximum = maximum
+        self.bytes = 0
+        self.throttled = []
+        self.peak_running = 0
+        self.window_started = time.monotonic()
+        self.previous = None  # (throughput, downloads) of the last window the limit was fully used
+        self.throughput = None
+        self.decisions = deque(maxlen=CONCURRENCY_HISTORY)
+
+    @property
+    def slots(self):
+        return max(CONCURRENCY_MIN, int(self.limit))
+
+    def adjust(self, running, now):
+        """
+        Close the current window and move the limit. `running` is the number of downloads running
+        now. Returns the decision, or None if nothing ran during the window.
+        """
+        throughput = self.bytes / max(now - self.window_started, 1e-6)
+        throttled, peak_running = self.throttled, self.peak_running
+        self.bytes, self.throttled, self.peak_running, self.window_started = 0, [], running, now
+        if not peak_running:
+            return None
+        self.throughput = throughput
+        previous, self.previous = self.previous, (throughput, peak_running)
+
+        if throttled:
+            action, reason, factor = 'decrease', f"throttled: {throttled[-1]}", THROTTLE_DECREASE_FACTOR
+        elif peak_running < self.slots:
+            # Demand, not the limit, decided how many ran, so the throughput says nothing about it
+            action, reason = 'hold', 'limit not reached'
+            self.previous = None
+        elif previous and throughput < previous[0] * (1 - CONCURRENCY_FALL_THRESHOLD):
+            action, reason, factor = 'decrease', 'throughput fell', CONCURRENCY_DECREASE_FACTOR
+        elif self.slots >= self.maximum:
+            action, reason = 'hold', 'at maximum'
+        elif not previous or throughput - previous[0] >= CONCURRENCY_MARGINAL_GAIN * previous[0] / previous[1]:
+            action, reason = 'increase', 'throughput rose'
+        else:
+            action, reason, factor = 'decrease', 'no gain from the last slot', CONCURRENCY_DECREASE_FACTOR
+
+        if action == 'increase':
+            self.limit = min(self.maximum, self.limit + 1)
+        elif action == 'decrease':
+            self.limit = max(CONCURRENCY_MIN, self.limit * factor)
+            self.previous = None  # measure the new level before judging it
+        decision = {'at': time.time(), 'action': action, 'reason': reason, 'limit': self.slots,
+                    'running': peak_running, 'throughput': throughput}
+        self.decisions.append(decision)
+        return decision
+
+    def status(self):
+        return {'limit': self.slots, 'throughput': self.throughput, 'decisions': list(self.decisions)}
+
+concurrency_lock = Lock()
+global_concurrency = ConcurrencyController(MAX_CONCURRENT_DOWNLOADS, CONCURRENCY_MAX)
+domain_concurrency = {}
+_concurrency_ticker = None
+
+def domain_controller(domain):
+    """The controller for one domain, created on first use (call with concurrency_lock held)."""
+    if domain not in domain_concurrency:
+        domain_concurrency[domain] = ConcurrencyController(
+            min(global_concurrency.slots, DOMAIN_CONCURRENCY_MAX), DOMAIN_CONCURRENCY_MAX)
+    return domain_concurrency[domain]
+
+def download_slots(domain):
+    """(overall, per-domain) number of downloads allowed to run; a None domain limit means no limit."""
+    if not ADAPTIVE_CONCURRENCY:
+        return MAX_CONCURRENT_DOWNLOADS, None
+    with concurrency_lock:
+        return global_concurrency.slots, domain_controller(domain).slots
+
+def note_running(domain, total, in_domain):
+    """Record how many downloads run right after one was started."""
+    with concurrency_lock:
+        global_concurrency.peak_running = max(global_concurrency.peak_running, total)
+        controller = domain_controller(domain)
+        controller.peak_running = max(controller.peak_running, in_domain)
+
+def record_download_bytes(job, nbytes):
+    """Count bytes a job received towards the throughput of its controllers."""
+    if nbytes <= 0:
+        return
+    with concurrency_lock:
+        global_concurrency.bytes += nbytes
+        domain_controller(job['domain']).bytes += nbytes
+
+def record_throttling(job, reason):
+    """Report that a site is throttling one of its downloads; its domain's limit is cut next window."""
+    with concurrency_lock:
+        domain_controller(job['domain']).throttled.append(reason)
+
+def adjust_concurrency():
+    """Close the current window of every controller, then start whatever the new limits allow."""
+    now = time.monotonic()
+    with scheduler_lock:
+        total = len(running_job_ids)
+        running = Counter(running_by_domain)
+    with concurrency_lock:
+        global_concurrency.adjust(total, now)
+        for domain, controller in list(domain_concurrency.items()):
+            controller.adjust(running[domain], now)
+            if not running[domain] and not controller.decisions:
+                del domain_concurrency[domain]  # seen once and never measured
+    dispatch_jobs()
+
+def start_concurrency_controller():
+    global _concurrency_ticker
+    with concurrency_lock:
+        if ADAPTIVE_CONCURRENCY and _concurrency_ticker is None:
+            _concurrency_ticker = Thread(target=_run_concurrency_controller, daemon=True)
+            _concurrency_ticker.start()
+
+def _run_concurrency_controller():
+    while True:
+        time.sleep(CONCURRENCY_INTERVAL_SECONDS)
+        adjust_concurrency()
+
+# Archive Export
+#
+# Folders are exported as zip or tar archives generated on the fly: each file is read in
+# ARCHIVE_CHUNK_SIZE pieces and every piece is yielded to the client as soon as it is encoded,
+# so memory use is constant and nothing is staged on disk.
+ARCHIVE_CHUNK_SIZE = 1024 * 1024
+# Already-compressed formats are stored as-is in zip archives; deflating them costs CPU for no gain.
+PRECOMPRESSED_EXTENSIONS = MEDIA_EXTENSIONS | {'.jpg', '.jpeg', '.png', '.webp', '.gif', '.zip', '.gz'}
+
+class _ArchiveSink(io.RawIOBase):
+    """Non-seekable write target that collects encoded bytes until the generator drains them."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+def collect_archive_members(paths, base_dir):
+    """Expand files and directories into sorted (path, arcname) pairs, arcnames relative to base_dir."""
+    members = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    file_path = os.path.join(dirpath, filename)
+                    members.append((file_path, os.path.relpath(file_path, base_dir)))
+        elif os.path.isfile(path):
+            members.append((path, os.path.relpath(path, base_dir)))
+    return members
+
+def _read_chunks(path, size):
+    """Yield exactly size bytes of path, zero-padding if the file shrank while being read."""
+    remaining = size
+    with open(path, 'rb') as f:
+        while remaining > 0:
+            chunk = f.read(min(ARCHIVE_CHUNK_SIZE, remaining))
+            if not chunk:
+                yield b'\0' * remaining
+                return
+            remaining -= len(chunk)
+            yield chunk
+
+def stream_zip(members):
+    """Generate a zip archive of members chunk by chunk (entries use data descriptors, as the output is not seekable)."""
+    sink = _ArchiveSink()
+    with zipfile.ZipFile(sink, 'w', allowZip64=True) as archive:
+        for path, arcname in members:
+            zinfo = zipfile.ZipInfo.from_file(path, arcname)
+            if os.path.splitext(path)[1].lower() in PRECOMPRESSED_EXTENSIONS:
+                zinfo.compress_type = zipfile.ZIP_STORED
+            else:
+                zinfo.compress_type = zipfile.ZIP_DEFLATED
+            with archive.open(zinfo, 'w') as entry:
+                for chunk in _read_chunks(path, zinfo.file_size):
+                    entry.write(chunk)
+                    yield sink.drain()
+            yield sink.drain()
+    yield sink.drain()
+
+def tar_entries(members):
+    """Stat each member once and return (path, header, size) entries for tar_size and stream_tar."""
+    entries = []
+    for path, arcname in members:
+        stat_result = os.stat(path)
+        tarinfo = tarfile.TarInfo(arcname)
+        tarinfo.size = stat_result.st_size
+        tarinfo.mtime = int(stat_result.st_mtime)
+        tarinfo.mode = stat_result.st_mode & 0o777
+        entries.append((path, tarinfo.tobuf(format=tarfile.PAX_FORMAT), tarinfo.size))
+    return entries
+
+def tar_size(entries):
+    """Exact byte size of the tar archive stream_tar will produce for entries."""
+    total = 2 * tarfile.BLOCKSIZE
+    for _, header, size in entries:
+        total += len(header) + size + (-size % tarfile.BLOCKSIZE)
+    return total
+
+def stream_tar(entries):
+    """Generate an uncompressed (PAX) tar archive of entries chunk by chunk.
+
+    Sizes come from the entries, not the files, so a file that changes while streaming
+    can't make the archive disagree with the Content-Length computed by tar_size.
+    """
+    for path, header, size in entries:
+        yield header
+        yield from _read_chunks(path, size)
+        yield b'\0' * (-size % tarfile.BLOCKSIZE)
+    yield b'\0' * (2 * tarfile.BLOCKSIZE)
+
+def archive_response(paths, base_dir, name, archive_format):
+    """Build a streaming download response for paths in the requested archive format."""
+    members = collect_archive_members(paths, base_dir)
+    if archive_format == 'tar':
+        entries = tar_entries(members)
+        response = Response(stream_tar(entries), mimetype='application/x-tar')
+        response.headers['Content-Length'] = str(tar_size(entries))
+        filename = f"{name}.tar"
+    else:
+        response = Response(stream_zip(members), mimetype='application/zip')
+        filename = f"{name}.zip"
+    response.headers['Content-Disposition'] = f"attachment; filename*=UTF-8''{quote(filename)}"
+    return response
+
+# Deduplication
+#
+# After a job is organized, its media files are queued for a low-priority background pass that
+# replaces byte-identical copies with links to a single file. Candidates are narrowed cheaply by
+# size and a hash of the first and last DEDUP_SAMPLE_BYTES; full-content hashes are only computed
+# when that prefilter matches. Hashes are kept in the content_hashes table of the library DB.
+FICLONE = 0x40049409
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_SET_SYSCALLS = {'x86_64': 251, 'aarch64': 30}
+
+dedup_queue = Queue()
+dedup_stats = {'files_hashed': 0, 'duplicates_linked': 0, 'bytes_reclaimed': 0}
+_dedup_worker = None
+_dedup_worker_lock = Lock()
+
+def set_low_io_priority():
+    """
+    Put the calling thread in the idle I/O class and lowest CPU priority (Linux; best effort).
+    Both settings apply per thread when given the thread's native id.
+    """
+    tid = threading.get_native_id()
+    try:
+        os.setpriority(os.PRIO_PROCESS, tid, 19)
+    except (AttributeError, OSError):
+        pass
+    syscall_number = IOPRIO_SET_SYSCALLS.get(platform.machine())
+    if syscall_number is not None:
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            libc.syscall(syscall_number, IOPRIO_WHO_PROCESS, tid, IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT)
+        except (OSError, AttributeError):
+            pass
+
+def quick_content_hash(path, size):
+    """Hash of the size plus the first and last DEDUP_SAMPLE_BYTES of a file."""
+    digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with open(path, 'rb') as f:
+        digest.update(f.read(DEDUP_SAMPLE_BYTES))
+        if size > 2 * DEDUP_SAMPLE_BYTES:
+            f.seek(size - DEDUP_SAMPLE_BYTES)
+            digest.update(f.read(DEDUP_SAMPLE_BYTES))
+    return digest.hexdigest()
+
+def full_content_hash(path):
+    digest = hashlib.blake2b()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DEDUP_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _hash_record(path):
+    stat_result = os.stat(path)
+    return {
+        'path': path,
+        'dev': stat_result.st_dev,
+        'inode': stat_result.st_ino,
+        'size': stat_result.st_size,
+        'mtime': stat_result.st_mtime,
+        'quick_hash': quick_content_hash(path, stat_result.st_size),
+        'full_hash': None,
+    }
+
+def _save_hash_record(record):
+    with _library_lock:
+        conn = get_library_db()
+        with conn:
+            conn.execute("""
+                INSERT OR REPLACE INTO content_hashes (path, dev, inode, size, mtime, quick_hash, full_hash)
+                VALUES (:path, :dev, :inode, :size, :mtime, :quick_hash, :full_hash)
+            """, record)
+
+def link_duplicate(source, target):
+    """Atomically replace target with a link (or reflink clone) of source."""
+    temp_path = f"{target}.dedup-{uuid.uuid4().hex[:8]}"
+    try:
+        if DEDUP_LINK_MODE == 'reflink':
+            try:
+                with open(source, 'rb') as src, open(temp_path, 'wb') as dst:
+                    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            except OSError:
+                os.remove(temp_path)
+                os.link(source, temp_path)
+        else:
+            os.link(source, temp_path)
+        os.replace(temp_path, target)
+    except OSError:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+def deduplicate_files(paths, pool):
+    """
+    Hash new media files and link any that duplicate an already indexed file on the same filesystem.
+    Returns the number of bytes reclaimed: a file that has other links (the artifact cache, an
+    attached request's copy) keeps its data on disk, so linking it frees nothing.
+    """
+    reclaimed = 0
+    paths = [path for path in paths if is_media_file(path) and os.path.isfile(path)]
+    for record in pool.map(_hash_record, paths):
+        dedup_stats['files_hashed'] += 1
+        with _library_lock:
+            candidates = get_library_db().execute("""
+                SELECT * FROM content_hashes WHERE size = ? AND quick_hash = ? AND path != ?
+            """, (record['size'], record['quick_hash'], record['path'])).fetchall()
+
+        for candidate in map(dict, candidates):
+            try:
+                current = os.stat(candidate['path'])
+            except OSError:
+                current = None
+            if current is None or current.st_mtime != candidate['mtime'] or current.st_ino != candidate['inode']:
+                with _library_lock:
+                    conn = get_library_db()
+                    with conn:
+                        conn.execute("DELETE FROM content_hashes WHERE path = ?", (candidate['path'],))
+                continue
+            if candidate['inode'] == record['inode'] and candidate['dev'] == record['dev']:
+                break  # already the same file
+            if candidate['dev'] != record['dev']:
+                continue  # links cannot cross filesystems
+
+            pending = {}
+            if record['full_hash'] is None:
+                pending['record'] = pool.submit(full_content_hash, record['path'])
+            if candidate['full_hash'] is None:
+                pending['candidate'] = pool.submit(full_content_hash, candidate['path'])
+            if 'record' in pending:
+                record['full_hash'] = pending['record'].result()
+            if 'candidate' in pending:
+                candidate['full_hash'] = pending['candidate'].result()
+                _save_hash_record(candidate)
+            if record['full_hash'] != candidate['full_hash']:
+                continue
+
+            freed = record['size'] if os.stat(record['path']).st_nlink == 1 else 0
+            link_duplicate(candidate['path'], record['path'])
+            linked = os.stat(record['path'])
+            record.update(inode=linked.st_ino, mtime=linked.st_mtime)
+            reclaimed += freed
+            dedup_stats['duplicates_linked'] += 1
+            dedup_stats['bytes_reclaimed'] += freed
+            print(f"Deduplicated {record['path']} -> {candidate['path']}")
+            break
+        _save_hash_record(record)
+    return reclaimed
+
+def _run_dedup_worker():
+    set_low_io_priority()
+    with ThreadPoolExecutor(max_workers=DEDUP_HASH_WORKERS, initializer=set_low_io_priority) as pool:
+        while True:
+            job = dedup_queue.get()
+            try:
+                with timed_phase(job, 'deduplicating'):
+                    reclaimed = deduplicate_files(job['files'], pool)
+                job['dedup_reclaimed_bytes'] = job.get('dedup_reclaimed_bytes', 0) + reclaimed
+            except Exception as e:
+                print(f"Deduplication for job {job['id']} failed: {e}")
+            finally:
+                dedup_queue.task_done()
+
+def queue_dedup(job):
+    """Queue a finished job's files for the background deduplication pass."""
+    global _dedup_worker
+    with _dedup_worker_lock:
+        if _dedup_worker is None:
+            _dedup_worker = Thread(target=_run_dedup_worker, daemon=True)
+            _dedup_worker.start()
+    dedup_queue.put(job)
+
+# Deferred Metadata
+#
+# Sidecar files can take longer to fetch than the media itself (comments above all). When a
+# download asks for them to be deferred, the job downloads only the media, and once it is done a
+# separate yt-dlp run with --skip-download writes the sidecars into the same %(title)s folder
+# layout build_metadata_dir describes. These runs go through their own queue with METADATA_WORKERS
+# workers at the lowest priority, so they never hold a download slot. Embedding metadata into the
+# media file needs it inline, so deferred options only produce sidecar files.
+METADATA_WRITE_FLAGS = {
+    'description': ['--write-description'],
+    'comments': ['--write-comments'],
+    'info_json': ['--write-info-json'],
+    'subtitles': ['--write-subs', '--write-auto-subs'],
+    'thumbnail': ['--write-thumbnail'],
+}
+
+metadata_queue = Queue()
+_metadata_workers = []
+_metadata_workers_lock = Lock()
+
+def split_deferred_metadata(download_options, custom_flags):
+    """
+    Take the deferrable sidecar options out of download_options and custom_flags.
+    Returns (download_options, custom_flags, deferred option names).
+    """
+    download_options = dict(download_options)
+    deferred = set()
+    for option, flags in METADATA_WRITE_FLAGS.items():
+        if download_options.pop(option, None) or any(flag in custom_flags for flag in flags):
+            deferred.add(option)
+    write_flags = {flag for flags in METADATA_WRITE_FLAGS.values() for flag in flags}
+    return download_options, [flag for flag in custom_flags if flag not in write_flags], deferred
+
+def build_metadata_command(url, output_dir, is_playlist, options, cookies_path, custom_flags):
+    """yt-dlp command writing only the sidecar files for `options` into the title folder layout."""
+    command = [YT_DLP_BINARY, '--skip-download', '-o', f'{build_metadata_dir(output_dir, is_playlist)}.%(ext)s']
+    for option in sorted(options):
+        command += METADATA_WRITE_FLAGS[option]
+    if 'comments' in options:
+        command.append('--write-info-json')  # comments are written into the info JSON
+    if cookies_path:
+        command += ['--cookies', cookies_path]
+    command += custom_flags
+    command.append(url)
+    return deduplicate_command(command)
+
+def run_metadata_pass(job):
+    """Fetch a finished job's deferred sidecar files, then refresh its library entries."""
+    metadata = job['deferred_metadata']
+    metadata['status'] = 'running'
+    errors = []
+    job['log_writer'].write(f"[metadata] Fetching deferred {', '.join(metadata['options'])}")
+    with timed_phase(job, 'metadata'):
+        process = spawn_supervised(metadata['command'], 'metadata',
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        supervision = supervised_processes.get(process.pid)
+        for line in process.stdout:
+            supervision['last_output'] = time.monotonic()
+            line = line.rstrip('\n')
+            print(line.strip())
+            job['log_writer'].write(line)
+            written = re.match(r'^\[info\] Writing .+? to: (.+)$', line)
+            if written:
+                metadata['files'].append(written.group(1))
+            if line.startswith('ERROR:'):
+                errors.append(line[len('ERROR:'):].strip())
+                emit_job_event(job, f"INFO::{line.strip()}")
+        metadata['returncode'] = reap_process(process, job)
+        job['log_writer'].close()
+    metadata['errors'] = errors
+    if metadata['files']:
+        if job['requesters']:
+            share_job_output(job)
+        index_media_files(job['files'] + requester_files(job), force=True)
+    if metadata['returncode'] == 0:
+        cache_job_output(job)
+    metadata['status'] = 'finished' if metadata['returncode'] == 0 else 'failed'
+
+def _run_metadata_worker():
+    while True:
+        job = metadata_queue.get()
+        try:
+            run_metadata_pass(job)
+        except Exception as e:
+            print(f"Metadata pass for job {job['id']} failed: {e}")
+            job['deferred_metadata']['status'] = 'failed'
+        finally:
+            metadata_queue.task_done()
+
+def queue_deferred_metadata(job):
+    """Queue the deferred sidecar fetch of a job whose media is done (no-op if nothing was deferred)."""
+    if not job['deferred_metadata'] or job['deferred_metadata']['status'] != 'waiting':
+        return
+    with _metadata_workers_lock:
+        while len(_metadata_workers) < METADATA_WORKERS:
+            worker = Thread(target=_run_metadata_worker, daemon=True)
+            worker.start()
+            _metadata_workers.append(worker)
+    job['deferred_metadata']['status'] = 'queued'
+    metadata_queue.put(job)
+
+# Single-Flight Requests
+#
+# A request for a download that is already queued or running does not start a second yt-dlp
+# process (which would fight the first over the same .part files with --continue). Requests are
+# keyed by the normalized URL, the format and the effective options; a matching request is
+# attached to the in-flight job and gets its job id, so it follows the same progress stream. When
+# the job is done its results are hard-linked (copied across devices) into the output_dir of every
+# attached requester. Once a job stops accepting requesters, an identical request starts afresh.
+single_flight_jobs = {}
+single_flight_lock = Lock()
+
+def single_flight_key(url, format_type, download_options, custom_flags, cookies_path, is_playlist, deferred_options):
+    """What makes two download requests the same download: the URL, format and effective options."""
+    option_args = []
+    add_download_option_commands(option_args, download_options, '', is_playlist)
+    flags = tuple(map(str, custom_flags)) if isinstance(custom_flags, list) else ()
+    return (normalize_url(url), format_type, bool(is_playlist), tuple(option_args), flags, cookies_path,
+            tuple(sorted(deferred_options or ())))
+
+def join_single_flight(key, output_dir, job=None):
+    """
+    Return the in-flight job for key with this request's output_dir attached to it. If there is
+    none, `job` (when given) becomes the in-flight job for key and is returned; otherwise None.
+    """
+    with single_flight_lock:
+        leader = single_flight_jobs.get(key)
+        if leader is None:
+            if job is not None:
+                job['single_flight_key'] = key
+                single_flight_jobs[key] = job
+            return job
+        target = os.path.realpath(output_dir)
+        if target != os.path.realpath(leader['output_dir']) and \
+                all(target != os.path.realpath(r['output_dir']) for r in leader['requesters']):
+            leader['requesters'].append({'output_dir': output_dir, 'attached_at': time.time(), 'files': []})
+        return leader
+
+def leave_single_flight(job):
+    """Stop attaching requests to job (idempotent); its requester list is final afterwards."""
+    with single_flight_lock:
+        if single_flight_jobs.get(job['single_flight_key']) is job:
+            del single_flight_jobs[job['single_flight_key']]
+
+def link_job_output(files, source_dir, target_dir, copy_across_devices=True):
+    """
+    Hard-link (or copy across devices) media files under source_dir, with their metadata folders,
+    to the same relative paths under target_dir. Existing files are kept. With
+    copy_across_devices=False a link that cannot be made raises OSError instead.
+    Returns (bytes placed, the media files' paths under target_dir).
+    """
+    placed_bytes = 0
+    placed_files = []
+    for path in files:
+        folder = os.path.splitext(path)[0]
+        sources = [path] + [os.path.join(dirpath, filename)
+                            for dirpath, _, filenames in os.walk(folder) for filename in filenames]
+        for source in sources:
+            relative = os.path.relpath(source, source_dir)
+            if relative.startswith(os.pardir) or not os.path.isfile(source):
+                continue
+            target = os.path.join(target_dir, relative)
+            if source == path:
+                placed_files.append(target)
+            if os.path.exists(target):
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            try:
+                os.link(source, target)
+            except OSError:
+                if not copy_across_devices:
+                    raise
+                shutil.copy2(source, target)
+            placed_bytes += os.path.getsize(target)
+    return placed_bytes, placed_files
+
+def share_job_output(job):
+    """Place a job's results under every requester's output_dir. Returns the number of bytes placed."""
+    placed_bytes = 0
+    for requester in job['requesters']:
+        nbytes, placed_files = link_job_output(job['files'], job['output_dir'], requester['output_dir'])
+        placed_bytes += nbytes
+        requester['files'] = sorted(set(requester['files']) | set(placed_files))
+    return placed_bytes
+
+def requester_files(job):
+    return [path for requester in job['requesters'] for path in requester['files']]
+
+# Artifact Cache
+#
+# Finished single-video downloads are kept in an artifact cache so that a later request for the
+# same item never touches the network. An entry is keyed like a single-flight request (extractor
+# and video ID, format and effective options) and holds hard links of the media file and its
+# metadata folder under ARTIFACT_CACHE_FOLDER, sharing storage with the downloaded files. A job
+# whose files are on another filesystem than the cache is not cached, rather than copied. On a hit
+# start_download links the cached files into the requested output_dir (copying across devices) and
+# the job finishes at once. Entries are listed in the artifact_cache table of the library DB and
+# evicted least recently used first once they add up to more than ARTIFACT_CACHE_MAX_BYTES; cache
+# folders without a row (the DB was lost while the downloads volume kept them) are swept then. Hits,
+# misses and the latency of jobs served cold (downloaded) and warm (from the cache) are reported
+# by /cache/stats.
+artifact_cache_stats = {'hits': 0, 'misses': 0, 'stored': 0, 'evicted': 0, 'evicted_bytes': 0}
+job_latency = {kind: {'count': 0, 'sum_seconds': 0.0, 'max_seconds': 0.0} for kind in ('cold', 'warm')}
+artifact_cache_lock = Lock()
+artifacts_storing = set()  # keys whose folders are being filled, not yet in the artifact_cache table
+
+def artifact_cache_key(url, flight_key, is_playlist):
+    """Cache key of a request, or None if it is not cached (playlists, URLs no extractor knows)."""
+    if not ARTIFACT_CACHE_ENABLED or is_playlist:
+        return None
+    classification = classify_url(url)
+    if not classification['extractor'] or not classification['id'] or classification['is_playlist']:
+        return None
+    return hashlib.sha256(json.dumps(flight_key).encode()).hexdigest()[:32]
+
+def artifact_dir(key):
+    return os.path.join(app.config['ARTIFACT_CACHE_FOLDER'], key)
+
+def lookup_artifact(key):
+    """Return the cached media files for key and mark the entry as used, or None on a miss."""
+    with _library_lock:
+        conn = get_library_db()
+        row = conn.execute("SELECT files FROM artifact_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        files = [os.path.join(artifact_dir(key), path) for path in json.loads(row['files'])]
+        if not all(os.path.isfile(path) for path in files):
+            conn.execute("DELETE FROM artifact_cache WHERE key = ?", (key,))
+            conn.commit()
+            shutil.rmtree(artifact_dir(key), ignore_errors=True)
+            return None
+        conn.execute("UPDATE artifact_cache SET last_used = ?, hits = hits + 1 WHERE key = ?", (time.time(), key))
+        conn.commit()
+    return files
+
+def store_artifact(job):
+    """Add a finished job's media files and metadata folders to the cache, then evict down to the budget."""
+    folder = artifact_dir(job['cache_key'])
+    with artifact_cache_lock:
+        artifacts_storing.add(job['cache_key'])
+    try:
+        shutil.rmtree(folder, ignore_errors=True)
+        try:
+            size, cached = link_job_output(job['files'], job['output_dir'], folder, copy_across_devices=False)
+        except OSError:
+            shutil.rmtree(folder, ignore_errors=True)
+            raise
+        if not cached:
+            return 0
+        now = time.time()
+        with _library_lock:
+            conn = get_library_db()
+            conn.execute(
+                "INSERT OR REPLACE INTO artifact_cache (key, url, format, files, size, created_at, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job['cache_key'], job['url'], job['format'], json.dumps([os.path.relpath(p, folder) for p in cached]),
+                 size, now, now))
+            conn.commit()
+    finally:
+        with artifact_cache_lock:
+            artifacts_storing.discard(job['cache_key'])
+    with artifact_cache_lock:
+        artifact_cache_stats['stored'] += 1
+    evict_artifacts()
+    return size
+
+def sweep_artifact_cache():
+    """
+    Delete cache folders that have no artifact_cache row, e.g. left behind when the library DB was
+    lost or reset while the downloads volume kept the cache. Returns the number removed.
+    """
+    cache_root = app.config['ARTIFACT_CACHE_FOLDER']
+    try:
+        names = os.listdir(cache_root)
+    except OSError:
+        return 0
+    # Listed before the keys are read: a folder being filled is either still in artifacts_storing
+    # or already has its row
+    with artifact_cache_lock:
+        busy = set(artifacts_storing)
+    with _library_lock:
+        keys = {row['key'] for row in get_library_db().execute("SELECT key FROM artifact_cache")}
+    orphans = [name for name in names if name not in keys and name not in busy]
+    for name in orphans:
+        path = os.path.join(cache_root, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    if orphans:
+        print(f"Removed {len(orphans)} orphaned entries from {cache_root}")
+    return len(orphans)
+
+def evict_artifacts():
+    """Delete the least recently used entries until the cache fits in ARTIFACT_CACHE_MAX_BYTES."""
+    sweep_artifact_cache()
+    with _library_lock:
+        conn = get_library_db()
+        rows = conn.execute("SELECT key, size FROM artifact_cache ORDER BY last_used").fetchall()
+        total = sum(row['size'] for row in rows)
+        victims = []
+        for row in rows:
+            if total <= ARTIFACT_CACHE_MAX_BYTES:
+                break
+            victims.append(row)
+            total -= row['size']
+        conn.executemany("DELETE FROM artifact_cache WHERE key = ?", [(row['key'],) for row in victims])
+        conn.commit()
+    for row in victims:
+        shutil.rmtree(artifact_dir(row['key']), ignore_errors=True)
+    with artifact_cache_lock:
+        artifact_cache_stats['evicted'] += len(victims)
+        artifact_cache_stats['evicted_bytes'] += sum(row['size'] for row in victims)
+
+def cache_job_output(job):
+    """Store a finished job in the cache if its request is cacheable."""
+    if job['cache'] != 'miss' or not job['files']:
+        return
+    with timed_phase(job, 'caching') as counters:
+        try:
+            counters['bytes'] = store_artifact(job)
+        except OSError as e:
+            # Typically EXDEV: output_dir is not on the cache's filesystem, and a copy would double disk use
+            print(f"Warning: not caching job {job['id']}, its files cannot be linked into "
+                  f"{app.config['ARTIFACT_CACHE_FOLDER']}: {e}")
+
+def serve_from_cache(key, url, output_dir, format_type):
+    """
+    Answer a request from the cache: link the cached files into output_dir and return the finished
+    job, or None on a miss.
+    """
+    cached = lookup_artifact(key)
+    job = None
+    if cached is not None:
+        job = create_job(url, output_dir, [], False)
+        job.update(format=format_type, cache_key=key, cache='hit', status='running', started_at=time.time())
+        try:
+            with timed_phase(job, 'placing') as counters:
+                counters['bytes'], job['files'] = link_job_output(cached, artifact_dir(key), output_dir)
+        except OSError as e:
+            print(f"Error placing cached files, downloading instead: {e}")
+            with jobs_lock:
+                jobs.pop(job['id'], None)
+            job = None
+    with artifact_cache_lock:
+        artifact_cache_stats['hits' if job else 'misses'] += 1
+    if job is None:
+        return None
+    with timed_phase(job, 'indexing'):
+        try:
+            index_media_files(job['files'])
+        except Exception as e:
+            print(f"Error indexing cached files: {e}")
+    emit_job_event(job, f"INFO::Served from cache: {', '.join(map(os.path.basename, job['files']))}")
+    emit_job_event(job, "PROGRESS::100.0::cached::00:00")
+    finish_job(job, 'finished')
+    return job
+
+def record_job_latency(job):
+    """Add a finished job's time from request to completion to the cold or warm latency totals."""
+    seconds = job['finished_at'] - job['created_at']
+    with artifact_cache_lock:
+        totals = job_latency['warm' if job['cache'] == 'hit' else 'cold']
+        totals['count'] += 1
+        totals['sum_seconds'] += seconds
+        totals['max_seconds'] = max(totals['max_seconds'], seconds)
+
+# Request Instrumentation
+#
+# Every request's latency is recorded in a fixed-bucket histogram per route. For streaming
+# routes such as /stream_logs this measures the time until the response starts (connect time).
+# A single request can also be profiled with cProfile on demand, and tracemalloc snapshots can be
+# diffed over time to find memory growth; both are guarded by PROFILING_ENABLED/PROFILING_TOKEN.
+request_metrics = {}
+request_metrics_lock = Lock()
+_profiler_lock = Lock()  # only one profiler can be active at a time
+_tracemalloc_snapshot = None
+
+def record_request_latency(route, seconds, status_code):
+    with request_metrics_lock:
+        metrics = request_metrics.setdefault(route, {
+            'count': 0, 'sum_seconds': 0.0, 'max_seconds': 0.0, 'errors': 0,
+            'buckets': [0] * len(LATENCY_BUCKETS),
+        })
+        metrics['count'] += 1
+        metrics['sum_seconds'] += seconds
+        metrics['max_seconds'] = max(metrics['max_seconds'], seconds)
+        if status_code >= 500:
+            metrics['errors'] += 1
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                metrics['buckets'][i] += 1
+                break
+
+def histogram_quantile(buckets, count, quantile):
+    """Upper bound of the bucket containing the given quantile (the max observed value for the last bucket)."""
+    target = quantile * count
+    seen = 0
+    for bound, bucket_count in zip(LATENCY_BUCKETS, buckets):
+        seen += bucket_count
+        if seen >= target:
+            return bound
+    return math.inf
+
+def profiling_authorized():
+    """True if profiling is enabled and the request carries the configured token (if any)."""
+    if not app.config['PROFILING_ENABLED']:
+        return False
+    token = app.config['PROFILING_TOKEN']
+    supplied = request.headers.get('X-Profile') or request.args.get('profile')
+    return token is None or supplied == token
+
+@app.before_request
+def _start_request_instrumentation():
+    g.request_started = time.perf_counter()
+    g.profiler = None
+    wants_profile = 'X-Profile' in request.headers or 'profile' in request.args
+    if wants_profile and profiling_authorized() and _profiler_lock.acquire(blocking=False):
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+@app.after_request
+def _finish_request_instrumentation(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else '<unmatched>'
+        record_request_latency(route, time.perf_counter() - started, response.status_code)
+
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        _profiler_lock.release()
+        profile_dir = app.config['PROFILE_FOLDER']
+        os.makedirs(profile_dir, exist_ok=True)
+        endpoint = (request.endpoint or 'unmatched').replace('.', '_')
+        profile_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{endpoint}-{uuid.uuid4().hex[:6]}"
+        profiler.dump_stats(os.path.join(profile_dir, f"{profile_id}.prof"))
+        response.headers['X-Profile-Id'] = profile_id
+    return response
+
+@app.teardown_request
+def _stop_abandoned_profiler(exc):
+    """Stop a profiler that after_request never saw (the view raised) so profiling isn't locked out."""
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        _profiler_lock.release()
+
 # Routes
 @app.route('/')
 def index():
@@ -191,9 +2998,10 @@ def browse_directories():
             return jsonify({'error': 'Path does not exist'}), 400
         
         items = []
+        cache_root = os.path.abspath(app.config['ARTIFACT_CACHE_FOLDER'])
         for item in os.listdir(path):
             item_path = os.path.join(path, item)
-            if os.path.isdir(item_path):
+            if os.path.isdir(item_path) and os.path.abspath(item_path) != cache_root:
                 items.append({
                     'name': item,
                     'path': item_path,
@@ -218,23 +3026,44 @@ def validate_url():
     if not url:
         return jsonify({'valid': False, 'error': 'No URL provided'})
     
-    if not re.match(r'^https?://', url):
-        return jsonify({'valid': False, 'error': 'Invalid URL format'})
-    
-    supported_domains = [
-        'youtube.com', 'youtu.be', 'vimeo.com', 'dailymotion.com',
-        'twitch.tv', 'facebook.com', 'instagram.com', 'tiktok.com'
-    ]
-    
-    is_supported = any(domain in url.lower() for domain in supported_domains)
-    is_playlist = is_likely_playlist(url)
-    
+    return jsonify(url_validation(url))
+
+@app.route('/validate_urls', methods=['POST'])
+def validate_urls():
+    """Validate a batch of URLs ({"urls": [...]} or newline-separated text) in one call."""
+    data = request.get_json(silent=True) or {}
+    urls = data.get('urls') or []
+    if isinstance(urls, str):
+        urls = [line for line in urls.splitlines() if line.strip()]
+    if not isinstance(urls, list) or not all(isinstance(u, str) for u in urls):
+        return jsonify({'error': 'urls must be a list of strings'}), 400
+    if len(urls) > URL_BATCH_LIMIT:
+        return jsonify({'error': f'At most {URL_BATCH_LIMIT} URLs per request'}), 400
+    results = [dict(url_validation(url), url=url) for url in urls]
     return jsonify({
-        'valid': is_supported,
-        'is_youtube': 'youtube.com' in url.lower() or 'youtu.be' in url.lower(),
-        'is_playlist': is_playlist
+        'results': results,
+        'summary': {
+            'total': len(results),
+            'valid': sum(r['valid'] for r in results),
+            'playlists': sum(r['valid'] and r['is_playlist'] for r in results),
+        },
     })
 
+def url_validation(url):
+    """The /validate_url answer for one URL."""
+    url = url.strip()
+    if not re.match(r'^https?://', url):
+        return {'valid': False, 'error': 'Invalid URL format'}
+    classification = classify_url(url)
+    extractor = classification['extractor']
+    return {
+        'valid': extractor is not None,
+        'is_youtube': bool(extractor) and extractor.startswith('youtube'),
+        'is_playlist': is_likely_playlist(url),
+        'extractor': extractor,
+        'id': classification['id'],
+    }
+
 @app.route('/upload_cookies', methods=['POST'])
 def upload_cookies():
     """Handle uploading and processing of cookies files."""
@@ -314,30 +3143,30 @@ def start_download():
     if not re.match(r'^https?://', url):
         return jsonify({'error': 'Invalid URL format'}), 400
 
+    segments = None
+    if download_options.get('segmented') and not is_playlist and format_type in VIDEO_FORMAT_PLANS:
+        try:
+            segments = int(download_options.get('segments') or SEGMENTED_DEFAULT_SEGMENTS)
+        except (TypeError, ValueError):
+            return jsonify({'error': 'segments must be a whole number'}), 400
+        segments = max(1, min(segments, SEGMENTED_MAX_SEGMENTS))
+
     os.makedirs(output_dir, exist_ok=True)
 
+    custom_flags = data.get('custom_flags', [])
+
+    # Deferred sidecars are left out of the download and fetched later by the metadata queue
+    deferred_options = None
+    if download_options.get('defer_metadata') and isinstance(custom_flags, list):
+        download_options, custom_flags, deferred_options = split_deferred_metadata(download_options, custom_flags)
+
     extra_files_requested = any(download_options.get(opt) for opt in [
         'description', 'comments', 'info_json', 'subtitles', 'thumbnail', 'sponsorblock', 'sponsorblock_remove'
-    ]) or any(flag in (data.get('custom_flags') or []) for flag in [
+    ]) or any(flag in (custom_flags or []) for flag in [
         '--write-description', '--write-info-json', '--write-comments', '--write-subs', '--write-auto-subs',
         '--write-thumbnail', '--sponsorblock-remove'
     ])
 
-    if is_playlist:
-        output_template = f'{output_dir}/%(playlist_title)s/%(title)s.%(ext)s'
-        metadata_dir = f'{output_dir}/%(playlist_title)s/%(title)s'
-    elif extra_files_requested:
-        output_template = f'{output_dir}/%(title)s/%(title)s.%(ext)s'
-        metadata_dir = f'{output_dir}/%(title)s'
-    else:
-        output_template = f'{output_dir}/%(title)s.%(ext)s'
-        metadata_dir = output_dir
-
-    command = ['yt-dlp', '--continue', '-o', output_template]
-    command += build_format_command(format_type)
-
-    custom_flags = data.get('custom_flags', [])
-
     # Infer download_options from custom_flags if not explicitly set
     if '--write-description' in custom_flags:
         download_options['description'] = True
@@ -352,6 +3181,39 @@ def start_download():
     if '--sponsorblock-remove' in custom_flags:
         download_options['sponsorblock'] = True
 
+    # An identical download already in flight is joined instead of started again
+    flight_key = single_flight_key(url, format_type, download_options, custom_flags, cookies_path,
+                                   is_playlist, deferred_options)
+    leader = join_single_flight(flight_key, output_dir)
+    if leader:
+        return jsonify({'message': 'Attached to a running download', 'job_id': leader['id'], 'attached': True}), 200
+
+    # A download finished earlier for the same request is linked from the artifact cache
+    cache_key = artifact_cache_key(url, flight_key, is_playlist)
+    if cache_key:
+        job = serve_from_cache(cache_key, url, output_dir, format_type)
+        if job:
+            return jsonify({'message': 'Served from cache', 'job_id': job['id'], 'cached': True}), 200
+
+    # With a scratch folder configured, yt-dlp writes everything there and the results are
+    # moved to output_dir once the job is done
+    stage_dir = reserve_scratch_space()
+    write_dir = stage_dir or output_dir
+
+    if is_playlist:
+        output_template = f'{write_dir}/%(playlist_title)s/%(title)s.%(ext)s'
+        metadata_dir = f'{write_dir}/%(playlist_title)s/%(title)s'
+    elif extra_files_requested:
+        output_template = f'{write_dir}/%(title)s/%(title)s.%(ext)s'
+        metadata_dir = f'{write_dir}/%(title)s'
+    else:
+        output_template = f'{write_dir}/%(title)s.%(ext)s'
+        metadata_dir = write_dir
+
+    format_plan = plan_format(format_type, None if is_playlist else known_formats(url))
+    command = [YT_DLP_BINARY, '--continue', '-o', output_template]
+    command += format_plan['args']
+
     add_download_option_commands(command, download_options, metadata_dir, is_playlist)
 
     if cookies_path:
@@ -363,48 +3225,411 @@ def start_download():
 
     command = deduplicate_command(command)
 
-    def run_command():
-        last_percent = -1
-        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-        for line in process.stdout:
-            print(line.strip())
-            match = re.search(r"\[download\]\s+(\d+(?:\.\d+)?)%.*?at\s+([^\s]+).*?ETA\s+([^\s]+)", line)
-            if match:
-                percent = float(match.group(1))
-                speed = match.group(2)
-                eta = match.group(3)
-                if int(percent) != last_percent:
-                    log_queue.put(f"PROGRESS::{percent}::{speed}::{eta}")
-                    last_percent = int(percent)
-            else:
-                if "[ffmpeg]" in line or "Destination" in line or "[info]" in line:
-                    log_queue.put(f"INFO::{line.strip()}")
-        log_queue.put('[DONE]')
-        try:
-            if is_playlist:
-                # Look for playlist folder (usually one folder in output_dir)
-                playlist_subfolders = [f for f in os.listdir(output_dir) if os.path.isdir(os.path.join(output_dir, f))]
-                for folder in playlist_subfolders:
-                    folder_path = os.path.join(output_dir, folder)
-                    move_media_files_up_and_metadata_down(folder_path)
-            else:
-                move_media_files_up_and_metadata_down(output_dir)
-        except Exception as e:
-            print(f"Error organizing metadata files: {e}")
-
-    Thread(target=run_command, daemon=True).start()
-    return jsonify({'message': 'Download started'}), 200
+    job = create_job(url, output_dir, command, is_playlist)
+    job['format'] = format_type
+    job['stage_dir'] = stage_dir
+    job['cache_key'] = cache_key
+    job['cache'] = 'miss' if cache_key else None
+    job['segments'] = segments
+    job['format_plan'] = {key: format_plan[key] for key in ('strategy', 'reason')}
+    if deferred_options:
+        job['deferred_metadata'] = {
+            'status': 'waiting',
+            'options': sorted(deferred_options),
+            'command': build_metadata_command(url, output_dir, is_playlist, deferred_options, cookies_path, custom_flags),
+            'files': [],
+            'returncode': None,
+        }
+    leader = join_single_flight(flight_key, output_dir, job)
+    if leader is not job:
+        # An identical request got in while this one was being prepared
+        release_scratch(job)
+        with jobs_lock:
+            jobs.pop(job['id'], None)
+        return jsonify({'message': 'Attached to a running download', 'job_id': leader['id'], 'attached': True}), 200
+    schedule_job(job)
+    return jsonify({'message': 'Download started', 'job_id': job['id']}), 200
 
 @app.route('/stream_logs')
 def stream_logs():
-    """Stream download logs via Server-Sent Events (SSE)."""
-    def generate():
+    """
+    Stream download logs via Server-Sent Events (SSE).
+    With ?job_id=... the job's buffered events are replayed from the start, then followed live.
+    """
+    job_id = request.args.get('job_id')
+    if job_id:
+        job = jobs.get(job_id)
+        if job is None:
+            return jsonify({'error': 'Unknown job'}), 404
+        buffer, seq = job['log'], 0
+    else:
+        buffer, seq = log_buffer, log_buffer.next_seq
+
+    def generate(seq):
         while True:
-            line = log_queue.get()
-            yield f'data: {line}\n\n'
-            if line == '[DONE]':
-                break
-    return Response(generate(), mimetype='text/event-stream')
+            lines, seq = buffer.read_since(seq, timeout=SSE_KEEPALIVE_SECONDS)
+            if not lines:
+                yield ': keepalive\n\n'
+            for line in lines:
+                yield f'data: {line}\n\n'
+                if line == '[DONE]':
+                    return
+    return Response(generate(seq), mimetype='text/event-stream')
+
+@app.route('/jobs', methods=['GET'])
+def list_jobs():
+    """List known jobs, newest first."""
+    with jobs_lock:
+        snapshot = sorted(jobs.values(), key=lambda j: j['created_at'], reverse=True)
+    return jsonify({'jobs': [job_summary(job) for job in snapshot]})
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(job_summary(job))
+
+@app.route('/jobs/<job_id>/timeline', methods=['GET'])
+def job_timeline(job_id):
+    """Per-phase wall time, CPU time and bytes for a job, with totals per phase."""
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    totals = {}
+    for entry in job['timeline']:
+        phase_total = totals.setdefault(entry['phase'], {'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'bytes': 0})
+        phase_total['wall_seconds'] += entry['wall_seconds']
+        phase_total['cpu_seconds'] += entry['cpu_seconds'] or 0.0
+        phase_total['bytes'] += entry['bytes']
+    return jsonify({'job_id': job_id, 'status': job['status'], 'phases': job['timeline'], 'totals': totals})
+
+@app.route('/jobs/timeline', methods=['GET'])
+def jobs_timeline_summary():
+    """Phase totals across all jobs since startup, with each phase's share of total wall time."""
+    with phase_totals_lock:
+        snapshot = {name: dict(totals) for name, totals in phase_totals.items()}
+    total_wall = sum(totals['wall_seconds'] for totals in snapshot.values()) or 1.0
+    for totals in snapshot.values():
+        totals['mean_wall_seconds'] = totals['wall_seconds'] / totals['count']
+        totals['wall_share'] = totals['wall_seconds'] / total_wall
+    return jsonify({'phases': snapshot})
+
+@app.route('/jobs/<job_id>/log', methods=['GET'])
+def job_log(job_id):
+    """
+    Read a job's full yt-dlp output from its log files.
+    Use offset/limit to page through lines, or tail=N for the last N lines.
+    Works after the job has finished (and after it is dropped from memory).
+    """
+    if not re.fullmatch(r'[0-9a-f]+', job_id):
+        return jsonify({'error': 'Unknown job'}), 404
+    job = jobs.get(job_id)
+    if job is not None:
+        job['log_writer'].flush()
+    elif not job_log_segments(job_id):
+        return jsonify({'error': 'Unknown job'}), 404
+
+    limit = min(request.args.get('limit', 200, type=int), 5000)
+    tail = request.args.get('tail', type=int)
+    if tail is not None:
+        total = 0
+        last_lines = deque(maxlen=max(0, min(tail, 5000)))
+        for line in iter_job_log(job_id):
+            last_lines.append(line)
+            total += 1
+        return jsonify({'lines': list(last_lines), 'offset': total - len(last_lines), 'next_offset': total})
+
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    lines = []
+    for index, line in enumerate(iter_job_log(job_id)):
+        if index < offset:
+            continue
+        if len(lines) >= limit:
+            break
+        lines.append(line)
+    return jsonify({'lines': lines, 'offset': offset, 'next_offset': offset + len(lines)})
+
+def confine_to_download_root(path):
+    """
+    Resolve path (following symlinks) and return it only if it is a file inside the download root.
+    Returns None for anything outside it, so callers can answer 404 without revealing why.
+    """
+    root = os.path.realpath(app.config['DOWNLOAD_FOLDER'])
+    real_path = os.path.realpath(path)
+    if os.path.commonpath([root, real_path]) != root or not os.path.isfile(real_path):
+        return None
+    return real_path
+
+def send_media_file(path):
+    """
+    Serve a finished file with conditional and partial response support.
+
+    send_file handles Range/If-Range (206 responses), ETag and Last-Modified validation, and
+    hands the open file to the server's wsgi.file_wrapper, which production servers implement
+    with sendfile(), so file data is never copied through Python. Set USE_X_SENDFILE in the
+    app config when running behind a proxy that serves X-Sendfile.
+    """
+    response = send_file(path, conditional=True, etag=True, last_modified=os.path.getmtime(path),
+                         download_name=os.path.basename(path))
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['Cache-Control'] = 'private, max-age=0, must-revalidate'
+    return response
+
+@app.route('/files/<path:subpath>', methods=['GET'])
+def serve_file(subpath):
+    """Serve a file from the download root by its relative path."""
+    path = confine_to_download_root(os.path.join(app.config['DOWNLOAD_FOLDER'], subpath))
+    if path is None:
+        return jsonify({'error': 'File not found'}), 404
+    return send_media_file(path)
+
+@app.route('/files/job/<job_id>', methods=['GET'])
+def serve_job_file(job_id):
+    """
+    Serve a job's downloaded media. With a single file it is sent directly; otherwise
+    the file list is returned and ?index=N selects one.
+    """
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    files = [path for path in job.get('files', []) if confine_to_download_root(path)]
+    index = request.args.get('index', type=int)
+    if index is None and len(files) != 1:
+        return jsonify({'files': [
+            {'name': os.path.basename(path), 'url': url_for('serve_job_file', job_id=job_id, index=i)}
+            for i, path in enumerate(files)
+        ]})
+    index = index or 0
+    if not 0 <= index < len(files):
+        return jsonify({'error': 'File not found'}), 404
+    return send_media_file(confine_to_download_root(files[index]))
+
+@app.route('/export/<path:subpath>', methods=['GET'])
+def export_folder(subpath):
+    """Stream a folder under the download root as a zip (default) or tar (?format=tar) archive."""
+    archive_format = request.args.get('format', 'zip')
+    if archive_format not in ('zip', 'tar'):
+        return jsonify({'error': 'Unsupported archive format'}), 400
+    root = os.path.realpath(app.config['DOWNLOAD_FOLDER'])
+    folder = os.path.realpath(os.path.join(root, subpath))
+    if os.path.commonpath([root, folder]) != root or not os.path.isdir(folder):
+        return jsonify({'error': 'Folder not found'}), 404
+    return archive_response([folder], os.path.dirname(folder), os.path.basename(folder), archive_format)
+
+@app.route('/export/job/<job_id>', methods=['GET'])
+def export_job(job_id):
+    """
+    Stream a job's output as an archive: the playlist folder for playlist jobs, otherwise
+    the media file(s) together with their metadata folders.
+    """
+    archive_format = request.args.get('format', 'zip')
+    if archive_format not in ('zip', 'tar'):
+        return jsonify({'error': 'Unsupported archive format'}), 400
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    files = [path for path in map(confine_to_download_root, job['files']) if path]
+    if not files:
+        return jsonify({'error': 'Job has no files to export'}), 404
+    if job['is_playlist']:
+        paths = sorted({os.path.dirname(path) for path in files})
+    else:
+        paths = []
+        for path in files:
+            paths.append(path)
+            metadata_dir = os.path.splitext(path)[0]
+            if os.path.isdir(metadata_dir):
+                paths.append(metadata_dir)
+    base_dir = os.path.commonpath([os.path.dirname(path) for path in paths])
+    name = os.path.basename(paths[0]) if job['is_playlist'] and len(paths) == 1 else f"job-{job_id}"
+    return archive_response(paths, base_dir, name, archive_format)
+
+@app.route('/dedup/stats', methods=['GET'])
+def get_dedup_stats():
+    """Totals for the background deduplication pass since startup."""
+    return jsonify(dict(dedup_stats, queued=dedup_queue.qsize()))
+
+@app.route('/concurrency', methods=['GET'])
+def get_concurrency():
+    """Current download limits, overall and per domain, with the controllers' recent decisions."""
+    with scheduler_lock:
+        running = Counter(running_by_domain)
+        queued = Counter(job['domain'] for job in pending_jobs)
+    with concurrency_lock:
+        overall = global_concurrency.status()
+        domains = {domain: dict(controller.status(), running=running[domain], queued=queued[domain])
+                   for domain, controller in domain_concurrency.items()}
+    overall.update(running=sum(running.values()), queued=sum(queued.values()))
+    if not ADAPTIVE_CONCURRENCY:
+        overall['limit'] = MAX_CONCURRENT_DOWNLOADS
+    return jsonify({'adaptive': ADAPTIVE_CONCURRENCY, 'global': overall, 'domains': domains})
+
+@app.route('/cache/stats', methods=['GET'])
+def get_cache_stats():
+    """Artifact cache size, hit rate and eviction totals, with cold and warm job latency."""
+    with _library_lock:
+        entries, size = get_library_db().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM artifact_cache").fetchone()
+    with artifact_cache_lock:
+        stats = dict(artifact_cache_stats)
+        latency = {kind: {'count': totals['count'],
+                          'mean_seconds': totals['sum_seconds'] / totals['count'] if totals['count'] else None,
+                          'max_seconds': totals['max_seconds']}
+                   for kind, totals in job_latency.items()}
+    lookups = stats['hits'] + stats['misses']
+    return jsonify(dict(stats, entries=entries, bytes=size, max_bytes=ARTIFACT_CACHE_MAX_BYTES,
+                        hit_rate=stats['hits'] / lookups if lookups else None, latency=latency))
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Request latency histograms per route, as JSON or (with ?format=prometheus) in the
+    Prometheus text format.
+    """
+    with request_metrics_lock:
+        snapshot = {route: dict(m, buckets=list(m['buckets'])) for route, m in request_metrics.items()}
+
+    if request.args.get('format') == 'prometheus':
+        lines = ['# TYPE http_request_duration_seconds histogram']
+        for route, m in sorted(snapshot.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(LATENCY_BUCKETS, m['buckets']):
+                cumulative += bucket_count
+                le = '+Inf' if bound == math.inf else repr(bound)
+                lines.append(f'http_request_duration_seconds_bucket{{route="{route}",le="{le}"}} {cumulative}')
+            lines.append(f'http_request_duration_seconds_sum{{route="{route}"}} {m["sum_seconds"]}')
+            lines.append(f'http_request_duration_seconds_count{{route="{route}"}} {m["count"]}')
+        return Response('\n'.join(lines) + '\n', mimetype='text/plain')
+
+    routes = {}
+    for route, m in snapshot.items():
+        routes[route] = {
+            'count': m['count'],
+            'errors': m['errors'],
+            'mean_seconds': m['sum_seconds'] / m['count'],
+            'max_seconds': m['max_seconds'],
+            'p50_seconds': min(histogram_quantile(m['buckets'], m['count'], 0.5), m['max_seconds']),
+            'p95_seconds': min(histogram_quantile(m['buckets'], m['count'], 0.95), m['max_seconds']),
+            'p99_seconds': min(histogram_quantile(m['buckets'], m['count'], 0.99), m['max_seconds']),
+            'buckets': dict(zip(['+Inf' if b == math.inf else str(b) for b in LATENCY_BUCKETS], m['buckets'])),
+        }
+    return jsonify({'routes': routes})
+
+@app.route('/debug/profiles/<profile_id>', methods=['GET'])
+def get_profile(profile_id):
+    """Render a stored request profile as pstats text (?sort=cumulative|tottime, ?limit=N)."""
+    if not profiling_authorized():
+        return jsonify({'error': 'Profiling is disabled'}), 403
+    path = os.path.join(app.config['PROFILE_FOLDER'], f"{secure_filename(profile_id)}.prof")
+    if not os.path.isfile(path):
+        return jsonify({'error': 'Unknown profile'}), 404
+    output = io.StringIO()
+    stats = pstats.Stats(path, stream=output)
+    stats.sort_stats(request.args.get('sort', 'cumulative')).print_stats(request.args.get('limit', 50, type=int))
+    return Response(output.getvalue(), mimetype='text/plain')
+
+@app.route('/debug/tracemalloc', methods=['GET', 'POST'])
+def debug_tracemalloc():
+    """
+    Diagnose memory growth in a running process.
+    The first call starts tracing; each later call returns the top allocation sites and the
+    growth since the previous call. POST with {"stop": true} stops tracing.
+    """
+    global _tracemalloc_snapshot
+    if not profiling_authorized():
+        return jsonify({'error': 'Profiling is disabled'}), 403
+    data = request.get_json(silent=True) or {}
+    if request.method == 'POST' and data.get('stop'):
+        tracemalloc.stop()
+        _tracemalloc_snapshot = None
+        return jsonify({'tracing': False})
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(request.args.get('frames', 1, type=int))
+        _tracemalloc_snapshot = tracemalloc.take_snapshot()
+        return jsonify({'tracing': True, 'message': 'Tracing started; call again to see growth'})
+
+    limit = request.args.get('limit', 25, type=int)
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+    ])
+    current, peak = tracemalloc.get_traced_memory()
+    growth = snapshot.compare_to(_tracemalloc_snapshot, 'lineno') if _tracemalloc_snapshot else []
+    _tracemalloc_snapshot = snapshot
+    return jsonify({
+        'tracing': True,
+        'traced_bytes': current,
+        'peak_bytes': peak,
+        'top': [{'location': str(stat.traceback), 'size': stat.size, 'count': stat.count}
+                for stat in snapshot.statistics('lineno')[:limit]],
+        'growth': [{'location': str(stat.traceback), 'size_diff': stat.size_diff, 'count_diff': stat.count_diff}
+                   for stat in growth[:limit]],
+    })
+
+@app.route('/library', methods=['GET'])
+def list_library():
+    """
+    List indexed media, newest first.
+    Pages with keyset pagination: pass the last seen id as before_id to get the next page.
+    """
+    limit = min(request.args.get('limit', 50, type=int), 500)
+    before_id = request.args.get('before_id', type=int)
+    query = "SELECT * FROM media"
+    params = []
+    if before_id is not None:
+        query += " WHERE id < ?"
+        params.append(before_id)
+    query += " ORDER BY id DESC LIMIT ?"
+    params.append(limit)
+    with _library_lock:
+        rows = get_library_db().execute(query, params).fetchall()
+    items = [_media_row_to_dict(row) for row in rows]
+    return jsonify({
+        'items': items,
+        'next_before_id': items[-1]['id'] if len(items) == limit else None
+    })
+
+@app.route('/library/search', methods=['GET'])
+def search_library():
+    """Full-text search over titles, uploaders, formats, paths and URLs, optionally filtered by duration."""
+    fts_query = build_fts_query(request.args.get('q', ''))
+    if not fts_query:
+        return jsonify({'error': 'Search query required'}), 400
+    limit = min(request.args.get('limit', 50, type=int), 500)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    min_duration = request.args.get('min_duration', type=float)
+    max_duration = request.args.get('max_duration', type=float)
+
+    query = """
+        SELECT media.* FROM media_fts JOIN media ON media.id = media_fts.rowid
+        WHERE media_fts MATCH ?
+    """
+    params = [fts_query]
+    if min_duration is not None:
+        query += " AND media.duration >= ?"
+        params.append(min_duration)
+    if max_duration is not None:
+        query += " AND media.duration <= ?"
+        params.append(max_duration)
+    query += " ORDER BY media_fts.rank LIMIT ? OFFSET ?"
+    params += [limit, offset]
+
+    with _library_lock:
+        rows = get_library_db().execute(query, params).fetchall()
+    return jsonify({'items': [_media_row_to_dict(row) for row in rows]})
+
+@app.route('/library/scan', methods=['GET', 'POST'])
+def library_scan():
+    """Start a background scan of a directory tree into the library index (POST), or report scan status (GET)."""
+    if request.method == 'GET':
+        return jsonify(library_scan_status)
+    data = request.get_json(silent=True) or {}
+    root = data.get('path') or app.config['DOWNLOAD_FOLDER']
+    if not os.path.isdir(root):
+        return jsonify({'error': 'Path does not exist'}), 400
+    if not start_library_scan(root):
+        return jsonify({'error': 'A library scan is already running'}), 409
+    return jsonify({'message': 'Library scan started', 'root': os.path.abspath(root)}), 202
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, threaded=True)
\ No newline at end of file
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+Stand-in for the yt-dlp executable, used by the load harness (see harness.py).
+
+It accepts the command lines app.py builds, prints output shaped like yt-dlp's (extractor lines,
+"[download] Destination:", progress lines, merger/ffmpeg lines, ERROR: lines) and writes dummy
+media and metadata files following the -o template and --paths options. Nothing touches the
+network.
+
+Behaviour is set with FAKE_YTDLP_* environment variables, and can be overridden per request
+with query parameters on the URL (https://fake.test/watch?v=abc&duration=5&fail=throttled):
+
+    duration       seconds spent "downloading" each entry (FAKE_YTDLP_DURATION, default 2)
+    size           bytes written per media file (FAKE_YTDLP_SIZE, default 1 MiB)
+    rate           progress lines printed per second (FAKE_YTDLP_RATE, default 10)
+    merge          seconds the merge step runs without printing (FAKE_YTDLP_MERGE, default 0)
+    entries        number of entries for playlist URLs (FAKE_YTDLP_ENTRIES, default 3)
+    fail           error class to fail with: throttled, forbidden, network, unavailable,
+                   geo_blocked, ffmpeg (FAKE_YTDLP_FAIL, default none)
+    fail_rate      probability that a run fails with `fail` (FAKE_YTDLP_FAIL_RATE, default 1)
+
+Every progress burst also prints "[info] loadtest-clock <unix time>", which the harness
+uses to measure how long events take to reach SSE subscribers.
+"""
+import json
+import os
+import random
+import re
+import sys
+import time
+from urllib.parse import urlparse, parse_qs
+
+ERRORS = {
+    'throttled': 'ERROR: [fake] {id}: Unable to download webpage: HTTP Error 429: Too Many Requests',
+    'forbidden': 'ERROR: unable to download video data: HTTP Error 403: Forbidden',
+    'network': 'ERROR: [fake] {id}: Unable to download webpage: Read timed out.',
+    'unavailable': 'ERROR: [fake] {id}: Video unavailable',
+    'geo_blocked': 'ERROR: [fake] {id}: The uploader has not made this video available in your country',
+    'ffmpeg': 'ERROR: Postprocessing: Conversion failed!',
+}
+
+# Per-type output folders from "--paths TYPE:DIR", the extension each type writes and what
+# yt-dlp calls it in its "Writing ... to:" line
+METADATA_FILES = {
+    '--write-info-json': ('infojson', '.info.json', 'video metadata as JSON'),
+    '--write-description': ('description', '.description', 'video description'),
+    '--write-thumbnail': ('thumbnail', '.jpg', 'video thumbnail'),
+    '--write-subs': ('subtitle', '.en.vtt', 'video subtitles'),
+}
+
+
+def settings(url):
+    """Merge FAKE_YTDLP_* defaults with the URL's query parameters."""
+    values = {
+        'duration': os.environ.get('FAKE_YTDLP_DURATION', '2'),
+        'size': os.environ.get('FAKE_YTDLP_SIZE', str(1024 * 1024)),
+        'rate': os.environ.get('FAKE_YTDLP_RATE', '10'),
+        'merge': os.environ.get('FAKE_YTDLP_MERGE', '0'),
+        'entries': os.environ.get('FAKE_YTDLP_ENTRIES', '3'),
+        'fail': os.environ.get('FAKE_YTDLP_FAIL', ''),
+        'fail_rate': os.environ.get('FAKE_YTDLP_FAIL_RATE', '1'),
+    }
+    for key, items in parse_qs(urlparse(url).query).items():
+        if key in values:
+            values[key] = items[-1]
+    return {
+        'duration': float(values['duration']),
+        'size': int(values['size']),
+        'rate': max(float(values['rate']), 0.1),
+        'merge': float(values['merge']),
+        'entries': int(values['entries']),
+        'fail': values['fail'],
+        'fail_rate': float(values['fail_rate']),
+    }
+
+
+def parse_args(argv):
+    """Pick out the options the stub cares about; everything else is accepted and ignored."""
+    options = {'template': '%(title)s.%(ext)s', 'paths': {}, 'flags': set(), 'items': None, 'url': argv[-1]}
+    i = 0
+    while i < len(argv) - 1:
+        arg = argv[i]
+        if arg in ('-o', '--output'):
+            options['template'] = argv[i + 1]
+            i += 1
+        elif arg in ('-P', '--paths'):
+            kind, _, path = argv[i + 1].rpartition(':')
+            options['paths'][kind or 'home'] = path
+            i += 1
+        elif arg == '--playlist-items':
+            options['items'] = {int(item) for item in argv[i + 1].split(',') if item.isdigit()}
+            i += 1
+        elif arg.startswith('-'):
+            options['flags'].add(arg)
+        i += 1
+    return options
+
+
+def render(template, fields):
+    return re.sub(r'%\((\w+)\)s', lambda m: str(fields.get(m.group(1), 'NA')), template)
+
+
+def say(line):
+    print(line, flush=True)
+
+
+def format_size(size):
+    """Format like yt-dlp does: 512.00B, 4.00KiB, 12.34MiB."""
+    for unit in ('B', 'KiB', 'MiB'):
+        if size < 1024:
+            return f"{size:.2f}{unit}"
+        size /= 1024
+    return f"{size:.2f}GiB"
+
+
+def write_media(path, size, video_id):
+    """Write `size` bytes that differ per video (so deduplication does not link them all)."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    block = (video_id.encode() * 64)[:4096].ljust(4096, b'\0')
+    with open(path + '.part', 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            f.write(block[:remaining])
+            remaining -= len(block)
+    os.replace(path + '.part', path)
+
+
+def download_entry(options, config, fields):
+    """Print one entry's download progress and write its files; returns False if it failed."""
+    video_id = fields['id']
+    say(f"[fake] Extracting URL: {options['url']}")
+    say(f"[fake] {video_id}: Downloading webpage")
+    say(f"[info] {video_id}: Downloading 1 format(s): 18")
+    media = render(options['template'], fields)
+    info = {'id': video_id, 'title': fields['title'], 'webpage_url': options['url'], 'extractor': 'fake'}
+    if '--write-comments' in options['flags']:
+        say(f"[fake] {video_id}: Downloading comment section API JSON")
+        info['comments'] = [{'id': '1', 'text': 'first'}]
+    for flag, (kind, ext, description) in METADATA_FILES.items():
+        if flag in options['flags']:
+            folder = render(options['paths'].get(kind, os.path.dirname(media)), fields)
+            os.makedirs(folder, exist_ok=True)
+            path = os.path.join(folder, fields['title'] + ext)
+            say(f"[info] Writing {description} to: {path}")
+            with open(path, 'w') as f:
+                json.dump(info, f)
+    if '--skip-download' in options['flags']:
+        return True
+    say(f"[download] Destination: {media}")
+
+    failing = config['fail'] in ERRORS and random.random() < config['fail_rate']
+    steps = max(1, int(config['duration'] * config['rate']))
+    speed = config['size'] / max(config['duration'], 0.001)
+    for step in range(1, steps + 1):
+        time.sleep(config['duration'] / steps)
+        percent = 100.0 * step / steps
+        eta = (steps - step) / config['rate']
+        say(f"[download] {percent:5.1f}% of {format_size(config['size'])} at {format_size(speed)}/s "
+            f"ETA {int(eta // 60):02d}:{int(eta % 60):02d}")
+        say(f"[info] loadtest-clock {time.time():.6f}")
+        if failing and step >= steps // 2:
+            say(ERRORS[config['fail']].format(id=video_id))
+            return False
+    write_media(media, config['size'], video_id)
+    say(f"[download] 100% of {format_size(config['size'])} in 00:00:{int(config['duration']):02d} "
+        f"at {format_size(speed)}/s")
+    say(f"[Merger] Merging formats into \"{media}\"")
+    time.sleep(config['merge'])
+    return True
+
+
+def main(argv):
+    options = parse_args(argv)
+    config = settings(options['url'])
+    query = parse_qs(urlparse(options['url']).query)
+    base_id = (query.get('v') or query.get('list') or ['fake'])[0]
+
+    if '-J' in options['flags'] or '--dump-single-json' in options['flags']:
+        say(json.dumps({'id': base_id, 'title': f"Fake Video {base_id}", 'ext': 'mp4', 'protocol': 'm3u8_native',
+                        'formats': [{'format_id': '18', 'ext': 'mp4', 'vcodec': 'avc1', 'acodec': 'mp4a'}]}))
+        return 0
+
+    if 'list' not in query:
+        fields = {'id': base_id, 'title': f"Fake Video {base_id}", 'ext': 'mp4'}
+        return 0 if download_entry(options, config, fields) else 1
+
+    ok = True
+    playlist_title = f"Fake Playlist {base_id}"
+    say(f"[download] Downloading playlist: {playlist_title}")
+    indexes = [i for i in range(1, config['entries'] + 1) if options['items'] is None or i in options['items']]
+    for position, index in enumerate(indexes, 1):
+        say(f"[download] Downloading item {index} of {config['entries']}")
+        fields = {'id': f"{base_id}-{index}", 'title': f"Fake Video {base_id} {index}", 'ext': 'mp4',
+                  'playlist_title': playlist_title, 'playlist_index': index}
+        ok = download_entry(options, config, fields) and ok
+    say(f"[download] Finished downloading playlist: {playlist_title}")
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+"""
+Load and soak harness: runs the real server with fake_yt_dlp.py as its yt-dlp and drives it
+with concurrent clients.
+
+    python loadtest/harness.py --jobs 300 --concurrency 50 --subscribers 20
+    python loadtest/harness.py --soak 3600 --rate 2 --subscribers 10 --report soak.json
+
+The server runs in a temporary working directory (its data/ and downloads/ live there), on
+127.0.0.1. The harness reports:
+
+- request latency percentiles per endpoint (/start_download, /jobs, /metrics, /stream_logs first event)
+- event delivery lag: the time between fake yt-dlp printing a "loadtest-clock" line and an SSE
+  subscriber receiving it
+- the server's RSS, thread count, open file descriptors and child processes over time, with
+  the growth rate of each, so leaks show up as a steady slope during a soak run
+- how many jobs finished, failed or were still in flight at the end
+
+Pass extra fake yt-dlp settings with --fake KEY=VALUE (see fake_yt_dlp.py), for example
+--fake duration=10 --fake fail=throttled --fake fail_rate=0.2.
+"""
+import argparse
+import http.client
+import json
+import math
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(HERE)
+FAKE_YT_DLP = os.path.join(HERE, 'fake_yt_dlp.py')
+CLOCK_PATTERN = re.compile(r'loadtest-clock (\d+\.\d+)')
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of a list of numbers (None for an empty list)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(q / 100.0 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def summarize(values):
+    return {
+        'count': len(values),
+        'p50': percentile(values, 50),
+        'p90': percentile(values, 90),
+        'p99': percentile(values, 99),
+        'max': max(values) if values else None,
+    }
+
+
+def slope(points):
+    """Least-squares slope of (t, value) points, in value units per second."""
+    if len(points) < 2:
+        return 0.0
+    n = len(points)
+    mean_t = sum(t for t, _ in points) / n
+    mean_v = sum(v for _, v in points) / n
+    var = sum((t - mean_t) ** 2 for t, _ in points)
+    if var == 0:
+        return 0.0
+    return sum((t - mean_t) * (v - mean_v) for t, v in points) / var
+
+
+def process_stats(pid):
+    """RSS bytes, threads, open FDs and direct child processes of pid, read from /proc."""
+    stats = {'rss': None, 'threads': None, 'fds': None, 'children': None}
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    stats['rss'] = int(line.split()[1]) * 1024
+                elif line.startswith('Threads:'):
+                    stats['threads'] = int(line.split()[1])
+        stats['fds'] = len(os.listdir(f'/proc/{pid}/fd'))
+    except OSError:
+        return stats
+    children = 0
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                if int(f.read().rsplit(')', 1)[1].split()[1]) == pid:
+                    children += 1
+        except (OSError, IndexError, ValueError):
+            continue
+    stats['children'] = children
+    return stats
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class Server:
+    """The app running in a subprocess with the fake yt-dlp and its own working directory."""
+
+    def __init__(self, workdir, port, fake_env):
+        self.workdir = workdir
+        self.port = port
+        env = dict(os.environ, YT_DLP_BINARY=FAKE_YT_DLP, PYTHONPATH=REPO_ROOT, **fake_env)
+        self.log = open(os.path.join(workdir, 'server.log'), 'w')
+        self.process = subprocess.Popen(
+            [sys.executable, '-c', f"import app; app.app.run(host='127.0.0.1', port={port}, threaded=True)"],
+            cwd=workdir, env=env, stdout=self.log, stderr=subprocess.STDOUT,
+        )
+
+    def wait_ready(self, timeout=30):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"server exited with {self.process.returncode}, see {self.log.name}")
+            try:
+                with socket.create_connection(('127.0.0.1', self.port), timeout=0.5):
+                    return
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError("server did not start listening")
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.log.close()
+
+
+class Harness:
+    def __init__(self, args):
+        self.args = args
+        self.workdir = tempfile.mkdtemp(prefix='ytdlp-load-')
+        self.port = args.port or free_port()
+        fake_env = {f"FAKE_YTDLP_{key.upper()}": value for key, value in args.fake}
+        self.server = Server(self.workdir, self.port, fake_env)
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.event_lags = []
+        self.events_received = 0
+        self.job_ids = []
+        self.samples = []
+        self.stopping = threading.Event()
+
+    # Measurements
+
+    def record(self, name, seconds, error=None):
+        with self.lock:
+            self.latencies.setdefault(name, []).append(seconds)
+            if error:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+    def request(self, method, path, body=None, name=None):
+        """One HTTP request on a fresh connection; returns (status, parsed JSON or None)."""
+        name = name or path.split('?')[0]
+        start = time.perf_counter()
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=self.args.timeout)
+            payload = json.dumps(body) if body is not None else None
+            conn.request(method, path, body=payload, headers={'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            data = response.read()
+            conn.close()
+        except OSError as e:
+            self.record(name, time.perf_counter() - start, error=e)
+            return None, None
+        self.record(name, time.perf_counter() - start, error=response.status >= 500)
+        try:
+            return response.status, json.loads(data)
+        except ValueError:
+            return response.status, None
+
+    # Workers
+
+    def start_job(self, number):
+        params = {'v': f"load{number}"}
+        if self.args.playlist_share and random.random() < self.args.playlist_share:
+            params = {'list': f"load{number}"}
+        url = f"https://fake.test/watch?{urlencode(params)}"
+        output_dir = os.path.join(self.workdir, 'downloads', f"client{number % self.args.concurrency}")
+        status, body = self.request('POST', '/start_download', {'url': url, 'format': 'mp4', 'output_dir': output_dir})
+        if status == 200 and body:
+            with self.lock:
+                self.job_ids.append(body['job_id'])
+
+    def subscriber(self):
+        """Follow the global SSE stream, measuring event lag; reconnects if the stream ends."""
+        while not self.stopping.is_set():
+            start = time.perf_counter()
+            try:
+                conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=self.args.timeout)
+                conn.request('GET', '/stream_logs')
+                response = conn.getresponse()
+                self.record('/stream_logs first event', time.perf_counter() - start)
+                while not self.stopping.is_set():
+                    line = response.fp.readline()
+                    if not line:
+                        break
+                    match = CLOCK_PATTERN.search(line.decode('utf-8', 'replace'))
+                    with self.lock:
+                        self.events_received += line.startswith(b'data:')
+                        if match:
+                            self.event_lags.append(time.time() - float(match.group(1)))
+                conn.close()
+            except OSError as e:
+                self.record('/stream_logs first event', time.perf_counter() - start, error=e)
+                self.stopping.wait(1)
+
+    def poller(self):
+        """Poll the read endpoints a dashboard would use."""
+        while not self.stopping.wait(self.args.poll_interval):
+            self.request('GET', '/jobs')
+            self.request('GET', '/metrics')
+
+    def sampler(self):
+        started = time.time()
+        while True:
+            stats = process_stats(self.server.process.pid)
+            stats['t'] = round(time.time() - started, 3)
+            with self.lock:
+                self.samples.append(stats)
+            if self.stopping.wait(self.args.sample_interval):
+                return
+
+    # Runs
+
+    def job_states(self):
+        status, body = self.request('GET', '/jobs', name='/jobs (final)')
+        states = {}
+        wanted = set(self.job_ids)
+        for job in (body or {}).get('jobs', []):
+            if job['id'] in wanted:
+                states[job['status']] = states.get(job['status'], 0) + 1
+        return states
+
+    def wait_for_jobs(self, timeout):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            states = self.job_states()
+            if not any(s in states for s in ('queued', 'running', 'retry_scheduled')):
+                return states
+            time.sleep(1)
+        return self.job_states()
+
+    def run(self):
+        self.server.wait_ready()
+        background = [threading.Thread(target=self.sampler, daemon=True),
+                      threading.Thread(target=self.poller, daemon=True)]
+        background += [threading.Thread(target=self.subscriber, daemon=True) for _ in range(self.args.subscribers)]
+        for thread in background:
+            thread.start()
+
+        started = time.time()
+        with ThreadPoolExecutor(max_workers=self.args.concurrency) as pool:
+            if self.args.soak:
+                number = 0
+                while time.time() - started < self.args.soak:
+                    pool.submit(self.start_job, number)
+                    number += 1
+                    time.sleep(1.0 / self.args.rate)
+            else:
+                list(pool.map(self.start_job, range(self.args.jobs)))
+        submit_seconds = time.time() - started
+
+        states = self.wait_for_jobs(self.args.drain_timeout)
+        self.stopping.set()
+        for thread in background:
+            thread.join(timeout=self.args.timeout + 1)
+        return self.report(states, submit_seconds, time.time() - started)
+
+    def report(self, states, submit_seconds, total_seconds):
+        samples = self.samples
+        resources = {}
+        for key in ('rss', 'threads', 'fds', 'children'):
+            points = [(s['t'], s[key]) for s in samples if s[key] is not None]
+            values = [v for _, v in points]
+            resources[key] = {
+                'start': values[0] if values else None,
+                'peak': max(values) if values else None,
+                'end': values[-1] if values else None,
+                'per_hour': round(slope(points) * 3600, 2),
+            }
+        return {
+            'jobs_submitted': len(self.job_ids),
+            'job_states': states,
+            'submit_seconds': round(submit_seconds, 2),
+            'total_seconds': round(total_seconds, 2),
+            'latency_seconds': {name: summarize(values) for name, values in sorted(self.latencies.items())},
+            'request_errors': self.errors,
+            'events_received': self.events_received,
+            'event_lag_seconds': summarize(self.event_lags),
+            'resources': resources,
+            'samples': samples,
+        }
+
+    def cleanup(self):
+        self.server.stop()
+        if self.args.keep:
+            print(f"Working directory kept at {self.workdir}")
+        else:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+def print_report(report):
+    def ms(value):
+        return '-' if value is None else f"{value * 1000:.1f}ms"
+
+    print(f"jobs submitted: {report['jobs_submitted']} in {report['submit_seconds']}s, "
+          f"states at end: {report['job_states']}")
+    print("latency (p50 / p90 / p99 / max):")
+    for name, stats in report['latency_seconds'].items():
+        errors = report['request_errors'].get(name, 0)
+        print(f"  {name:<26} n={stats['count']:<6} {ms(stats['p50'])} / {ms(stats['p90'])} / "
+              f"{ms(stats['p99'])} / {ms(stats['max'])}" + (f"  errors={errors}" if errors else ''))
+    lag = report['event_lag_seconds']
+    print(f"SSE events received: {report['events_received']}, delivery lag p50 {ms(lag['p50'])}, "
+          f"p99 {ms(lag['p99'])}, max {ms(lag['max'])}")
+    print("server resources (start / peak / end, growth per hour):")
+    for key, stats in report['resources'].items():
+        scale, unit = (1024 * 1024, 'MiB') if key == 'rss' else (1, '')
+        values = ['-' if v is None else f"{v / scale:.1f}{unit}" if unit else str(v) for v in (stats['start'], stats['peak'], stats['end'])]
+        print(f"  {key:<9} {' / '.join(values)}, {stats['per_hour'] / scale:+.1f}{unit}/h")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--jobs', type=int, default=100, help="jobs to submit in load mode")
+    parser.add_argument('--concurrency', type=int, default=20, help="concurrent submitting clients")
+    parser.add_argument('--soak', type=float, default=0, help="soak mode: keep submitting for this many seconds")
+    parser.add_argument('--rate', type=float, default=1.0, help="jobs per second in soak mode")
+    parser.add_argument('--subscribers', type=int, default=5, help="concurrent /stream_logs subscribers")
+    parser.add_argument('--playlist-share', type=float, default=0.0, help="fraction of jobs that are playlists")
+    parser.add_argument('--poll-interval', type=float, default=1.0, help="seconds between /jobs and /metrics polls")
+    parser.add_argument('--sample-interval', type=float, default=1.0, help="seconds between resource samples")
+    parser.add_argument('--drain-timeout', type=float, default=600, help="seconds to wait for jobs to finish")
+    parser.add_argument('--timeout', type=float, default=30, help="HTTP timeout in seconds")
+    parser.add_argument('--port', type=int, default=0, help="server port (default: a free one)")
+    parser.add_argument('--fake', action='append', default=[], type=lambda s: tuple(s.split('=', 1)),
+                        metavar='KEY=VALUE', help="fake yt-dlp setting, e.g. duration=5")
+    parser.add_argument('--report', help="also write the full report (with samples) as JSON here")
+    parser.add_argument('--keep', action='store_true', help="keep the server's working directory")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    harness = Harness(args)
+    try:
+        report = harness.run()
+    finally:
+        harness.cleanup()
+    print_report(report)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+import unittest
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import zipfile
+from app import app, create_job
+from unittest.mock import patch
+
+
+class ArchiveExportTests(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client()
+        self.client.testing = True
+        self.tmp = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmp, 'downloads')
+        self.playlist = os.path.join(self.root, 'My Playlist')
+        os.makedirs(os.path.join(self.playlist, 'Episode 1'))
+        self.original_root = app.config['DOWNLOAD_FOLDER']
+        app.config['DOWNLOAD_FOLDER'] = self.root
+        self.media_path = os.path.join(self.playlist, 'Episode 1.mp4')
+        with open(self.media_path, 'wb') as f:
+            f.write(os.urandom(3000))
+        with open(os.path.join(self.playlist, 'Episode 1', 'Episode 1.description'), 'w') as f:
+            f.write('A description\n' * 50)
+
+    def tearDown(self):
+        app.config['DOWNLOAD_FOLDER'] = self.original_root
+        shutil.rmtree(self.tmp)
+
+    def test_zip_export_stores_media_and_deflates_text(self):
+        response = self.client.get('/export/My%20Playlist')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/zip')
+        archive = zipfile.ZipFile(io.BytesIO(response.data))
+        self.assertIsNone(archive.testzip())
+        media = archive.getinfo('My Playlist/Episode 1.mp4')
+        description = archive.getinfo('My Playlist/Episode 1/Episode 1.description')
+        self.assertEqual(media.compress_type, zipfile.ZIP_STORED)
+        self.assertEqual(description.compress_type, zipfile.ZIP_DEFLATED)
+        with open(self.media_path, 'rb') as f:
+            self.assertEqual(archive.read(media), f.read())
+
+    def test_tar_export_has_exact_content_length(self):
+        response = self.client.get('/export/My%20Playlist?format=tar')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(int(response.headers['Content-Length']), len(response.data))
+        archive = tarfile.open(fileobj=io.BytesIO(response.data))
+        self.assertEqual(sorted(archive.getnames()),
+                         ['My Playlist/Episode 1.mp4', 'My Playlist/Episode 1/Episode 1.description'])
+
+    def test_tar_matches_content_length_when_a_file_changes(self):
+        response = self.client.get('/export/My%20Playlist?format=tar', buffered=False)
+        for path in (self.media_path, os.path.join(self.playlist, 'Episode 1', 'Episode 1.description')):
+            with open(path, 'ab') as f:
+                f.write(os.urandom(5000))
+        data = b''.join(response.response)
+        response.close()
+        self.assertEqual(int(response.headers['Content-Length']), len(data))
+        archive = tarfile.open(fileobj=io.BytesIO(data))
+        self.assertEqual(archive.getmember('My Playlist/Episode 1.mp4').size, 3000)
+        self.assertEqual(archive.getmember('My Playlist/Episode 1/Episode 1.description').size, 700)
+
+    def test_export_is_streamed_in_chunks(self):
+        with patch('app.ARCHIVE_CHUNK_SIZE', 1000):
+            response = self.client.get('/export/My%20Playlist', buffered=False)
+            chunks = [chunk for chunk in response.response if chunk]
+            response.close()
+        self.assertGreater(len(chunks), 3)
+
+    def test_export_rejects_bad_requests(self):
+        self.assertEqual(self.client.get('/export/../').status_code, 404)
+        self.assertEqual(self.client.get('/export/missing').status_code, 404)
+        self.assertEqual(self.client.get('/export/My%20Playlist?format=rar').status_code, 400)
+
+    def test_job_export_includes_metadata_folder(self):
+        job = create_job('https://www.youtube.com/watch?v=abc', self.playlist, ['yt-dlp'], False)
+        job['files'] = [self.media_path]
+        response = self.client.get(f"/export/job/{job['id']}?format=tar")
+        archive = tarfile.open(fileobj=io.BytesIO(response.data))
+        self.assertEqual(sorted(archive.getnames()),
+                         ['Episode 1.mp4', 'Episode 1/Episode 1.description'])
@@ -0,0 +1,141 @@
+import unittest
+import errno
+import os
+import shutil
+import tempfile
+import time
+from app import (app, jobs, create_job, build_url_index, _classify_url, store_artifact, lookup_artifact,
+                 artifact_dir, scan_library, get_library_db, _library_lock, FALLBACK_EXTRACTORS)
+from loadtest.harness import FAKE_YT_DLP
+from unittest.mock import patch
+
+
+class ArtifactCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client()
+        self.client.testing = True
+        self.tmp = tempfile.mkdtemp()
+        self.original_config = {key: app.config[key] for key in ('ARTIFACT_CACHE_FOLDER', 'LIBRARY_DB')}
+        app.config['ARTIFACT_CACHE_FOLDER'] = os.path.join(self.tmp, 'cache')
+        app.config['LIBRARY_DB'] = os.path.join(self.tmp, 'library.db')
+        _classify_url.cache_clear()
+        self.patches = [
+            patch('app._url_index', build_url_index(FALLBACK_EXTRACTORS)),
+            patch('app.YT_DLP_BINARY', FAKE_YT_DLP),
+            patch.dict('app.artifact_cache_stats', {'hits': 0, 'misses': 0, 'stored': 0, 'evicted': 0, 'evicted_bytes': 0}),
+            patch.dict('app.job_latency', {kind: {'count': 0, 'sum_seconds': 0.0, 'max_seconds': 0.0}
+                                           for kind in ('cold', 'warm')}),
+        ]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        _classify_url.cache_clear()
+        app.config.update(self.original_config)
+        shutil.rmtree(self.tmp)
+
+    def request(self, url, output_dir):
+        response = self.client.post('/start_download', json={
+            'url': url, 'format': 'mp4', 'output_dir': os.path.join(self.tmp, output_dir),
+            'download_options': {'info_json': True},
+        })
+        body = response.get_json()
+        job = jobs[body['job_id']]
+        deadline = time.time() + 10
+        while job['status'] in ('queued', 'running') and time.time() < deadline:
+            time.sleep(0.02)
+        return body, job
+
+    def cached_job(self, name, size):
+        """A finished job with one media file of `size` bytes, stored in the cache."""
+        output_dir = os.path.join(self.tmp, 'jobs', name)
+        os.makedirs(output_dir)
+        job = create_job(f'https://www.youtube.com/watch?v={name}', output_dir, [], False)
+        job['files'] = [os.path.join(output_dir, f'{name}.mp4')]
+        with open(job['files'][0], 'wb') as f:
+            f.write(b'x' * size)
+        job['cache_key'] = name
+        store_artifact(job)
+        return job
+
+    def test_repeat_request_is_served_from_the_cache(self):
+        url = 'https://www.youtube.com/watch?v=cachedvid01&duration=0.3&size=2048'
+        cold_body, cold = self.request(url, 'first')
+        self.assertEqual(cold['cache'], 'miss')
+        self.assertEqual(cold['status'], 'finished')
+
+        warm_body, warm = self.request(url, 'second')
+        self.assertEqual(warm_body['cached'], True)
+        self.assertEqual(warm['status'], 'finished')
+        self.assertEqual(warm['processes'], [])  # no yt-dlp run
+        media = os.path.join(self.tmp, 'second', 'Fake Video cachedvid01.mp4')
+        self.assertEqual(warm['files'], [media])
+        self.assertTrue(os.path.samefile(media, cold['files'][0]))
+        self.assertTrue(os.path.isfile(os.path.join(self.tmp, 'second', 'Fake Video cachedvid01',
+                                                    'Fake Video cachedvid01.info.json')))
+
+        stats = self.client.get('/cache/stats').get_json()
+        self.assertEqual((stats['hits'], stats['misses'], stats['stored'], stats['entries']), (1, 1, 1, 1))
+        self.assertEqual(stats['hit_rate'], 0.5)
+        self.assertEqual(stats['latency']['cold']['count'], 1)
+        self.assertEqual(stats['latency']['warm']['count'], 1)
+        self.assertLess(stats['latency']['warm']['mean_seconds'], stats['latency']['cold']['mean_seconds'])
+
+    def test_playlists_and_unknown_sites_are_not_cached(self):
+        _, job = self.request('https://fake.test/watch?v=nocache&duration=0.1', 'plain')
+        self.assertIsNone(job['cache'])
+        self.assertEqual(self.client.get('/cache/stats').get_json()['entries'], 0)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        with patch('app.ARTIFACT_CACHE_MAX_BYTES', 2500):
+            self.cached_job('one', 1000)
+            self.cached_job('two', 1000)
+            self.assertIsNotNone(lookup_artifact('one'))  # "two" is now the least recently used
+            self.cached_job('three', 1000)
+        self.assertIsNone(lookup_artifact('two'))
+        self.assertFalse(os.path.exists(artifact_dir('two')))
+        self.assertIsNotNone(lookup_artifact('one'))
+        self.assertIsNotNone(lookup_artifact('three'))
+        stats = self.client.get('/cache/stats').get_json()
+        self.assertEqual((stats['entries'], stats['bytes'], stats['evicted'], stats['evicted_bytes']), (2, 2000, 1, 1000))
+
+    def test_files_on_another_device_are_not_copied_into_the_cache(self):
+        url = 'https://www.youtube.com/watch?v=crossdevice&duration=0.1'
+        with patch('app.os.link', side_effect=OSError(errno.EXDEV, 'Invalid cross-device link')):
+            _, job = self.request(url, 'elsewhere')
+        self.assertEqual(job['status'], 'finished')
+        self.assertEqual(self.client.get('/cache/stats').get_json()['entries'], 0)
+        self.assertFalse(os.path.exists(artifact_dir(job['cache_key'])))
+
+    def test_library_scan_skips_the_cache(self):
+        self.cached_job('scanned', 10)
+        scan_library(self.tmp)
+        with _library_lock:
+            paths = [row['path'] for row in get_library_db().execute("SELECT path FROM media")]
+        self.assertEqual(paths, [os.path.join(self.tmp, 'jobs', 'scanned', 'scanned.mp4')])
+
+    def test_folders_without_an_entry_are_swept(self):
+        orphan = artifact_dir('lostdb')
+        os.makedirs(orphan)
+        with open(os.path.join(orphan, 'old.mp4'), 'wb') as f:
+            f.write(b'x' * 10)
+        self.cached_job('kept', 10)
+        self.assertFalse(os.path.exists(orphan))
+        self.assertEqual(os.listdir(app.config['ARTIFACT_CACHE_FOLDER']), ['kept'])
+
+    def test_cache_folder_is_hidden_from_browsing(self):
+        self.cached_job('hidden', 10)
+        items = self.client.get(f'/browse_directories?path={self.tmp}').get_json()['items']
+        self.assertEqual(sorted(item['name'] for item in items), ['jobs'])
+
+    def test_entries_with_missing_files_are_dropped(self):
+        self.cached_job('gone', 10)
+        shutil.rmtree(artifact_dir('gone'))
+        self.assertIsNone(lookup_artifact('gone'))
+        self.assertEqual(self.client.get('/cache/stats').get_json()['entries'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import unittest
+import os
+import shutil
+import tempfile
+import time
+from collections import deque, Counter
+import app as app_module
+from app import (app, jobs, create_job, ConcurrencyController, adjust_concurrency, _next_dispatchable_job,
+                 url_domain, CONCURRENCY_MIN)
+from loadtest.harness import FAKE_YT_DLP
+from unittest.mock import patch
+
+MB = 1024 * 1024
+
+
+def run_windows(controller, link, windows):
+    """Feed `controller` the throughput `link(downloads)` gives at its limit for a number of windows."""
+    now = controller.window_started
+    limits = []
+    for _ in range(windows):
+        controller.peak_running = controller.slots
+        controller.bytes = link(controller.slots) * 10
+        now += 10
+        controller.adjust(controller.slots, now)
+        limits.append(controller.slots)
+    return limits
+
+
+class ConcurrencyControllerTests(unittest.TestCase):
+    def test_additive_increase_while_throughput_rises(self):
+        controller = ConcurrencyController(2, 16)
+        self.assertEqual(run_windows(controller, lambda n: n * MB, 4), [3, 4, 5, 6])
+        self.assertEqual([d['reason'] for d in controller.decisions], ['throughput rose'] * 4)
+
+    def test_multiplicative_decrease_without_gain_or_when_throttled(self):
+        controller = ConcurrencyController(8, 16)
+        run_windows(controller, lambda n: 10 * MB, 2)  # the 9th download added nothing
+        self.assertEqual(controller.slots, 6)
+        self.assertEqual(controller.decisions[-1]['reason'], 'no gain from the last slot')
+
+        controller.throttled.append('HTTP Error 429')
+        run_windows(controller, lambda n: 10 * MB, 1)
+        self.assertEqual(controller.slots, 3)
+        self.assertEqual(controller.decisions[-1]['reason'], 'throttled: HTTP Error 429')
+
+        controller.limit = CONCURRENCY_MIN
+        controller.throttled.append('HTTP Error 429')
+        run_windows(controller, lambda n: 10 * MB, 1)
+        self.assertEqual(controller.slots, CONCURRENCY_MIN)
+
+    def test_unused_limit_and_idle_windows_hold(self):
+        controller = ConcurrencyController(4, 16)
+        controller.peak_running, controller.bytes = 2, 100 * MB
+        self.assertEqual(controller.adjust(0, controller.window_started + 10)['reason'], 'limit not reached')
+        self.assertIsNone(controller.adjust(0, controller.window_started + 10))
+        self.assertEqual(controller.slots, 4)
+
+    def test_converges_near_the_knee_of_different_links(self):
+        # Per-download speed of 2 MiB/s up to the link capacity, then contention costs 3% per extra download
+        for capacity, knee in [(8 * MB, 4), (20 * MB, 10), (60 * MB, 30)]:
+            with self.subTest(capacity=capacity):
+                link = lambda n: min(2 * MB * n, capacity) * (1 - 0.03 * max(0, n - knee))
+                controller = ConcurrencyController(1, 64)
+                limits = run_windows(controller, link, 200)[100:]
+                self.assertLessEqual(max(limits), knee + 1)
+                self.assertGreaterEqual(min(limits), int(0.75 * (knee + 1)))
+                mean = sum(link(n) for n in limits) / len(limits)
+                self.assertGreater(mean, 0.85 * capacity)
+
+
+class ConcurrencySchedulingTests(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client()
+        self.client.testing = True
+        self.tmp = tempfile.mkdtemp()
+        self.original_db = app.config['LIBRARY_DB']
+        app.config['LIBRARY_DB'] = os.path.join(self.tmp, 'library.db')
+        self.patches = [patch('app.domain_concurrency', {}), patch('app.global_concurrency', ConcurrencyController(3, 16))]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        app.config['LIBRARY_DB'] = self.original_db
+        shutil.rmtree(self.tmp)
+
+    def test_url_domain(self):
+        self.assertEqual(url_domain('https://www.YouTube.com/watch?v=x'), 'youtube.com')
+        self.assertEqual(url_domain('https://m.youtube.com/watch?v=x'), 'm.youtube.com')
+
+    def test_saturated_domain_lets_other_domains_go_first(self):
+        a1, a2, b1 = (create_job(url, self.tmp, ['yt-dlp'], False) for url in
+                      ('https://a.test/1', 'https://a.test/2', 'https://b.test/1'))
+        with patch('app.pending_jobs', deque([a1, a2, b1])), patch('app.running_job_ids', {'x'}), \
+                patch('app.running_by_domain', Counter({'a.test': 1})):
+            app_module.domain_concurrency['a.test'] = ConcurrencyController(1, 8)
+            self.assertIs(_next_dispatchable_job(), b1)
+            app_module.global_concurrency.limit = 1
+            self.assertIsNone(_next_dispatchable_job())
+
+    def test_throttled_download_cuts_its_domain_limit(self):
+        with patch('app.YT_DLP_BINARY', FAKE_YT_DLP):
+            response = self.client.post('/start_download', json={
+                'url': 'https://fake.test/watch?v=slow&duration=0.2&fail=throttled', 'format': 'mp4',
+                'output_dir': os.path.join(self.tmp, 'downloads')
+            })
+            job = jobs[response.get_json()['job_id']]
+            deadline = time.time() + 10
+            while job['status'] == 'running' and time.time() < deadline:
+                time.sleep(0.02)
+        job['retry_timer'].cancel()
+        adjust_concurrency()
+
+        state = self.client.get('/concurrency').get_json()
+        self.assertTrue(state['adaptive'])
+        domain = state['domains']['fake.test']
+        self.assertEqual(domain['limit'], 1)
+        self.assertEqual(domain['decisions'][-1]['action'], 'decrease')
+        self.assertIn('Too Many Requests', domain['decisions'][-1]['reason'])
+        self.assertGreater(domain['decisions'][-1]['throughput'], 0)
+        self.assertEqual(state['global']['limit'], 3)  # other sites are not held back
+
+        with patch('app.ADAPTIVE_CONCURRENCY', False), patch('app.MAX_CONCURRENT_DOWNLOADS', 2):
+            self.assertEqual(self.client.get('/concurrency').get_json()['global']['limit'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
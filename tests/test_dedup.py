@@ -0,0 +1,80 @@
+import unittest
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from app import app, deduplicate_files, get_library_db, _library_lock
+from unittest.mock import patch
+
+
+class DeduplicationTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.original_db = app.config['LIBRARY_DB']
+        app.config['LIBRARY_DB'] = os.path.join(self.tmp, 'library.db')
+        self.pool = ThreadPoolExecutor(max_workers=2)
+        self.content = os.urandom(5000)
+
+    def tearDown(self):
+        self.pool.shutdown()
+        app.config['LIBRARY_DB'] = self.original_db
+        shutil.rmtree(self.tmp)
+
+    def write(self, relative_path, content):
+        path = os.path.join(self.tmp, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def test_duplicate_is_replaced_with_hard_link(self):
+        original = self.write('folder_a/Video.mp4', self.content)
+        self.assertEqual(deduplicate_files([original], self.pool), 0)
+
+        copy = self.write('Playlist/Video.mp4', self.content)
+        self.assertEqual(deduplicate_files([copy], self.pool), len(self.content))
+        self.assertTrue(os.path.samefile(original, copy))
+        with open(copy, 'rb') as f:
+            self.assertEqual(f.read(), self.content)
+
+        # Running again finds the files already linked
+        self.assertEqual(deduplicate_files([copy], self.pool), 0)
+
+    def test_only_released_bytes_are_counted(self):
+        original = self.write('folder_a/Video.mp4', self.content)
+        deduplicate_files([original], self.pool)
+        copy = self.write('folder_b/Video.mp4', self.content)
+        os.makedirs(os.path.join(self.tmp, 'cache'))
+        os.link(copy, os.path.join(self.tmp, 'cache', 'Video.mp4'))  # e.g. an artifact cache entry
+
+        self.assertEqual(deduplicate_files([copy], self.pool), 0)
+        self.assertTrue(os.path.samefile(original, copy))
+
+    def test_same_prefilter_but_different_content_is_kept(self):
+        # Same size, same first/last bytes: only the full hash tells them apart
+        with patch('app.DEDUP_SAMPLE_BYTES', 100):
+            middle_changed = self.content[:2500] + bytes([self.content[2500] ^ 0xFF]) + self.content[2501:]
+            first = self.write('a/Video.mp4', self.content)
+            second = self.write('b/Video.mp4', middle_changed)
+            deduplicate_files([first], self.pool)
+            self.assertEqual(deduplicate_files([second], self.pool), 0)
+        self.assertFalse(os.path.samefile(first, second))
+        with _library_lock:
+            hashes = get_library_db().execute("SELECT full_hash FROM content_hashes").fetchall()
+        self.assertEqual(len({row['full_hash'] for row in hashes}), 2)
+
+    def test_non_media_files_are_ignored(self):
+        first = self.write('a/Video.info.json', b'{}')
+        second = self.write('b/Video.info.json', b'{}')
+        deduplicate_files([first], self.pool)
+        self.assertEqual(deduplicate_files([second], self.pool), 0)
+        self.assertFalse(os.path.samefile(first, second))
+
+    def test_stale_index_entries_are_dropped(self):
+        original = self.write('a/Video.mp4', self.content)
+        deduplicate_files([original], self.pool)
+        self.write('a/Video.mp4', os.urandom(5000))  # replaced since it was hashed
+        os.utime(original, (0, 0))
+        copy = self.write('b/Video.mp4', self.content)
+        self.assertEqual(deduplicate_files([copy], self.pool), 0)
+        self.assertFalse(os.path.samefile(original, copy))
@@ -0,0 +1,78 @@
+import unittest
+import json
+import os
+import shutil
+import tempfile
+import time
+from app import app, jobs, get_library_db, split_deferred_metadata, build_metadata_command, _library_lock
+from loadtest.harness import FAKE_YT_DLP
+from unittest.mock import patch
+
+
+class DeferredMetadataTests(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client()
+        self.client.testing = True
+        self.tmp = tempfile.mkdtemp()
+        self.output_dir = os.path.join(self.tmp, 'downloads')
+        self.original_db = app.config['LIBRARY_DB']
+        app.config['LIBRARY_DB'] = os.path.join(self.tmp, 'library.db')
+
+    def tearDown(self):
+        app.config['LIBRARY_DB'] = self.original_db
+        shutil.rmtree(self.tmp)
+
+    def test_split_moves_sidecar_options_out_of_the_download(self):
+        options, flags, deferred = split_deferred_metadata(
+            {'comments': True, 'thumbnail': False, 'sponsorblock': True, 'defer_metadata': True},
+            ['--write-subs', '--limit-rate', '1M'])
+        self.assertEqual(options, {'sponsorblock': True, 'defer_metadata': True})
+        self.assertEqual(flags, ['--limit-rate', '1M'])
+        self.assertEqual(deferred, {'comments', 'subtitles'})
+
+        command = build_metadata_command('https://example.com/v', '/media', True, deferred, None, flags)
+        self.assertEqual(command[:4], ['yt-dlp', '--skip-download', '-o',
+                                       '/media/%(playlist_title)s/%(title)s/%(title)s.%(ext)s'])
+        for flag in ('--write-comments', '--write-info-json', '--write-subs', '--write-auto-subs', '--limit-rate'):
+            self.assertIn(flag, command)
+        self.assertEqual(command[-1], 'https://example.com/v')
+
+    def test_sidecars_are_fetched_after_the_media(self):
+        with patch('app.YT_DLP_BINARY', FAKE_YT_DLP):
+            response = self.client.post('/start_download', json={
+                'url': 'https://fake.test/watch?v=meta&duration=0.1&size=1024', 'format': 'mp4',
+                'output_dir': self.output_dir,
+                'download_options': {'comments': True, 'description': True, 'defer_metadata': True},
+            })
+            job = jobs[response.get_json()['job_id']]
+            deadline = time.time() + 10
+            while job['deferred_metadata']['status'] not in ('finished', 'failed') and time.time() < deadline:
+                time.sleep(0.02)
+
+        self.assertEqual(job['status'], 'finished')
+        self.assertNotIn('--write-comments', job['command'])
+        media = os.path.join(self.output_dir, 'Fake Video meta.mp4')
+        self.assertEqual(job['files'], [media])
+
+        metadata = job['deferred_metadata']
+        self.assertEqual(metadata['status'], 'finished')
+        self.assertEqual(metadata['options'], ['comments', 'description'])
+        folder = os.path.join(self.output_dir, 'Fake Video meta')
+        self.assertEqual(sorted(metadata['files']), [os.path.join(folder, 'Fake Video meta.description'),
+                                                     os.path.join(folder, 'Fake Video meta.info.json')])
+        with open(os.path.join(folder, 'Fake Video meta.info.json')) as f:
+            self.assertIn('comments', json.load(f))
+        self.assertEqual([p['job_class'] for p in job['processes']], ['download', 'metadata'])
+        self.assertIn('metadata', [phase['phase'] for phase in job['timeline']])
+
+        log = self.client.get(f"/jobs/{job['id']}/log").get_data(as_text=True)
+        self.assertIn('[info] Writing video metadata as JSON to:', log)
+
+        # The library entry picked up the info JSON that arrived after the media
+        with _library_lock:
+            row = get_library_db().execute("SELECT url FROM media WHERE path = ?", (media,)).fetchone()
+        self.assertEqual(row['url'], 'https://fake.test/watch?v=meta&duration=0.1&size=1024')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import unittest
+import os
+import shutil
+import tempfile
+from app import app, create_job
+
+
+class FileServingTests(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client()
+        self.client.testing = True
+        self.tmp = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmp, 'downloads')
+        os.makedirs(os.path.join(self.root, 'Playlist'))
+        self.original_root = app.config['DOWNLOAD_FOLDER']
+        app.config['DOWNLOAD_FOLDER'] = self.root
+        self.media_path = os.path.join(self.root, 'Playlist', 'Video.mp4')
+        with open(self.media_path, 'wb') as f:
+            f.write(bytes(range(256)) * 4)
+
+    def tearDown(self):
+        app.config['DOWNLOAD_FOLDER'] = self.original_root
+        shutil.rmtree(self.tmp)
+
+    def test_serves_whole_file_with_cache_headers(self):
+        response = self.client.get('/files/Playlist/Video.mp4')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), 1024)
+        self.assertEqual(response.headers['Accept-Ranges'], 'bytes')
+        self.assertIn('ETag', response.headers)
+        self.assertIn('Last-Modified', response.headers)
+        response.close()
+
+    def test_range_request(self):
+        response = self.client.get('/files/Playlist/Video.mp4', headers={'Range': 'bytes=10-19'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.data, bytes(range(10, 20)))
+        self.assertEqual(response.headers['Content-Range'], 'bytes 10-19/1024')
+        response.close()
+
+    def test_if_range_with_stale_etag_sends_full_file(self):
+        response = self.client.get('/files/Playlist/Video.mp4',
+                                   headers={'Range': 'bytes=10-19', 'If-Range': '"stale"'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), 1024)
+        response.close()
+
+    def test_conditional_get_returns_not_modified(self):
+        etag = self.client.get('/files/Playlist/Video.mp4').headers['ETag']
+        response = self.client.get('/files/Playlist/Video.mp4', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+    def test_paths_outside_download_root_are_rejected(self):
+        outside = os.path.join(self.tmp, 'secret.txt')
+        with open(outside, 'w') as f:
+            f.write('secret')
+        os.symlink(outside, os.path.join(self.root, 'link.txt'))
+        for path in ('/files/../secret.txt', '/files/%2e%2e/secret.txt', '/files/link.txt', '/files/Playlist'):
+            with self.subTest(path=path):
+                self.assertEqual(self.client.get(path).status_code, 404)
+
+    def test_serves_job_file(self):
+        job = create_job('https://www.youtube.com/watch?v=abc', self.root, ['yt-dlp'], False)
+        job['files'] = [self.media_path]
+        response = self.client.get(f"/files/job/{job['id']}", headers={'Range': 'bytes=0-3'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.data, bytes(range(4)))
+        response.close()
+
+        job['files'].append(os.path.join(self.tmp, 'outside.mp4'))
+        self.assertEqual(self.client.get(f"/files/job/{job['id']}?index=1").status_code, 404)
@@ -0,0 +1,89 @@
+import unittest
+from app import app, jobs, plan_format, build_format_command, observe_format_path, DOWNLOAD_FOLDER
+from unittest.mock import patch, MagicMock
+
+VP9_ONLY = [
+    {'format_id': '248', 'vcodec': 'vp9', 'acodec': 'none', 'ext': 'webm'},
+    {'format_id': '251', 'vcodec': 'none', 'acodec': 'opus', 'ext': 'webm'},
+]
+WITH_H264_AAC = VP9_ONLY + [
+    {'format_id': '137', 'vcodec': 'avc1.640028', 'acodec': 'none', 'ext': 'mp4'},
+    {'format_id': '140', 'vcodec': 'none', 'acodec': 'mp4a.40.2', 'ext': 'm4a'},
+]
+
+
+class FormatPlannerTests(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client()
+        self.client.testing = True
+
+    def test_mp4_prefers_stream_copyable_codecs(self):
+        args = build_format_command('mp4')
+        self.assertEqual(args[args.index('-S') + 1], 'res,vcodec:h264,acodec:aac')
+        self.assertIn('--merge-output-format', args)
+        self.assertNotIn('--recode-video', args)
+
+    def test_codec_preference_does_not_outrank_resolution(self):
+        for format_type in ('mp4', 'webm', 'avi'):
+            with self.subTest(format_type=format_type):
+                args = build_format_command(format_type)
+                self.assertEqual(args[args.index('-S') + 1].split(',')[0], 'res')
+        args = build_format_command('flv')
+        self.assertTrue(args[args.index('-S') + 1].startswith('vcodec:h264'))
+
+    def test_m4a_selects_aac_and_copies_when_available(self):
+        plan = plan_format('m4a', WITH_H264_AAC)
+        self.assertEqual(plan['strategy'], 'copy')
+        self.assertTrue(plan['args'][plan['args'].index('-f') + 1].startswith('ba[acodec^=mp4a]'))
+        self.assertEqual(plan_format('m4a', VP9_ONLY)['strategy'], 'transcode')
+
+    def test_mp3_transcodes_without_mp3_source(self):
+        plan = plan_format('mp3', WITH_H264_AAC)
+        self.assertEqual(plan['strategy'], 'transcode')
+        self.assertIn('--audio-format', plan['args'])
+
+    def test_avi_recodes_only_when_no_compatible_streams(self):
+        self.assertEqual(plan_format('avi', WITH_H264_AAC)['strategy'], 'copy')
+        plan = plan_format('avi', VP9_ONLY)
+        self.assertEqual(plan['strategy'], 'transcode')
+        self.assertIn('--recode-video', plan['args'])
+
+    def test_webm_transcodes_without_webm_codecs(self):
+        self.assertEqual(plan_format('webm', VP9_ONLY)['strategy'], 'copy')
+        plan = plan_format('webm', WITH_H264_AAC[2:])
+        self.assertEqual(plan['strategy'], 'transcode')
+        self.assertEqual(plan['args'][plan['args'].index('--recode-video') + 1], 'webm')
+        self.assertEqual(plan_format('mp4', VP9_ONLY)['strategy'], 'copy')
+
+    def test_mkv_always_copies(self):
+        self.assertEqual(plan_format('mkv', VP9_ONLY)['strategy'], 'copy')
+
+    def test_observe_format_path(self):
+        job = {'format': 'm4a', 'format_path': None}
+        observe_format_path(job, '[ExtractAudio] Destination: Song.m4a', 'm4a')
+        self.assertEqual(job['format_path'], 'copy')
+
+        job = {'format': 'mp3', 'format_path': None}
+        observe_format_path(job, '[ExtractAudio] Destination: Song.mp3', 'webm')
+        self.assertEqual(job['format_path'], 'transcode')
+
+        job = {'format': 'mp4', 'format_path': None}
+        observe_format_path(job, '[Merger] Merging formats into "Video.mp4"', 'm4a')
+        self.assertEqual(job['format_path'], 'copy')
+
+    def test_job_records_plan_and_path(self):
+        with patch('app.subprocess.Popen') as mock_popen:
+            mock_proc = MagicMock()
+            mock_proc.stdout = iter([
+                "[download] Destination: Song.m4a\n",
+                "[ExtractAudio] Destination: Song.m4a\n",
+            ])
+            mock_proc.wait.return_value = 0
+            mock_popen.return_value = mock_proc
+            response = self.client.post('/start_download', json={
+                'url': 'https://www.youtube.com/watch?v=planner', 'format': 'm4a', 'output_dir': DOWNLOAD_FOLDER
+            })
+            job = jobs[response.get_json()['job_id']]
+            job['thread'].join(timeout=5)
+        self.assertEqual(job['format_plan']['strategy'], 'auto')
+        self.assertEqual(job['format_path'], 'copy')
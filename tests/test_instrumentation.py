@@ -0,0 +1,79 @@
+import unittest
+import os
+import shutil
+import tempfile
+import tracemalloc
+from app import app, histogram_quantile, LATENCY_BUCKETS, _profiler_lock
+from unittest.mock import patch
+
+
+class InstrumentationTests(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client()
+        self.client.testing = True
+        self.tmp = tempfile.mkdtemp()
+        self.original_config = {key: app.config[key] for key in ('PROFILE_FOLDER', 'PROFILING_ENABLED', 'PROFILING_TOKEN')}
+        app.config['PROFILE_FOLDER'] = self.tmp
+
+    def tearDown(self):
+        app.config.update(self.original_config)
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        shutil.rmtree(self.tmp)
+
+    def test_latency_is_recorded_per_route(self):
+        self.client.post('/validate_url', json={'url': 'https://youtu.be/abc'})
+        self.client.get('/browse_directories?path=/nonexistent-path')
+        routes = self.client.get('/metrics').get_json()['routes']
+        self.assertGreaterEqual(routes['/validate_url']['count'], 1)
+        self.assertGreaterEqual(routes['/browse_directories']['count'], 1)
+        self.assertLessEqual(routes['/validate_url']['p50_seconds'], routes['/validate_url']['max_seconds'])
+
+    def test_prometheus_format(self):
+        self.client.get('/')
+        body = self.client.get('/metrics?format=prometheus').get_data(as_text=True)
+        self.assertIn('http_request_duration_seconds_bucket{route="/",le="+Inf"}', body)
+        self.assertIn('http_request_duration_seconds_count{route="/"}', body)
+
+    def test_histogram_quantile(self):
+        buckets = [0] * len(LATENCY_BUCKETS)
+        buckets[0] = 90   # <= 1ms
+        buckets[6] = 10   # <= 100ms
+        self.assertEqual(histogram_quantile(buckets, 100, 0.5), LATENCY_BUCKETS[0])
+        self.assertEqual(histogram_quantile(buckets, 100, 0.95), LATENCY_BUCKETS[6])
+
+    def test_profiling_is_off_by_default(self):
+        response = self.client.get('/?profile=1')
+        self.assertNotIn('X-Profile-Id', response.headers)
+        self.assertEqual(os.listdir(self.tmp), [])
+        self.assertEqual(self.client.get('/debug/tracemalloc').status_code, 403)
+
+    def test_profiling_requires_token(self):
+        app.config.update(PROFILING_ENABLED=True, PROFILING_TOKEN='secret')
+        self.assertNotIn('X-Profile-Id', self.client.get('/', headers={'X-Profile': 'wrong'}).headers)
+
+        response = self.client.get('/', headers={'X-Profile': 'secret'})
+        profile_id = response.headers['X-Profile-Id']
+        self.assertTrue(os.path.isfile(os.path.join(self.tmp, f'{profile_id}.prof')))
+
+        report = self.client.get(f'/debug/profiles/{profile_id}', headers={'X-Profile': 'secret'})
+        self.assertEqual(report.status_code, 200)
+        self.assertIn('function calls', report.get_data(as_text=True))
+
+    def test_profiler_is_released_when_a_view_raises(self):
+        app.config.update(PROFILING_ENABLED=True, PROFILING_TOKEN=None)
+        with patch.dict(app.config, PROPAGATE_EXCEPTIONS=True), \
+                patch('app.render_template', side_effect=RuntimeError('boom')):
+            with self.assertRaises(RuntimeError):
+                self.client.get('/?profile=1')
+        self.assertFalse(_profiler_lock.locked())
+        self.assertIn('X-Profile-Id', self.client.get('/?profile=1').headers)
+
+    def test_tracemalloc_snapshots(self):
+        app.config.update(PROFILING_ENABLED=True)
+        self.assertTrue(self.client.get('/debug/tracemalloc').get_json()['tracing'])
+        data = self.client.get('/debug/tracemalloc?limit=5').get_json()
+        self.assertLessEqual(len(data['top']), 5)
+        self.assertIn('growth', data)
+        self.assertFalse(self.client.post('/debug/tracemalloc', json={'stop': True}).get_json()['tracing'])
+        self.assertFalse(tracemalloc.is_tracing())
@@ -0,0 +1,105 @@
+import unittest
+import os
+import shutil
+import tempfile
+import time
+from app import app, LogBuffer, JobLogWriter, iter_job_log, prune_job_logs, create_job, jobs, DOWNLOAD_FOLDER
+from unittest.mock import patch, MagicMock
+
+
+class JobLogTests(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client()
+        self.client.testing = True
+        self.tmp = tempfile.mkdtemp()
+        self.original_log_folder = app.config['LOG_FOLDER']
+        app.config['LOG_FOLDER'] = self.tmp
+
+    def tearDown(self):
+        app.config['LOG_FOLDER'] = self.original_log_folder
+        shutil.rmtree(self.tmp)
+
+    def start_mocked_download(self, mock_lines):
+        with patch('app.subprocess.Popen') as mock_popen:
+            mock_proc = MagicMock()
+            mock_proc.stdout = iter(mock_lines)
+            mock_popen.return_value = mock_proc
+            response = self.client.post('/start_download', json={
+                'url': 'https://www.youtube.com/watch?v=joblogs',
+                'format': 'mp4',
+                'output_dir': DOWNLOAD_FOLDER,
+            })
+            job_id = response.get_json()['job_id']
+            jobs[job_id]['thread'].join(timeout=5)
+        return job_id
+
+    def test_ring_buffer_is_bounded(self):
+        buffer = LogBuffer(3)
+        for i in range(10):
+            buffer.append(f"line {i}")
+        lines, next_seq = buffer.read_since(0, timeout=0)
+        self.assertEqual(lines, ['line 7', 'line 8', 'line 9'])
+        self.assertEqual(next_seq, 10)
+        self.assertEqual(buffer.read_since(9, timeout=0)[0], ['line 9'])
+
+    def test_full_output_is_persisted_and_paged(self):
+        mock_lines = [f"[youtube] line {i}\n" for i in range(5)] + ["ERROR: something broke\n"]
+        job_id = self.start_mocked_download(mock_lines)
+
+        response = self.client.get(f'/jobs/{job_id}/log?offset=1&limit=2')
+        self.assertEqual(response.status_code, 200)
+        data = response.get_json()
+        self.assertEqual(data['lines'], ['[youtube] line 1', '[youtube] line 2'])
+        self.assertEqual(data['next_offset'], 3)
+
+        data = self.client.get(f'/jobs/{job_id}/log?tail=1').get_json()
+        self.assertEqual(data['lines'], ['ERROR: something broke'])
+
+    def test_log_readable_after_job_is_forgotten(self):
+        job_id = self.start_mocked_download(["[info] hello\n"])
+        jobs.pop(job_id)
+        data = self.client.get(f'/jobs/{job_id}/log').get_json()
+        self.assertEqual(data['lines'], ['[info] hello'])
+
+    def test_unknown_job_log(self):
+        self.assertEqual(self.client.get('/jobs/deadbeef/log').status_code, 404)
+        self.assertEqual(self.client.get('/jobs/../log').status_code, 404)
+
+    def test_log_rotation_keeps_newest_segments(self):
+        with patch('app.LOG_ROTATE_BYTES', 20), patch('app.LOG_MAX_SEGMENTS', 2):
+            writer = JobLogWriter('rotation')
+            for i in range(10):
+                writer.write(f"line number {i:02d}")
+            writer.close()
+        segments = [name for name in os.listdir(self.tmp) if name.startswith('rotation.')]
+        self.assertEqual(len(segments), 2)
+        self.assertEqual(list(iter_job_log('rotation')), [f'line number {i:02d}' for i in range(6, 10)])
+
+    def test_old_job_logs_are_pruned(self):
+        now = time.time()
+        for i, job_id in enumerate(['oldest', 'older', 'newer', 'newest']):
+            writer = JobLogWriter(job_id)
+            writer.write('[info] done')
+            writer.close()
+            for path in os.listdir(self.tmp):
+                if path.startswith(f'{job_id}.'):
+                    os.utime(os.path.join(self.tmp, path), (now - 100 + i, now - 100 + i))
+        running = create_job('https://example.com/v', self.tmp, [], False)
+        running['log_writer'].write('[info] still going')
+        os.utime(running['log_writer']._segment_path(running['log_writer'].segment), (now - 1000, now - 1000))
+        try:
+            with patch('app.LOG_RETENTION_JOBS', 3), patch('app.LOG_RETENTION_SECONDS', 98.5):
+                prune_job_logs(now)
+            remaining = {name.split('.', 1)[0] for name in os.listdir(self.tmp)}
+            self.assertEqual(remaining, {'newer', 'newest', running['id']})
+        finally:
+            running['log_writer'].close()
+            jobs.pop(running['id'])
+
+    def test_stream_logs_replays_job_events(self):
+        job_id = self.start_mocked_download(["[info] Extracting URL\n"])
+        response = self.client.get(f'/stream_logs?job_id={job_id}')
+        body = response.get_data(as_text=True)
+        self.assertIn('data: INFO::[info] Extracting URL', body)
+        self.assertTrue(body.endswith('data: [DONE]\n\n'))
+        self.assertIn(jobs[job_id]['status'], ('finished', 'failed'))
@@ -0,0 +1,104 @@
+import unittest
+import json
+import os
+import shutil
+import tempfile
+import app as app_module
+from app import app, index_media_files, scan_library, get_library_db, _library_lock
+
+
+class LibraryIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client()
+        self.client.testing = True
+        self.tmp = tempfile.mkdtemp()
+        self.original_db = app.config['LIBRARY_DB']
+        app.config['LIBRARY_DB'] = os.path.join(self.tmp, 'library.db')
+        self.root = os.path.join(self.tmp, 'downloads')
+        os.makedirs(self.root)
+
+    def tearDown(self):
+        app.config['LIBRARY_DB'] = self.original_db
+        shutil.rmtree(self.tmp)
+
+    def make_video(self, folder, title, uploader='Some Channel', duration=212):
+        """Create a media file plus organized info.json sidecar like move_media_files_up_and_metadata_down leaves them."""
+        os.makedirs(os.path.join(folder, title), exist_ok=True)
+        media_path = os.path.join(folder, f"{title}.mp4")
+        with open(media_path, 'wb') as f:
+            f.write(b'\x00' * 16)
+        with open(os.path.join(folder, title, f"{title}.info.json"), 'w') as f:
+            json.dump({
+                'title': title,
+                'uploader': uploader,
+                'duration': duration,
+                'format': '137 - 1920x1080 (1080p)+140 - audio only',
+                'webpage_url': f'https://www.youtube.com/watch?v={title[:4]}',
+                'extractor_key': 'Youtube',
+                'id': title[:4],
+            }, f)
+        return media_path
+
+    def test_index_media_files_and_search(self):
+        media_path = self.make_video(self.root, 'Never Gonna Give You Up')
+        self.assertEqual(index_media_files([media_path]), 1)
+        # Unchanged files are skipped on re-index
+        self.assertEqual(index_media_files([media_path]), 0)
+
+        response = self.client.get('/library/search?q=gonna give')
+        self.assertEqual(response.status_code, 200)
+        items = response.get_json()['items']
+        self.assertEqual(len(items), 1)
+        self.assertEqual(items[0]['uploader'], 'Some Channel')
+        self.assertEqual(items[0]['duration'], 212)
+
+        response = self.client.get('/library/search?q=gonna&max_duration=100')
+        self.assertEqual(response.get_json()['items'], [])
+
+    def test_search_requires_query(self):
+        response = self.client.get('/library/search?q=')
+        self.assertEqual(response.status_code, 400)
+
+    def test_scan_library_and_list_pagination(self):
+        playlist = os.path.join(self.root, 'My Playlist')
+        for i in range(3):
+            self.make_video(playlist, f'Episode {i}')
+        self.make_video(self.root, 'Standalone')
+
+        self.assertEqual(scan_library(self.root), 4)
+
+        first = self.client.get('/library?limit=2').get_json()
+        self.assertEqual(len(first['items']), 2)
+        second = self.client.get(f"/library?limit=2&before_id={first['next_before_id']}").get_json()
+        self.assertEqual(len(second['items']), 2)
+        paths = {item['path'] for item in first['items'] + second['items']}
+        self.assertEqual(len(paths), 4)
+
+    def test_scan_removes_deleted_files(self):
+        media_path = self.make_video(self.root, 'Short Lived')
+        scan_library(self.root)
+        os.remove(media_path)
+        scan_library(self.root)
+        self.assertEqual(self.client.get('/library').get_json()['items'], [])
+
+    def test_interrupted_scan_resumes_after_cursor(self):
+        first_dir = os.path.join(self.root, 'A')
+        second_dir = os.path.join(self.root, 'B')
+        self.make_video(first_dir, 'First')
+        self.make_video(second_dir, 'Second')
+
+        # Simulate a scan that stopped right after finishing directory A
+        with _library_lock:
+            conn = get_library_db()
+            with conn:
+                conn.execute("INSERT INTO scan_state (root, cursor, files_indexed, started_at, finished_at) "
+                             "VALUES (?, ?, 0, 0, NULL)", (os.path.abspath(self.root), first_dir))
+
+        scan_library(self.root)
+        titles = {item['title'] for item in self.client.get('/library').get_json()['items']}
+        self.assertEqual(titles, {'Second'})
+
+    def test_scan_endpoint_rejects_missing_path(self):
+        response = self.client.post('/library/scan', json={'path': os.path.join(self.tmp, 'nope')})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(app_module.library_scan_status['running'])
@@ -0,0 +1,65 @@
+import unittest
+import os
+import shutil
+import tempfile
+import time
+from app import app, jobs
+from loadtest.harness import FAKE_YT_DLP, percentile, slope
+from unittest.mock import patch
+
+
+class FakeYtDlpTests(unittest.TestCase):
+    """The load harness stub must produce output the real job runner understands."""
+
+    def setUp(self):
+        self.client = app.test_client()
+        self.client.testing = True
+        self.tmp = tempfile.mkdtemp()
+        self.output_dir = os.path.join(self.tmp, 'downloads')
+        self.original_db = app.config['LIBRARY_DB']
+        app.config['LIBRARY_DB'] = os.path.join(self.tmp, 'library.db')
+
+    def tearDown(self):
+        app.config['LIBRARY_DB'] = self.original_db
+        shutil.rmtree(self.tmp)
+
+    def run_job(self, url):
+        with patch('app.YT_DLP_BINARY', FAKE_YT_DLP):
+            response = self.client.post('/start_download', json={'url': url, 'format': 'mp4', 'output_dir': self.output_dir})
+        job = jobs[response.get_json()['job_id']]
+        deadline = time.time() + 10
+        while job['status'] in ('queued', 'running') and time.time() < deadline:
+            time.sleep(0.02)
+        return job
+
+    def test_single_video_runs_through_the_job_runner(self):
+        job = self.run_job('https://fake.test/watch?v=unit&duration=0.2&size=4096')
+        self.assertEqual(job['status'], 'finished')
+        self.assertEqual(job['files'], [os.path.join(self.output_dir, 'Fake Video unit.mp4')])
+        self.assertEqual(os.path.getsize(job['files'][0]), 4096)
+        self.assertTrue(any(line.startswith('PROGRESS::100.0') for line in job['log'].read_since(0, timeout=0)[0]))
+        downloading = [p for p in job['timeline'] if p['phase'] == 'downloading']
+        self.assertAlmostEqual(sum(p['bytes'] for p in downloading), 4096, delta=1)
+
+    def test_injected_failure_is_classified(self):
+        job = self.run_job('https://fake.test/watch?v=gone&duration=0.1&fail=unavailable')
+        self.assertEqual(job['status'], 'failed')
+        self.assertEqual([e['class'] for e in job['errors']], ['unavailable'])
+
+
+class ReportMathTests(unittest.TestCase):
+    def test_percentile_is_nearest_rank(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile(values, 100), 100)
+        self.assertEqual(percentile([7], 90), 7)
+        self.assertIsNone(percentile([], 50))
+
+    def test_slope_of_steady_growth(self):
+        self.assertAlmostEqual(slope([(t, 100 + 2 * t) for t in range(10)]), 2.0)
+        self.assertEqual(slope([(0, 5)]), 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
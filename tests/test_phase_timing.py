@@ -0,0 +1,79 @@
+import unittest
+from app import app, jobs, detect_phase, parse_size, DOWNLOAD_FOLDER
+from unittest.mock import patch, MagicMock
+
+
+class PhaseTimingTests(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client()
+        self.client.testing = True
+
+    def run_mocked_job(self, mock_lines):
+        with patch('app.subprocess.Popen') as mock_popen:
+            mock_proc = MagicMock()
+            mock_proc.stdout = iter(mock_lines)
+            mock_proc.wait.return_value = 0
+            mock_popen.return_value = mock_proc
+            response = self.client.post('/start_download', json={
+                'url': 'https://www.youtube.com/watch?v=phases', 'format': 'mp4', 'output_dir': DOWNLOAD_FOLDER
+            })
+            job = jobs[response.get_json()['job_id']]
+            job['thread'].join(timeout=5)
+        return job
+
+    def test_detect_phase(self):
+        cases = {
+            '[youtube] abc: Downloading webpage': 'extracting',
+            '[youtube:tab] Extracting URL': 'extracting',
+            '[info] abc: Downloading 1 format(s): 137+140': 'extracting',
+            '[info] Writing video description to: x.description': 'writing_metadata',
+            '[download] Destination: x.f137.mp4': 'downloading',
+            '[download]  42.0% of 10.00MiB at 1.00MiB/s ETA 00:05': 'downloading',
+            '[Merger] Merging formats into "x.mp4"': 'merging',
+            '[SponsorBlock] Found 2 segments': 'sponsorblock',
+            '[ModifyChapters] Removing chapters from x.mp4': 'sponsorblock',
+            '[EmbedThumbnail] ffmpeg: Adding thumbnail': 'embedding',
+            '[ExtractAudio] Destination: x.mp3': 'converting',
+            'Deleting original file x.f137.mp4': None,
+        }
+        for line, expected in cases.items():
+            with self.subTest(line=line):
+                self.assertEqual(detect_phase(line), expected)
+
+    def test_parse_size(self):
+        self.assertEqual(parse_size('10.00MiB'), 10 * 1024 ** 2)
+        self.assertEqual(parse_size('~ 1.5GiB'), 1.5 * 1024 ** 3)
+        self.assertEqual(parse_size('2.00KiB/s'), 2048)
+        self.assertIsNone(parse_size('Unknown'))
+
+    def test_job_timeline_records_phases_in_order(self):
+        job = self.run_mocked_job([
+            "[youtube] phases: Downloading webpage\n",
+            "[download] Destination: phases.f137.mp4\n",
+            "[download]  50.0% of 10.00MiB at 1.00MiB/s ETA 00:05\n",
+            "[download] 100.0% of 10.00MiB at 1.00MiB/s ETA 00:00\n",
+            "[download] Destination: phases.f140.m4a\n",
+            "[download] 100.0% of 2.00MiB at 1.00MiB/s ETA 00:00\n",
+            '[Merger] Merging formats into "phases.mp4"\n',
+            "[EmbedThumbnail] ffmpeg: Adding thumbnail\n",
+        ])
+
+        phases = [entry['phase'] for entry in job['timeline']]
+        self.assertEqual(phases[:6], ['extracting', 'downloading', 'merging', 'embedding', 'organizing', 'indexing'])
+        downloading = job['timeline'][1]
+        self.assertEqual(downloading['bytes'], 12 * 1024 ** 2)
+        self.assertGreaterEqual(downloading['wall_seconds'], 0)
+
+        response = self.client.get(f"/jobs/{job['id']}/timeline")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['totals']['downloading']['bytes'], 12 * 1024 ** 2)
+
+    def test_aggregate_timeline(self):
+        self.run_mocked_job(["[youtube] phases: Downloading webpage\n"])
+        summary = self.client.get('/jobs/timeline').get_json()['phases']
+        self.assertIn('extracting', summary)
+        self.assertGreaterEqual(summary['extracting']['count'], 1)
+        self.assertLessEqual(sum(p['wall_share'] for p in summary.values()), 1.0001)
+
+    def test_unknown_job_timeline(self):
+        self.assertEqual(self.client.get('/jobs/nope/timeline').status_code, 404)
@@ -0,0 +1,111 @@
+import unittest
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from app import (app, jobs, create_job, spawn_supervised, reap_process, run_supervised, stop_stalled_processes,
+                 supervised_processes, PROCESS_LIMITS)
+from loadtest.harness import FAKE_YT_DLP
+from unittest.mock import patch
+
+
+class ProcessSupervisorTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.job = create_job('https://fake.test/watch?v=sup', self.tmp, ['yt-dlp'], False)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_exit_code_and_rusage_are_recorded(self):
+        script = 'data = bytearray(64 * 1024 * 1024); sum(range(200000)); raise SystemExit(3)'
+        process = spawn_supervised([sys.executable, '-c', script], 'download')
+        self.assertEqual(reap_process(process, self.job), 3)
+        self.assertEqual(process.returncode, 3)
+        self.assertNotIn(process.pid, supervised_processes)
+        with self.assertRaises(ChildProcessError):
+            os.waitpid(process.pid, os.WNOHANG)  # already reaped, no zombie left behind
+
+        record = self.job['processes'][0]
+        self.assertEqual(record['returncode'], 3)
+        self.assertEqual(record['job_class'], 'download')
+        self.assertGreater(record['cpu_seconds'], 0)
+        self.assertGreater(record['max_rss_bytes'], 64 * 1024 * 1024)
+        self.assertFalse(record['stalled'])
+
+    def test_class_limits_are_applied(self):
+        script = ('import os, resource, time; time.sleep(0.3); '
+                  'print(os.getpriority(os.PRIO_PROCESS, 0), resource.getrlimit(resource.RLIMIT_NOFILE)[0])')
+        result = run_supervised([sys.executable, '-c', script], 'merge', job=self.job)
+        limits = PROCESS_LIMITS['merge']
+        self.assertEqual(result.stdout.split(), [str(limits['nice']), str(limits['max_open_files'])])
+        self.assertEqual(self.job['processes'][0]['job_class'], 'merge')
+
+    def test_memory_limit_caps_data_not_address_space(self):
+        # Reserving address space well beyond the cap (as V8 does) must still work
+        script = ('import mmap, resource, time; time.sleep(0.3); '
+                  'reserved = mmap.mmap(-1, 2 * resource.getrlimit(resource.RLIMIT_DATA)[0], prot=0); '
+                  'print(resource.getrlimit(resource.RLIMIT_DATA)[0], resource.getrlimit(resource.RLIMIT_AS)[0])')
+        result = run_supervised([sys.executable, '-c', script], 'probe', job=self.job)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.split(), [str(PROCESS_LIMITS['probe']['max_memory_bytes']),
+                                                 str(resource.RLIM_INFINITY)])
+
+    def test_timeout_kills_the_process_group(self):
+        script = 'import subprocess, sys, time; subprocess.Popen([sys.executable, "-c", "import time; time.sleep(30)"]); time.sleep(30)'
+        with self.assertRaises(subprocess.TimeoutExpired):
+            run_supervised([sys.executable, '-c', script], 'probe', job=self.job, timeout=0.5)
+        self.assertEqual(self.job['processes'][0]['returncode'], -9)
+
+
+class StallWatchdogTests(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client()
+        self.client.testing = True
+        self.tmp = tempfile.mkdtemp()
+        self.original_db = app.config['LIBRARY_DB']
+        app.config['LIBRARY_DB'] = os.path.join(self.tmp, 'library.db')
+
+    def tearDown(self):
+        app.config['LIBRARY_DB'] = self.original_db
+        shutil.rmtree(self.tmp)
+
+    def test_silent_download_is_stopped_and_retried(self):
+        # One progress line every 30 seconds: far slower than the stall timeout below
+        url = 'https://fake.test/watch?v=stuck&duration=300&rate=0.034'
+        with patch('app.YT_DLP_BINARY', FAKE_YT_DLP), patch('app.STALL_TIMEOUT_SECONDS', 0.3):
+            response = self.client.post('/start_download', json={
+                'url': url, 'format': 'mp4', 'output_dir': os.path.join(self.tmp, 'downloads')
+            })
+            job = jobs[response.get_json()['job_id']]
+            time.sleep(0.5)
+            stop_stalled_processes()
+            deadline = time.time() + 10
+            while job['status'] == 'running' and time.time() < deadline:
+                time.sleep(0.02)
+        job['retry_timer'].cancel()
+        self.assertEqual(job['status'], 'retry_scheduled')
+        self.assertEqual([e['class'] for e in job['errors']], ['stalled'])
+        self.assertEqual(job['retries'], {'stalled': 1})
+        self.assertTrue(job['processes'][0]['stalled'])
+
+    def test_silent_post_processing_is_not_a_stall(self):
+        url = 'https://fake.test/watch?v=merging&duration=0.1&merge=1'
+        with patch('app.YT_DLP_BINARY', FAKE_YT_DLP), patch('app.STALL_TIMEOUT_SECONDS', 0.3):
+            response = self.client.post('/start_download', json={
+                'url': url, 'format': 'mp4', 'output_dir': os.path.join(self.tmp, 'downloads')
+            })
+            job = jobs[response.get_json()['job_id']]
+            deadline = time.time() + 10
+            while job['status'] == 'running' and time.time() < deadline:
+                time.sleep(0.1)
+                stop_stalled_processes()
+        self.assertEqual(job['status'], 'finished', job['errors'])
+        self.assertFalse(job['processes'][0]['stalled'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+import unittest
+import time
+from app import (app, jobs, classify_error, plan_retry, backoff_delay, create_job, schedule_job, playlist_items,
+                 RETRY_POLICIES, DOWNLOAD_FOLDER)
+from unittest.mock import patch, MagicMock
+
+
+class RetryTests(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client()
+        self.client.testing = True
+
+    def run_mocked_job(self, url, mock_lines, returncode):
+        with patch('app.subprocess.Popen') as mock_popen:
+            mock_proc = MagicMock()
+            mock_proc.stdout = iter(mock_lines)
+            mock_proc.wait.return_value = returncode
+            mock_popen.return_value = mock_proc
+            response = self.client.post('/start_download', json={
+                'url': url, 'format': 'mp4', 'output_dir': DOWNLOAD_FOLDER
+            })
+            job = jobs[response.get_json()['job_id']]
+            deadline = time.time() + 5
+            while job['status'] in ('queued', 'running') and time.time() < deadline:
+                time.sleep(0.01)
+        return job
+
+    def test_classify_error(self):
+        cases = {
+            'ERROR: [youtube] abc: Unable to download webpage: HTTP Error 429: Too Many Requests': 'throttled',
+            'ERROR: unable to download video data: HTTP Error 403: Forbidden': 'forbidden',
+            'ERROR: [youtube] abc: The uploader has not made this video available in your country': 'geo_blocked',
+            'ERROR: [youtube] abc: Video unavailable': 'unavailable',
+            'ERROR: Postprocessing: Conversion failed!': 'ffmpeg',
+            'ERROR: [youtube] abc: Read timed out.': 'network',
+            'ERROR: something nobody has seen before': 'unknown',
+        }
+        for message, expected in cases.items():
+            with self.subTest(message=message):
+                self.assertEqual(classify_error(message), expected)
+
+    def test_backoff_delay_is_capped_and_jittered(self):
+        policy = RETRY_POLICIES['network']
+        for retry_number in range(10):
+            delay = backoff_delay(policy, retry_number)
+            cap = min(policy['max_delay'], policy['base_delay'] * 2 ** retry_number)
+            self.assertGreaterEqual(delay, cap / 2)
+            self.assertLessEqual(delay, cap)
+
+    def test_unavailable_video_is_not_retried(self):
+        job = self.run_mocked_job('https://www.youtube.com/watch?v=gone',
+                                  ["ERROR: [youtube] gone: Video unavailable\n"], 1)
+        self.assertEqual(job['status'], 'failed')
+        self.assertEqual(job['errors'][0]['class'], 'unavailable')
+        self.assertNotIn('retry_timer', job)
+
+    def test_throttled_job_is_rescheduled(self):
+        job = self.run_mocked_job('https://www.youtube.com/watch?v=throttled',
+                                  ["ERROR: HTTP Error 429: Too Many Requests\n"], 1)
+        job['retry_timer'].cancel()
+        self.assertEqual(job['status'], 'retry_scheduled')
+        self.assertEqual(job['retries'], {'throttled': 1})
+        self.assertGreater(job['retry_at'], time.time())
+
+    def test_playlist_retries_only_failed_entries(self):
+        command = ['yt-dlp', '--continue', '-o', 'x', 'https://www.youtube.com/playlist?list=abc']
+        job = create_job(command[-1], DOWNLOAD_FOLDER, command, True)
+        job['returncode'] = 1
+        job['errors'] = [
+            {'class': 'forbidden', 'message': 'HTTP Error 403', 'playlist_index': 2},
+            {'class': 'unavailable', 'message': 'Video unavailable', 'playlist_index': 3},
+            {'class': 'network', 'message': 'Read timed out', 'playlist_index': 5},
+        ]
+        delay, error_class, retry_command = plan_retry(job)
+        self.assertEqual(error_class, 'network')
+        self.assertEqual(retry_command[-1], command[-1])
+        self.assertIn('--no-cache-dir', retry_command)
+        items = retry_command[retry_command.index('--playlist-items') + 1]
+        self.assertEqual(items, '2,5')
+
+    def test_consecutive_playlist_retries_keep_the_real_index(self):
+        timeout = "ERROR: [youtube] x: Read timed out.\n"
+        job = self.run_mocked_job('https://www.youtube.com/playlist?list=twice', [
+            "[download] Downloading item 2 of 5\n", timeout,
+            "[download] Downloading item 5 of 5\n", timeout,
+        ], 1)
+        job['retry_timer'].cancel()
+        self.assertEqual(job['command'][job['command'].index('--playlist-items') + 1], '2,5')
+
+        # Second attempt: entry 5 fails again, and yt-dlp numbers it 2 of the 2 selected
+        with patch('app.subprocess.Popen') as mock_popen:
+            mock_proc = MagicMock()
+            mock_proc.stdout = iter(["[download] Downloading item 1 of 2\n", "[download] Downloading item 2 of 2\n", timeout])
+            mock_proc.wait.return_value = 1
+            mock_popen.return_value = mock_proc
+            schedule_job(job)
+            deadline = time.time() + 5
+            while job['status'] in ('queued', 'running') and time.time() < deadline:
+                time.sleep(0.01)
+        job['retry_timer'].cancel()
+        self.assertEqual(job['errors'][0]['playlist_index'], 5)
+        self.assertEqual(job['command'][job['command'].index('--playlist-items') + 1], '5')
+        self.assertEqual(job['retries'], {'network': 2})
+
+    def test_playlist_items_parsing(self):
+        self.assertEqual(playlist_items(['yt-dlp', '--playlist-items', '2,5-7', 'url']), [2, 5, 6, 7])
+        self.assertIsNone(playlist_items(['yt-dlp', 'url']))
+        self.assertIsNone(playlist_items(['yt-dlp', '-I', '::2', 'url']))
+
+    def test_retry_limit_is_enforced(self):
+        command = ['yt-dlp', 'https://www.youtube.com/watch?v=abc']
+        job = create_job(command[-1], DOWNLOAD_FOLDER, command, False)
+        job['returncode'] = 1
+        job['errors'] = [{'class': 'ffmpeg', 'message': 'Conversion failed', 'playlist_index': None}]
+        self.assertIsNotNone(plan_retry(job))
+        job['retries']['ffmpeg'] = RETRY_POLICIES['ffmpeg']['max_retries']
+        self.assertIsNone(plan_retry(job))
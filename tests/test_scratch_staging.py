@@ -0,0 +1,106 @@
+import unittest
+import os
+import shutil
+import tempfile
+import time
+from app import app, jobs, scratch_reservations, release_scratch, get_library_db, _library_lock
+from unittest.mock import patch, MagicMock
+
+
+class ScratchStagingTests(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client()
+        self.client.testing = True
+        self.tmp = tempfile.mkdtemp()
+        self.scratch = os.path.join(self.tmp, 'scratch')
+        self.output_dir = os.path.join(self.tmp, 'output')
+        self.original_config = {key: app.config[key] for key in ('SCRATCH_FOLDER', 'LIBRARY_DB')}
+        app.config['SCRATCH_FOLDER'] = self.scratch
+        app.config['LIBRARY_DB'] = os.path.join(self.tmp, 'library.db')
+        # Every test requests the same URL; a job left waiting for a retry must not absorb the next one
+        self.single_flight = patch.dict('app.single_flight_jobs', clear=True)
+        self.single_flight.start()
+
+    def tearDown(self):
+        self.single_flight.stop()
+        app.config.update(self.original_config)
+        shutil.rmtree(self.tmp)
+
+    def fake_yt_dlp(self, error_line=None):
+        """Popen stand-in that writes the files yt-dlp would write for the -o template it gets."""
+        def popen(command, **kwargs):
+            template = command[command.index('-o') + 1]
+            media = template.replace('%(title)s', 'Clip').replace('%(ext)s', 'mp4')
+            os.makedirs(os.path.dirname(media), exist_ok=True)
+            with open(media, 'wb') as f:
+                f.write(b'media')
+            with open(media + '.part', 'wb') as f:
+                f.write(b'leftover')
+            lines = [f"[download] Destination: {media}\n"]
+            if error_line:
+                lines.append(error_line)
+            process = MagicMock()
+            process.stdout = iter(lines)
+            process.wait.return_value = 1 if error_line else 0
+            return process
+        return popen
+
+    def run_job(self, popen):
+        with patch('app.subprocess.Popen', side_effect=popen) as mock_popen:
+            response = self.client.post('/start_download', json={
+                'url': 'https://www.youtube.com/watch?v=staged', 'format': 'mp4', 'output_dir': self.output_dir
+            })
+            job = jobs[response.get_json()['job_id']]
+            deadline = time.time() + 5
+            while job['status'] in ('queued', 'running') and time.time() < deadline:
+                time.sleep(0.01)
+        return job, mock_popen
+
+    def test_staged_files_are_moved_to_output_dir(self):
+        job, mock_popen = self.run_job(self.fake_yt_dlp())
+        command = mock_popen.call_args[0][0]
+        self.assertTrue(command[command.index('-o') + 1].startswith(self.scratch))
+
+        self.assertEqual(job['status'], 'finished')
+        final = os.path.join(self.output_dir, 'Clip.mp4')
+        self.assertEqual(job['files'], [final])
+        self.assertTrue(os.path.isfile(final))
+        self.assertFalse(os.path.exists(final + '.part'))
+        self.assertEqual(os.listdir(self.scratch), [])
+        self.assertNotIn(job['stage_dir'], scratch_reservations)
+        self.assertIn('placing', [phase['phase'] for phase in job['timeline']])
+
+    def test_full_scratch_falls_back_to_direct_writes(self):
+        with patch('app.SCRATCH_MAX_BYTES', 0):
+            job, mock_popen = self.run_job(self.fake_yt_dlp())
+        command = mock_popen.call_args[0][0]
+        self.assertTrue(command[command.index('-o') + 1].startswith(self.output_dir))
+        self.assertIsNone(job['stage_dir'])
+        self.assertEqual(job['files'], [os.path.join(self.output_dir, 'Clip.mp4')])
+
+    def test_disk_full_retries_without_staging(self):
+        job, mock_popen = self.run_job(self.fake_yt_dlp("ERROR: [Errno 28] No space left on device\n"))
+        job['retry_timer'].cancel()
+        self.assertEqual(job['status'], 'retry_scheduled')
+        self.assertEqual(job['retries'], {'disk_full': 1})
+        self.assertIsNone(job['stage_dir'])
+        self.assertTrue(job['command'][job['command'].index('-o') + 1].startswith(self.output_dir))
+        self.assertTrue(os.path.isfile(os.path.join(self.output_dir, 'Clip.mp4')))
+        self.assertEqual(os.listdir(self.scratch), [])
+
+    def test_files_waiting_for_a_retry_are_not_indexed_from_scratch(self):
+        error = "ERROR: [youtube] staged: Unable to download webpage: <urlopen error [Errno -3] Temporary failure in name resolution>\n"
+        with patch('app.queue_dedup') as queue_dedup:
+            job, _ = self.run_job(self.fake_yt_dlp(error))
+        job['retry_timer'].cancel()
+        self.addCleanup(release_scratch, job)
+        self.assertEqual(job['status'], 'retry_scheduled')
+        self.assertIsNotNone(job['stage_dir'])
+        queue_dedup.assert_not_called()
+        with _library_lock:
+            paths = [row['path'] for row in get_library_db().execute("SELECT path FROM media")]
+        self.assertEqual(paths, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
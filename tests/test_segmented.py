@@ -0,0 +1,162 @@
+import unittest
+import os
+import re
+import shutil
+import tempfile
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from app import app, jobs, split_ranges, plan_segments, parse_destination, scratch_reservations, DOWNLOAD_FOLDER
+from unittest.mock import patch, MagicMock
+
+PAYLOAD = os.urandom(200 * 1024)
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """Serves PAYLOAD with Range support; the first request for each of the four segments drops mid-way."""
+    dropped = set()
+    lock = threading.Lock()
+
+    def do_GET(self):
+        start, end = map(int, re.match(r'bytes=(\d+)-(\d+)', self.headers['Range']).groups())
+        body = PAYLOAD[start:end + 1]
+        with self.lock:
+            drop = start % (len(PAYLOAD) // 4) == 0 and start not in self.dropped
+            if drop:
+                self.dropped.add(start)
+        self.send_response(206)
+        self.send_header('Content-Range', f'bytes {start}-{end}/{len(PAYLOAD)}')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body[:len(body) // 2] if drop else body)
+
+    def log_message(self, *args):
+        pass
+
+
+class SegmentedDownloadTests(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client()
+        self.client.testing = True
+        self.tmp = tempfile.mkdtemp()
+        self.server = HTTPServer(('127.0.0.1', 0), RangeHandler)
+        threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_port}/video'
+        RangeHandler.dropped = set()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp)
+
+    def test_split_ranges_cover_everything(self):
+        ranges = split_ranges(1001, 4)
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], 1000)
+        for (_, end), (start, _) in zip(ranges, ranges[1:]):
+            self.assertEqual(start, end + 1)
+        self.assertEqual(split_ranges(3, 8), [(0, 0), (1, 1), (2, 2)])
+
+    def test_plan_segments_requires_progressive_formats(self):
+        info = {'requested_formats': [
+            {'format_id': '137', 'protocol': 'https', 'url': 'u', 'filesize': 100 * 1024 ** 2, 'ext': 'mp4'},
+            {'format_id': '140', 'protocol': 'https', 'url': 'u', 'filesize': 1024, 'ext': 'm4a'},
+        ]}
+        parts = plan_segments(info, 8)
+        self.assertEqual(len(parts[0]['ranges']), 8)
+        self.assertEqual(len(parts[1]['ranges']), 1)
+        info['requested_formats'][0]['protocol'] = 'm3u8_native'
+        self.assertIsNone(plan_segments(info, 8))
+
+    def run_segmented_job(self, probe_info, mock_lines=(), output_dir=DOWNLOAD_FOLDER, **options):
+        with patch('app.probe_media', return_value=probe_info), \
+                patch('app.SEGMENTED_MIN_BYTES', 1024), patch('app.backoff_delay', return_value=0), \
+                patch('app.subprocess.Popen') as mock_popen:
+            mock_proc = MagicMock()
+            mock_proc.stdout = iter(mock_lines)
+            mock_proc.wait.return_value = 0
+            mock_popen.return_value = mock_proc
+            response = self.client.post('/start_download', json={
+                'url': 'https://www.youtube.com/watch?v=longvod', 'format': 'mkv', 'output_dir': output_dir,
+                'download_options': dict(options, segmented=True, segments=4),
+            })
+            job = jobs[response.get_json()['job_id']]
+            job['thread'].join(timeout=10)
+        return job, mock_popen
+
+    def test_segments_download_in_parallel_and_retry_individually(self):
+        target = os.path.join(self.tmp, 'Long VOD.mkv')
+        job, _ = self.run_segmented_job({
+            'filename': target,
+            'format_id': '22', 'protocol': 'http', 'url': self.url, 'filesize': len(PAYLOAD), 'ext': 'mkv',
+        })
+        self.assertEqual(job['status'], 'finished', job['errors'])
+        with open(target, 'rb') as f:
+            self.assertEqual(f.read(), PAYLOAD)
+        self.assertEqual(len(RangeHandler.dropped), 4)
+        phases = [entry['phase'] for entry in job['timeline']]
+        self.assertIn('downloading', phases)
+
+    def test_sidecars_keep_the_organized_media_path(self):
+        output_dir = os.path.join(self.tmp, 'out')
+        target = os.path.join(output_dir, 'Long VOD', 'Long VOD.mkv')
+        info_json = os.path.join(output_dir, 'Long VOD', 'Long VOD.info.json')
+        os.makedirs(os.path.dirname(target))
+        with open(info_json, 'w') as f:
+            f.write('{"title": "Long VOD"}')
+        with patch.dict(app.config, LIBRARY_DB=os.path.join(self.tmp, 'library.db')):
+            job, mock_popen = self.run_segmented_job({
+                'filename': target,
+                'format_id': '22', 'protocol': 'http', 'url': self.url, 'filesize': len(PAYLOAD), 'ext': 'mkv',
+            }, output_dir=output_dir, info_json=True)
+        self.assertIn('--write-info-json', mock_popen.call_args[0][0])
+        self.assertEqual(job['status'], 'finished', job['errors'])
+        self.assertEqual(job['files'], [os.path.join(output_dir, 'Long VOD.mkv')])
+        self.assertTrue(os.path.isfile(job['files'][0]))
+
+    def test_post_processing_runs_on_the_merged_file(self):
+        target = os.path.join(self.tmp, 'Long VOD.mkv')
+        remuxed = os.path.join(self.tmp, 'Long VOD.flv')
+
+        def remux_output():
+            yield f'[download] {target} has already been downloaded\n'
+            yield '[SponsorBlock] Found 1 segments in the SponsorBlock database\n'
+            os.replace(target, remuxed)
+            yield f'[VideoRemuxer] Remuxing video from mkv to flv; Destination: {remuxed}\n'
+
+        with patch.dict(app.config, LIBRARY_DB=os.path.join(self.tmp, 'library.db')):
+            job, mock_popen = self.run_segmented_job({
+                'filename': target,
+                'format_id': '22', 'protocol': 'http', 'url': self.url, 'filesize': len(PAYLOAD), 'ext': 'mkv',
+            }, remux_output(), sponsorblock=True)
+        command = mock_popen.call_args[0][0]
+        self.assertNotIn('--skip-download', command)
+        self.assertIn('--sponsorblock-remove', command)
+        self.assertEqual(job['status'], 'finished', job['errors'])
+        self.assertEqual(job['files'], [remuxed])
+
+    def test_parse_destination_of_converted_files(self):
+        self.assertEqual(parse_destination('[VideoConvertor] Converting video from mkv to webm; Destination: a b.webm'),
+                         'a b.webm')
+        self.assertEqual(parse_destination('[download] Destination: a.mp4'), 'a.mp4')
+        self.assertIsNone(parse_destination('[download] a.mp4 has already been downloaded'))
+
+    def test_invalid_segment_count_is_rejected_before_anything_is_reserved(self):
+        with patch.dict(app.config, SCRATCH_FOLDER=os.path.join(self.tmp, 'scratch')):
+            job_count = len(jobs)
+            response = self.client.post('/start_download', json={
+                'url': 'https://www.youtube.com/watch?v=longvod', 'format': 'mkv', 'output_dir': self.tmp,
+                'download_options': {'segmented': True, 'segments': 'lots'},
+            })
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(len(jobs), job_count)
+            self.assertEqual(scratch_reservations, {})
+
+    def test_fragmented_formats_fall_back_to_concurrent_fragments(self):
+        job, mock_popen = self.run_segmented_job({
+            'filename': os.path.join(self.tmp, 'Live.mkv'),
+            'format_id': 'hls-1080', 'protocol': 'm3u8_native', 'url': self.url, 'ext': 'mp4',
+        })
+        command = mock_popen.call_args[0][0]
+        self.assertEqual(command[command.index('--concurrent-fragments') + 1], '4')
+        self.assertEqual(command[-1], 'https://www.youtube.com/watch?v=longvod')
+        self.assertEqual(job['status'], 'finished')
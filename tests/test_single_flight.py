@@ -0,0 +1,84 @@
+import unittest
+import os
+import shutil
+import tempfile
+import time
+from app import app, jobs, normalize_url, get_library_db, _library_lock
+from loadtest.harness import FAKE_YT_DLP
+from unittest.mock import patch
+
+
+class SingleFlightTests(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client()
+        self.client.testing = True
+        self.tmp = tempfile.mkdtemp()
+        self.original_db = app.config['LIBRARY_DB']
+        app.config['LIBRARY_DB'] = os.path.join(self.tmp, 'library.db')
+        self.binary = patch('app.YT_DLP_BINARY', FAKE_YT_DLP)
+        self.binary.start()
+
+    def tearDown(self):
+        self.binary.stop()
+        app.config['LIBRARY_DB'] = self.original_db
+        shutil.rmtree(self.tmp)
+
+    def request(self, url, output_dir, **options):
+        response = self.client.post('/start_download', json={
+            'url': url, 'format': options.pop('format', 'mp4'), 'download_options': options,
+            'output_dir': os.path.join(self.tmp, output_dir),
+        })
+        return response.get_json()
+
+    def wait(self, job):
+        deadline = time.time() + 10
+        while job['status'] in ('queued', 'running') and time.time() < deadline:
+            time.sleep(0.02)
+
+    def test_normalize_url(self):
+        self.assertEqual(normalize_url('https://WWW.Example.com/v/?b=2&a=1#t=10'),
+                         normalize_url('https://example.com/v?a=1&b=2'))
+        self.assertNotEqual(normalize_url('https://example.com/v?a=1'), normalize_url('https://example.com/v?a=2'))
+
+    def test_duplicate_requests_share_one_download(self):
+        url = 'https://fake.test/watch?v=shared&duration=0.5&size=2048'
+        first = self.request(url, 'alice', info_json=True)
+        second = self.request(url.replace('https://fake.test', 'https://www.fake.test'), 'bob', info_json=True)
+        again = self.request(url, 'alice', info_json=True)  # a retrying client
+        self.assertNotIn('attached', first)
+        self.assertEqual(second, {'message': 'Attached to a running download', 'job_id': first['job_id'], 'attached': True})
+        self.assertEqual(again['job_id'], first['job_id'])
+
+        job = jobs[first['job_id']]
+        self.wait(job)
+        self.assertEqual(job['status'], 'finished')
+        self.assertEqual([p['job_class'] for p in job['processes']], ['download'])
+        self.assertEqual([r['output_dir'] for r in job['requesters']], [os.path.join(self.tmp, 'bob')])
+
+        media = os.path.join(self.tmp, 'alice', 'Fake Video shared.mp4')
+        copy = os.path.join(self.tmp, 'bob', 'Fake Video shared.mp4')
+        self.assertEqual(job['files'], [media])
+        self.assertEqual(job['requesters'][0]['files'], [copy])
+        self.assertTrue(os.path.samefile(media, copy))
+        self.assertTrue(os.path.isfile(os.path.join(self.tmp, 'bob', 'Fake Video shared', 'Fake Video shared.info.json')))
+        with _library_lock:
+            paths = {row['path'] for row in get_library_db().execute("SELECT path FROM media")}
+        self.assertEqual(paths, {media, copy})
+
+        # Once finished, the same request is a new download
+        repeat = self.request(url, 'alice', info_json=True)
+        self.assertNotEqual(repeat['job_id'], first['job_id'])
+        self.wait(jobs[repeat['job_id']])
+
+    def test_different_format_or_options_are_separate_downloads(self):
+        url = 'https://fake.test/watch?v=apart&duration=0.3'
+        first = self.request(url, 'a')
+        other_format = self.request(url, 'b', format='webm')
+        other_options = self.request(url, 'c', thumbnail=True)
+        self.assertEqual(len({first['job_id'], other_format['job_id'], other_options['job_id']}), 3)
+        for response in (first, other_format, other_options):
+            self.wait(jobs[response['job_id']])
+
+
+if __name__ == '__main__':
+    unittest.main()
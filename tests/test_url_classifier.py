@@ -0,0 +1,109 @@
+import unittest
+from app import (app, build_url_index, match_url, pattern_hosts, host_keys, classify_url, _classify_url,
+                 FALLBACK_EXTRACTORS)
+from unittest.mock import patch
+
+
+class PatternHostTests(unittest.TestCase):
+    def test_literal_hosts_are_found(self):
+        cases = {
+            r'https?://(?:www\.|m\.)?youtube\.com/watch\?v=(?P<id>\w+)': {'youtube.com'},
+            r'https?://(?:www\.)?(?:youtube\.com|youtu\.be)/': {'youtube.com', 'youtu.be'},
+            r'https?://(?:[\w-]+\.)?facebook\.com/': {'facebook.com'},
+            r'https?://tv\d+\.example\.com(?:\.au)?/': {'example.com'},
+            r'(?x)https?://  (?:www\.)?foo\.tv  (?:/|$)  # comment': {'foo.tv'},
+            r'(?:https?://)?(?:\w+\.)?(?:youtube\.com|yt\.be)/x': {'youtube.com', 'yt.be'},
+        }
+        for pattern, expected in cases.items():
+            with self.subTest(pattern=pattern):
+                self.assertEqual(pattern_hosts(pattern), expected)
+
+    def test_variable_hosts_are_not_indexed(self):
+        # Each of these can match a host that has none of the literals as whole labels
+        for pattern in [
+            r'https?://(?P<host>[^/]+)/watch',
+            r'https?://example\.coms?/',
+            r'https?://\dfoo\.com/',
+            r'https?://(?:youtube(?:kids)?\.com|invidio\.us)/',
+            r'https?://bili(?:bili\.tv|intl\.com)/',
+            r'https?://(?:youtube\.com|[^/]+\.invidious\.\w+)/',
+            r'(?:https?://a\.example\.com/x|https?://b\.example\.com)/',
+        ]:
+            with self.subTest(pattern=pattern):
+                self.assertEqual(pattern_hosts(pattern), set())
+
+    def test_host_keys_are_label_runs(self):
+        self.assertEqual(host_keys('m.youtube.com'), {'m.youtube', 'youtube.com', 'm.youtube.com'})
+
+
+class ClassifierTests(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client()
+        self.client.testing = True
+        _classify_url.cache_clear()
+        self.index = patch('app._url_index', build_url_index(FALLBACK_EXTRACTORS))
+        self.index.start()
+
+    def tearDown(self):
+        self.index.stop()
+        _classify_url.cache_clear()
+
+    def test_index_keeps_extractor_order_and_custom_rules(self):
+        index = build_url_index([
+            ('special', [r'https?://(?:www\.)?example\.com/v/(?P<id>\d+)'], False, lambda url: 'skip' not in url),
+            ('anyhost', [r'https?://[^/]+/v/(?P<id>\w+)'], False),
+            ('example', [r'https?://(?:www\.)?example\.com/(?:v|list)/(?P<id>\w+)'], True),
+        ])
+        self.assertEqual(index['unindexed'][0]['name'], 'anyhost')
+        self.assertEqual(match_url(index, 'https://example.com/v/1'), ('special', False, '1'))
+        self.assertEqual(match_url(index, 'https://example.com/v/1?skip'), ('anyhost', False, '1'))
+        self.assertEqual(match_url(index, 'https://www.example.com/list/abc'), ('example', True, 'abc'))
+        self.assertIsNone(match_url(index, 'https://example.org/list/abc'))
+
+    def test_classify_url(self):
+        cases = {
+            'https://www.youtube.com/watch?v=dQw4w9WgXcQ': ('youtube', False, 'dQw4w9WgXcQ'),
+            'https://youtu.be/dQw4w9WgXcQ': ('youtube', False, 'dQw4w9WgXcQ'),
+            'HTTPS://WWW.YouTube.com/watch?v=dQw4w9WgXcQ': ('youtube', False, 'dQw4w9WgXcQ'),
+            'https://www.youtube.com/playlist?list=PLabc': ('youtube:tab', True, 'PLabc'),
+            'https://soundcloud.com/artist/sets/album': ('soundcloud:set', True, 'album'),
+            'https://example.com/video.mp4': (None, False, None),
+        }
+        for url, (extractor, is_playlist, video_id) in cases.items():
+            with self.subTest(url=url):
+                self.assertEqual(classify_url(url), {'extractor': extractor, 'is_playlist': is_playlist, 'id': video_id})
+
+    def test_results_are_memoized(self):
+        classify_url('https://vimeo.com/123456')
+        classify_url('https://vimeo.com/123456')
+        self.assertEqual(_classify_url.cache_info().hits, 1)
+
+    def test_validate_url(self):
+        response = self.client.post('/validate_url', json={'url': 'https://www.youtube.com/playlist?list=PLabc'})
+        self.assertEqual(response.get_json(), {
+            'valid': True, 'is_youtube': True, 'is_playlist': True, 'extractor': 'youtube:tab', 'id': 'PLabc'
+        })
+        response = self.client.post('/validate_url', json={'url': 'https://WWW.YouTube.com/watch?v=dQw4w9WgXcQ'})
+        self.assertTrue(response.get_json()['valid'])
+        response = self.client.post('/validate_url', json={'url': 'ftp://example.com'})
+        self.assertEqual(response.get_json(), {'valid': False, 'error': 'Invalid URL format'})
+
+    def test_validate_urls_batch(self):
+        urls = ['https://vimeo.com/123456', 'https://example.com/page', 'not a url',
+                'https://www.dailymotion.com/playlist/x6hynp']
+        response = self.client.post('/validate_urls', json={'urls': urls})
+        body = response.get_json()
+        self.assertEqual([r['url'] for r in body['results']], urls)
+        self.assertEqual([r['valid'] for r in body['results']], [True, False, False, True])
+        self.assertEqual(body['summary'], {'total': 4, 'valid': 2, 'playlists': 1})
+
+        response = self.client.post('/validate_urls', json={'urls': 'https://vimeo.com/1\n\nhttps://vimeo.com/2\n'})
+        self.assertEqual(response.get_json()['summary']['valid'], 2)
+
+        with patch('app.URL_BATCH_LIMIT', 1):
+            response = self.client.post('/validate_urls', json={'urls': urls})
+        self.assertEqual(response.status_code, 400)
+
+
+if __name__ == '__main__':
+    unittest.main()